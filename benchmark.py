@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import csv
+import http.server
+import io
+import json
+import os
+import resource
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+import simulator
+from modules import messagetypes
+from modules.communicator import Communicator
+from modules.dataparser import DataParser
+from modules.mllp import MLLPFile, decode_frames, to_mllp
+
+DEFAULT_MESSAGES = 1000
+DEFAULT_PATIENTS = 500
+DEFAULT_RESULTS_PER_PATIENT = 2
+# creatinine result sent to every other patient, far above any baseline so AKI is detected
+AKI_CREATININE = 400
+STARTUP_TIMEOUT_SECONDS = 120
+PAGE_SETTLE_SECONDS = 2
+
+def percentiles(samples):
+    '''Summarises latency samples in seconds as milliseconds.'''
+    if not samples:
+        return None
+    samples = sorted(samples)
+    def at(p):
+        return round(samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000, 3)
+    return {"p50": at(50), "p95": at(95), "p99": at(99), "mean": round(statistics.fmean(samples) * 1000, 3)}
+
+def generate_messages(history, filename, patients, results_per_patient):
+    '''
+    Writes an MLLP message file for the simulator. Every patient from the history is admitted,
+    gets blood test results and is discharged, and every other patient's last result is an AKI.
+    Returns:
+        aki_messages (dict): The index of the AKI result message of each patient sent one, by MRN.
+    '''
+    with open(history) as f:
+        reader = csv.reader(f)
+        next(reader)
+        mrns = [row[0] for _, row in zip(range(patients), reader)]
+    aki_messages = {}
+    count = 0
+    with open(filename, "wb") as w:
+        def write(segments):
+            nonlocal count
+            w.write(to_mllp(("\r".join(segments) + "\r").encode("ascii")))
+            count += 1
+        for i, mrn in enumerate(mrns):
+            stamp = f"202406{1 + i // 24 % 28:02d}{i % 24:02d}"
+            write([f"MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||{stamp}0000||ADT^A01|||2.5", f"PID|1||{mrn}||JOHN DOE||19600101|M"])
+            for j in range(results_per_patient):
+                value = 80 + j
+                if i % 2 == 0 and j == results_per_patient - 1:
+                    value = AKI_CREATININE
+                    aki_messages[mrn] = count
+                write([f"MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||{stamp}{j + 1:02d}00||ORU^R01|||2.5", f"PID|1||{mrn}",
+                       f"OBR|1||||||{stamp}{j + 1:02d}00", f"OBX|1|SN|CREATININE||{value}"])
+            write([f"MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||{stamp}5900||ADT^A03|||2.5", f"PID|1||{mrn}"])
+    return aki_messages
+
+class TimedMLLPServer():
+    '''
+    Replays messages like the simulator MLLP server, recording when each message was sent and acknowledged.
+    A reconnecting client continues from the first message not acknowledged yet, and the connection is
+    kept open after the last message so the client does not reconnect for a replay.
+    '''
+    def __init__(self, hl7_messages):
+        self.hl7_messages = hl7_messages
+        self.sent = {}
+        self.acked = {}
+        self.first_connection = None
+        self.finished = threading.Event()
+        self.shutdown = threading.Event()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("localhost", 0))
+        self.server.listen(1)
+        self.server.settimeout(simulator.SHUTDOWN_POLL_INTERVAL_SECONDS)
+        self.port = self.server.getsockname()[1]
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        i = 0
+        while not self.shutdown.is_set():
+            try:
+                client, (host, port) = self.server.accept()
+            except TimeoutError:
+                continue
+            if self.first_connection is None:
+                self.first_connection = time.perf_counter()
+            i = self.serve(client, f"{host}:{port}", i)
+
+    def serve(self, client, source, i):
+        client.settimeout(simulator.MLLP_TIMEOUT_SECONDS)
+        buffer = b""
+        try:
+            while i < len(self.hl7_messages):
+                self.sent[i] = time.perf_counter()
+                client.sendall(to_mllp(self.hl7_messages[i]))
+                received = []
+                while len(received) < 1:
+                    r = client.recv(simulator.MLLP_BUFFER_SIZE)
+                    if len(r) == 0:
+                        raise Exception("client closed connection")
+                    buffer += r
+                    received, buffer = decode_frames(buffer, source)
+                acked, error = simulator.verify_ack(received)
+                if error:
+                    raise Exception(error)
+                self.acked[i] = time.perf_counter()
+                i += 1
+            self.finished.set()
+            self.shutdown.wait()
+        except Exception as e:
+            print(f"mllp: {source}: {e}")
+        client.close()
+        return i
+
+    def close(self):
+        self.shutdown.set()
+        self.thread.join()
+        self.server.close()
+
+class TimedPagerRequestHandler(simulator.PagerRequestHandler):
+    '''Pager of the simulator, recording when the first page of each MRN arrived.'''
+    def do_POST_page(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.pages.setdefault(body.split(b",")[0].decode(), time.perf_counter())
+        self.rfile = io.BytesIO(body)
+        # keep stdout for the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            super().do_POST_page()
+
+def ack_rtt_server(server, hl7_messages, count, rtts):
+    '''Replays the messages to one client like the simulator, timing each message until its ACK.'''
+    client, (host, port) = server.accept()
+    source = f"{host}:{port}"
+    client.settimeout(simulator.MLLP_TIMEOUT_SECONDS)
+    buffer = b""
+    try:
+        for i in range(count):
+            mllp = to_mllp(hl7_messages[i % len(hl7_messages)])
+            start = time.perf_counter()
+            client.sendall(mllp)
+            received = []
+            while len(received) < 1:
+                r = client.recv(simulator.MLLP_BUFFER_SIZE)
+                if len(r) == 0:
+                    raise Exception("client closed connection")
+                buffer += r
+                received, buffer = decode_frames(buffer, source)
+            rtts.append(time.perf_counter() - start)
+            acked, error = simulator.verify_ack(received)
+            if error or not acked:
+                raise Exception(error or "message not acknowledged")
+    finally:
+        client.close()
+
+def ack_rtt(hl7_messages, count, socket_options):
+    '''
+    Measures the round trip from sending a message to receiving its ACK, with the
+    Communicator acknowledging every message as soon as it is received.
+    Args:
+        hl7_messages (list): The messages to replay, without MLLP framing.
+        count (int): The number of messages to send.
+        socket_options (dict): The socket options of the Communicator.
+    Returns:
+        result (dict): The ACK round trip percentiles in milliseconds.
+    '''
+    rtts = []
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+        server.bind(("localhost", 0))
+        server.listen(1)
+        t = threading.Thread(target=ack_rtt_server, args=(server, hl7_messages, count, rtts), daemon=True)
+        t.start()
+        communicator = Communicator(f"localhost:{server.getsockname()[1]}", socket_options=socket_options)
+        while communicator.receive() is not None:
+            communicator.acknowledge(True)
+        communicator.close()
+        t.join()
+    return {"messages": len(rtts), "ack_rtt_ms": percentiles(rtts)}
+
+def end_to_end(flags, main_args):
+    '''
+    Runs main.py against a generated message file replayed by the simulator, from a fresh database.
+    Returns:
+        result (dict): Throughput, message-to-ACK and message-to-page latency percentiles in
+            milliseconds, peak RSS and startup time of main.py.
+    '''
+    with tempfile.TemporaryDirectory() as state:
+        messages_file = os.path.join(state, "messages.mllp")
+        aki_messages = generate_messages(flags.history, messages_file, flags.patients, flags.results_per_patient)
+        hl7_messages = MLLPFile(messages_file)
+        mllp = TimedMLLPServer(hl7_messages)
+        pager = http.server.ThreadingHTTPServer(("localhost", 0), lambda *args, **kwargs: TimedPagerRequestHandler(lambda: None, *args, **kwargs))
+        pager.pages = {}
+        threading.Thread(target=pager.serve_forever, daemon=True).start()
+
+        start = time.perf_counter()
+        with open(os.path.join(state, "main.out"), "w") as out:
+            p = subprocess.Popen([sys.executable, "main.py", f"--mllp=localhost:{mllp.port}", f"--pager=localhost:{pager.server_address[1]}",
+                                  f"--history={flags.history}", f"--database={os.path.join(state, 'database.db')}", f"--logs={state}"] + main_args,
+                                 stdout=out, stderr=subprocess.STDOUT)
+            try:
+                deadline = time.time() + STARTUP_TIMEOUT_SECONDS
+                while mllp.first_connection is None and time.time() < deadline and p.poll() is None:
+                    time.sleep(0.01)
+                if mllp.first_connection is None:
+                    raise Exception(f"main.py did not connect, see {os.path.join(state, 'main.out')}")
+                mllp.finished.wait()
+                deadline = time.time() + PAGE_SETTLE_SECONDS
+                while len(pager.pages) < len(aki_messages) and time.time() < deadline:
+                    time.sleep(0.01)
+            finally:
+                p.send_signal(signal.SIGTERM)
+                p.wait()
+        mllp.close()
+        pager.shutdown()
+
+    acked = sorted(mllp.acked)
+    seconds = mllp.acked[acked[-1]] - mllp.sent[acked[0]]
+    page_latencies = [paged - mllp.sent[aki_messages[mrn]] for mrn, paged in pager.pages.items() if mrn in aki_messages]
+    return {
+        "messages": len(acked),
+        "seconds": round(seconds, 3),
+        "messages_per_second": round(len(acked) / seconds, 1),
+        "ack_latency_ms": percentiles([mllp.acked[i] - mllp.sent[i] for i in acked]),
+        "pages": len(page_latencies),
+        "expected_pages": len(aki_messages),
+        "page_latency_ms": percentiles(page_latencies),
+        "startup_seconds": round(mllp.first_connection - start, 3),
+        # kilobytes on linux, the only child is main.py
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        "main_args": main_args,
+    }
+
+def split_parse(dataparser, message):
+    '''The DataParser path before parse_message scanned the frame, decoding and splitting all of it.'''
+    segments = dataparser.segment_message(dataparser.remove_start_and_end(message).decode('utf-8'))
+    message_obj = {dataparser.ORU: messagetypes.Oru_r01, dataparser.A01: messagetypes.Adt_a01,
+                   dataparser.A03: messagetypes.Adt_a03}[dataparser.get_message_type(segments)]()
+    return message_obj if message_obj.process_message(segments) else None
+
+def parse(hl7_messages, repeat):
+    '''
+    Measures the time to parse each message with DataParser.parse_message against splitting it,
+    and with DataParser.parse_many parsing all of them into columns.
+    Returns:
+        result (dict): Microseconds per message of every parser.
+    '''
+    dataparser = DataParser()
+    frames = list(hl7_messages.frames())
+    parsers = {
+        "split": lambda: [split_parse(dataparser, frame) for frame in frames],
+        "parse_message": lambda: [dataparser.parse_message(frame) for frame in frames],
+        "parse_many": lambda: dataparser.parse_many(frames),
+    }
+    seconds = {name: [] for name in parsers}
+    # the parsers take turns, so a noisy neighbour slows all alike
+    for _ in range(repeat):
+        for name, parser in parsers.items():
+            seconds[name].append(timeit.timeit(parser, number=1))
+    return {name: {"us_per_message": round(min(times) / len(frames) * 1e6, 3)} for name, times in seconds.items()}
+
+def bytewise_decode(buffer, source):
+    '''The simulator decoder before the mllp module, walking the buffer one byte at a time.'''
+    i = 0
+    messages = []
+    consumed = 0
+    expect = simulator.MLLP_START_OF_BLOCK
+    while i < len(buffer):
+        if expect is not None:
+            if buffer[i] != expect:
+                raise Exception(f"{source}: bad MLLP encoding: want {hex(expect)}, found {hex(buffer[i])}")
+            if expect == simulator.MLLP_START_OF_BLOCK:
+                expect = None
+                consumed = i
+            elif expect == simulator.MLLP_CARRIAGE_RETURN:
+                messages.append(buffer[consumed+1:i-1])
+                expect = simulator.MLLP_START_OF_BLOCK
+                consumed = i + 1
+        elif buffer[i] == simulator.MLLP_END_OF_BLOCK:
+            expect = simulator.MLLP_CARRIAGE_RETURN
+        i += 1
+    return messages, buffer[consumed:]
+
+def load(filename, repeat):
+    '''
+    Measures the time to load an MLLP file and read every message, reading the whole file and
+    decoding it byte by byte or with decode_frames, against indexing it through mmap with MLLPFile.
+    Returns:
+        result (dict): Seconds and MB/s of every loader.
+    '''
+    def read(decode):
+        with open(filename, "rb") as r:
+            return len(decode(r.read(), filename)[0])
+    def mapped():
+        with MLLPFile(filename) as messages:
+            return sum(1 for _ in messages)
+    loaders = {
+        "bytewise": lambda: read(bytewise_decode),
+        "decode_frames": lambda: read(decode_frames),
+        "mmap": mapped,
+    }
+    seconds = {name: [] for name in loaders}
+    for _ in range(repeat):
+        for name, loader in loaders.items():
+            seconds[name].append(timeit.timeit(loader, number=1))
+    megabytes = os.path.getsize(filename) / 1e6
+    return {name: {"seconds": round(min(times), 4), "mb_per_second": round(megabytes / min(times), 1)} for name, times in seconds.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks main.py against the simulator, extra arguments are passed to main.py")
+    modes = parser.add_subparsers(dest="mode", required=True)
+    e2e = modes.add_parser("e2e", help="Throughput and latency of main.py replaying a generated message file")
+    e2e.add_argument("--history", default="./data/coursework5-history.csv", help="History CSV file, its patients are used for the messages")
+    e2e.add_argument("--patients", default=DEFAULT_PATIENTS, type=int, help="Number of patients admitted, every other one with AKI")
+    e2e.add_argument("--results-per-patient", default=DEFAULT_RESULTS_PER_PATIENT, type=int, help="Number of blood test results per patient")
+    e2e.add_argument("--output", help="File to write the JSON report to, as well as stdout")
+    ack = modes.add_parser("ack-rtt", help="ACK round trip of the Communicator with Nagle's algorithm on and off")
+    ack.add_argument("--messages", default="messages.mllp", help="HL7 messages to replay, in MLLP format")
+    ack.add_argument("--count", default=DEFAULT_MESSAGES, type=int, help="Number of messages to send")
+    parse_mode = modes.add_parser("parse", help="Time per message of the HL7 parser")
+    parse_mode.add_argument("--messages", default="messages.mllp", help="HL7 messages to parse, in MLLP format")
+    parse_mode.add_argument("--repeat", default=20, type=int, help="Number of runs over the messages, the fastest is reported")
+    load_mode = modes.add_parser("load", help="Time to load an MLLP file and read every message")
+    load_mode.add_argument("--messages", default="messages.mllp", help="HL7 messages to load, in MLLP format")
+    load_mode.add_argument("--repeat", default=5, type=int, help="Number of loads of the file, the fastest is reported")
+    flags, main_args = parser.parse_known_args()
+    if flags.mode == "e2e":
+        results = end_to_end(flags, main_args)
+    elif flags.mode == "parse":
+        results = parse(MLLPFile(flags.messages), flags.repeat)
+    elif flags.mode == "load":
+        results = load(flags.messages, flags.repeat)
+    else:
+        hl7_messages = MLLPFile(flags.messages)
+        results = {}
+        for name, options in (("nagle", {"tcp_nodelay": False}), ("nodelay", {"tcp_nodelay": True})):
+            results[name] = ack_rtt(hl7_messages, flags.count, options)
+    report = json.dumps(results, indent=2)
+    if getattr(flags, "output", None):
+        with open(flags.output, "w") as w:
+            w.write(report + "\n")
+    print(report)
+
+if __name__ == "__main__":
+    main()
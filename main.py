@@ -1,13 +1,23 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
 import torch
 import http
 import logging
 import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from modules.communicator import Communicator
+from modules.communicator import Communicator, SOCKET_OPTIONS
+from modules.async_communicator import AsyncCommunicator
+from modules.multiplexer import MLLPMultiplexer, MLLP_LISTEN_BACKLOG
 from modules.dataparser import DataParser
-from modules.database import Database
+from modules.messagetypes import MessagePool
+from modules.pager import PAGER_WORKERS, PAGER_TIMEOUT_SECONDS, PAGE_DEADLINE_SECONDS
+from modules.database import Database, DATABASE_SYNCHRONOUS, SYNCHRONOUS_MODES, GROUP_COMMIT_MESSAGES
+from modules.patient_cache import PATIENT_CACHE_SIZE, PATIENT_CACHE_FLUSH_SECONDS
 from modules.preprocessor import Preprocessor
 from modules.model import load_model, inference
 from modules.module_logging import main_logger, set_log_path
@@ -17,20 +27,162 @@ from modules.recovery_utils import recover_messages, read_missed_messages
 import signal
 import sys
 
+INFLIGHT_WINDOW = 64
+SETTLE_INTERVAL_SECONDS = 0.1
+
+# set on shutdown, stops the processing thread of the sync engine between two messages
+stopping = threading.Event()
+processing = None
+
 
 def get_arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--mllp', type=str, help="Address to receive HL7 messages via MLLP")
+    parser.add_argument('--mllp', type=str, help="Comma separated addresses to receive HL7 messages via MLLP")
+    parser.add_argument('--listen', type=str, help="host:port to accept HL7 messages from senders connecting via MLLP")
     parser.add_argument('--pager', type=str, help="Address to page requests via HTTP")
     parser.add_argument('--history', type=str, help="Path to the history CSV file", default="./data/coursework5-history.csv")
     parser.add_argument('--model', type=str, help="Path to the model file", default="./lstm_model.pth")
     parser.add_argument('--database', type=str, help="Path to the database .db file", default="./data/database.db")
     parser.add_argument('--logs', type=str, help="Path to the log files", default="/state")
+    parser.add_argument('--pager-workers', type=int, help="Number of background threads sending pages", default=PAGER_WORKERS)
+    parser.add_argument('--page-timeout', type=float, help="Time budget in seconds of one page attempt", default=PAGER_TIMEOUT_SECONDS)
+    parser.add_argument('--page-deadline', type=float, help="Seconds from detection after which an unsent page is escalated", default=PAGE_DEADLINE_SECONDS)
+    parser.add_argument('--engine', type=str, choices=['sync', 'async'], help="Blocking main loop or asyncio ingest engine", default="sync")
+    parser.add_argument('--tcp-nodelay', action=argparse.BooleanOptionalAction, help="Disable Nagle's algorithm on the MLLP socket", default=SOCKET_OPTIONS["tcp_nodelay"])
+    parser.add_argument('--keepalive-idle', type=int, help="Idle seconds before the first TCP keepalive probe, 0 disables keepalive", default=SOCKET_OPTIONS["keepalive_idle"])
+    parser.add_argument('--recv-buffer', type=int, help="SO_RCVBUF size in bytes of the MLLP socket", default=SOCKET_OPTIONS["recv_buffer"])
+    parser.add_argument('--send-buffer', type=int, help="SO_SNDBUF size in bytes of the MLLP socket", default=SOCKET_OPTIONS["send_buffer"])
+    parser.add_argument('--read-timeout', type=float, help="Seconds without MLLP data after which the connection is reopened", default=SOCKET_OPTIONS["read_timeout"])
+    parser.add_argument('--inflight', type=int, help="Maximum number of messages received but not acknowledged yet", default=INFLIGHT_WINDOW)
+    parser.add_argument('--backpressure', type=str, choices=['stop-reading', 'slow-acks'], default="stop-reading",
+                        help="With a full in-flight window, stop reading the MLLP sockets, or keep serving them and only hold back the ACKs of new messages. "
+                             "The async engine always stops reading the connection whose message does not fit")
+    parser.add_argument('--patient-cache-size', type=int, help="Number of patients kept in memory in front of the database", default=PATIENT_CACHE_SIZE)
+    parser.add_argument('--cache-flush-interval', type=float, default=PATIENT_CACHE_FLUSH_SECONDS,
+                        help="Seconds between writes of cached test results to the database, 0 writes every result through before its ACK")
+    parser.add_argument('--synchronous', type=str.upper, choices=SYNCHRONOUS_MODES, default=DATABASE_SYNCHRONOUS,
+                        help="SQLite synchronous mode of the WAL journal, NORMAL does not survive a power loss but syncs far less")
+    parser.add_argument('--group-commit', type=int, default=GROUP_COMMIT_MESSAGES,
+                        help="Maximum number of received messages whose writes are committed in one transaction before their ACKs, 1 commits every message")
+    parser.add_argument('--echo-control-id', action='store_true', help="Echo the MSH-10 control ID of each message in its ACK")
     flags = parser.parse_args()
 
     return flags
 
-def main(communicator: Communicator, database: Database, dataparser: DataParser, preprocessor: Preprocessor, flags):
+def socket_options(flags):
+    '''Builds the MLLP socket options from the command line flags, see SOCKET_OPTIONS.'''
+    return {
+        "tcp_nodelay": flags.tcp_nodelay,
+        "keepalive": flags.keepalive_idle > 0,
+        "keepalive_idle": flags.keepalive_idle,
+        "recv_buffer": flags.recv_buffer,
+        "send_buffer": flags.send_buffer,
+        "read_timeout": flags.read_timeout,
+    }
+
+def process_message(message, database: Database, dataparser: DataParser, preprocessor: Preprocessor, model, device):
+    '''
+    Parses, stores and runs inference on a single received message.
+    Args:
+        message (bytes): The MLLP framed message
+    Returns:
+        accept (bool): False if the message is invalid and should be acknowledged with AE
+        positive (tuple): The (mrn, timestamp) to page if AKI was detected, None otherwise
+    '''
+    # Pass the message to data parser, only MSH is parsed until the message type is known
+    view = dataparser.view(message)
+    if view is None:
+        monitoring.increase_invalid_messages()
+        return False, None
+    if view.message_type == dataparser.A03:
+        # discharges are not preprocessed, so only the fields Adt_a03 requires are decoded
+        if not view.msg_timestamp or not view.mrn:
+            main_logger('ERROR', 'Invalid message format for ADT^A03: missing required fields')
+            monitoring.increase_invalid_messages()
+            return False, None
+        monitoring.increase_discharge_message()
+        return True, None
+    parsed_message = view.parse()
+
+    if parsed_message == None:
+        monitoring.increase_invalid_messages()
+        return False, None
+    elif parsed_message.message_type == 'ORU^R01':
+        monitoring.increase_blood_test_messages()
+        # every result of the panel is stored, see Database.set_many
+        for _, value in parsed_message.creatinine_results():
+            monitoring.increase_sum_blood_test_results(value)
+            monitoring.update_running_mean_blood_test_results()
+    else:
+        monitoring.increase_admission_message()
+
+    mrn = parsed_message.mrn
+    timestamp = parsed_message.msg_timestamp
+
+    # Process message
+    preprocessed_message = preprocessor.preprocess(parsed_message)
+    dataparser.release(parsed_message)
+
+    # Perform inference
+    has_aki = False
+    if preprocessed_message is not None:
+        has_aki = inference(model, preprocessed_message.to(device))
+
+    if has_aki:
+        database.is_positive(mrn, timestamp)
+        return True, (mrn, timestamp)
+    return True, None
+
+def process_batch(messages, database: Database, dataparser: DataParser, preprocessor: Preprocessor, model, device):
+    '''
+    Processes messages one by one, with their writes committed together in one transaction, see process_message.
+    Returns:
+        results (list): The (accept, positive) of every message, returned once their writes are committed,
+                        so they may be acknowledged
+    '''
+    database.begin_group()
+    try:
+        results = [process_message(message, database, dataparser, preprocessor, model, device) for message in messages]
+    except Exception:
+        # none of the messages is acknowledged, so none of their writes is kept
+        database.rollback_group()
+        raise
+    database.commit_group(len(messages))
+    return results
+
+def settle_pages(communicator: Communicator, database: Database):
+    '''
+    Records the outcome of the page attempts reported by the pager retry scheduler.
+    Paged patients are marked in the database, failed attempts persist their retry state,
+    so a restart resumes the schedule where it stopped.
+    It also writes the test results behind once the flush interval has passed, see Database.flush_due.
+    '''
+    database.flush_due()
+    for event, mrn, timestamp, attempts, next_attempt in communicator.completed_pages():
+        if event == 'paged':
+            database.paged(mrn)
+            monitoring.increase_positive_predictions()
+            # monitoring.update_positive_prediction_rate()
+        elif event == 'retry':
+            database.reschedule_page(mrn, attempts, next_attempt)
+        else:
+            main_logger('CRITICAL', f"Page for MRN {mrn} detected at {timestamp} missed its deadline after {attempts} attempts")
+            monitoring.increase_page_deadline_exceeded()
+
+def resume_pages(communicator: Communicator, database: Database, flags):
+    '''
+    Starts the pager and reschedules the positives that were not paged before the last shutdown.
+    '''
+    communicator.start_paging(flags.pager_workers, flags.page_deadline)
+    for mrn, timestamp, created, attempts, next_attempt in database.pending_pages():
+        communicator.schedule_page(mrn, timestamp, created, attempts, next_attempt)
+
+def main(communicator: Communicator, feeds: MLLPMultiplexer, database: Database, dataparser: DataParser, preprocessor: Preprocessor, flags):
+    '''
+    Receives from every MLLP feed on one thread and processes on another, see process_frames.
+    Messages are processed one at a time in the order they arrived, so the order is kept per
+    feed and per MRN, and each message is acknowledged on the feed it came from once processed.
+    '''
 
     ### Metrics ###
     main_logger('INFO', 'Server started')
@@ -40,81 +192,179 @@ def main(communicator: Communicator, database: Database, dataparser: DataParser,
     model = load_model(flags.model).to(device)
 
     ## settle the positives but not paged mrn in the database
-    mrns_times = database.settle_positives()
-    for mrn, timestamp in mrns_times:
-        communicator.page_queue.append((mrn, timestamp))
-    while communicator.page_queue:
-        mrn, timestamp = communicator.page_queue.pop()
-        r = communicator.page(mrn, timestamp)
-        if r is not None and r.status == http.HTTPStatus.OK:
-            database.paged(mrn)
-            monitoring.increase_positive_predictions()
-            monitoring.update_positive_prediction_rate()
-        else:
-            communicator.page_queue.appendleft((mrn, timestamp))
-            break
+    resume_pages(communicator, database, flags)
 
-    ## start the server
+    ## start the server, messages received but not acknowledged yet are limited to the in-flight window
+    global processing
+    inflight = queue.Queue()
+    done = queue.Queue()
+    window = 0
+    processing = threading.Thread(target=process_frames, args=(communicator, feeds, inflight, done, database, dataparser, preprocessor, model, device, flags.group_commit), daemon=True)
+    processing.start()
     while True:
-        # Receive message
-        message = communicator.receive()
-        monitoring.increase_message_received()
+        if not processing.is_alive():
+            main_logger('CRITICAL', 'Processing thread stopped, shutting down')
+            raise RuntimeError("processing thread stopped")
+
+        # Acknowledge the processed messages on the feed they arrived on
+        while not done.empty():
+            feeds.acknowledge(*done.get())
+            window -= 1
+        monitoring.set_inflight_messages(window)
+
+        if window >= flags.inflight:
+            if flags.backpressure == 'stop-reading':
+                # the sockets are not read, so the senders are held back by TCP flow control
+                try:
+                    feeds.acknowledge(*done.get(timeout=SETTLE_INTERVAL_SECONDS))
+                    window -= 1
+                except queue.Empty:
+                    pass
+            else:
+                # connections are still served, complete frames wait in their decoder unacknowledged
+                feeds.poll()
+            continue
+
+        # Receive message, the multiplexer reconnects feeds that were closed
+        feed, message = feeds.receive()
         if message == None:
-            monitoring.increase_null_messages()
-            communicator.connect()
             continue
+        monitoring.increase_message_received()
+        inflight.put((feed, feed.socket, message, time.monotonic()))
+        window += 1
 
-        # Pass the message to data parser
-        parsed_message = dataparser.parse_message(message)
-        
-        if parsed_message == None:
-            monitoring.increase_invalid_messages()
-            communicator.acknowledge(accept=False)
+def process_frames(communicator: Communicator, feeds: MLLPMultiplexer, inflight: queue.Queue, done: queue.Queue,
+                   database: Database, dataparser: DataParser, preprocessor: Preprocessor, model, device, group_commit=GROUP_COMMIT_MESSAGES):
+    '''
+    Processing stage of the sync engine, on its own thread so a slow commit or inference does not
+    hold up reading. Messages are processed in the order they were received, and handed back to the
+    receiving thread to be acknowledged, since it owns the sockets.
+    The messages waiting when processing starts, up to group_commit, are committed together, see process_batch.
+    '''
+    while not stopping.is_set():
+        try:
+            batch = [inflight.get(timeout=SETTLE_INTERVAL_SECONDS)]
+        except queue.Empty:
+            settle_pages(communicator, database)
             continue
-        elif parsed_message.message_type == 'ORU^R01':
-            monitoring.increase_blood_test_messages()
-            monitoring.increase_sum_blood_test_results(parsed_message.obx_value)
-            monitoring.update_running_mean_blood_test_results()
-        else:
-            if parsed_message.message_type == 'ADT^A01':
-                monitoring.increase_admission_message()
-            else:
-                monitoring.increase_discharge_message()
-
-        mrn = parsed_message.mrn
-        timestamp = parsed_message.msg_timestamp
-
-        # Process message
-        preprocessed_message = preprocessor.preprocess(parsed_message)
-
-        # Perform inference
-        has_aki = False
-        if preprocessed_message is not None:
-            has_aki = inference(model, preprocessed_message.to(device))
-        
-        # Page (if necessary)
-        if has_aki:
-            database.is_positive(mrn, timestamp)
-            communicator.page_queue.append((mrn, timestamp))
-            while communicator.page_queue:
-                mrn, timestamp = communicator.page_queue.pop()
-                r = communicator.page(mrn, timestamp)
-                if r is not None and r.status == http.HTTPStatus.OK:
-                    database.paged(mrn)
-                    monitoring.increase_positive_predictions()
-                    # monitoring.update_positive_prediction_rate()
-                else:
-                    communicator.page_queue.appendleft((mrn, timestamp))
-                    break
-
-        # Acknowledge message
-        communicator.acknowledge(accept=True)
+        while len(batch) < group_commit:
+            try:
+                batch.append(inflight.get_nowait())
+            except queue.Empty:
+                break
+        started = time.monotonic()
+        for _, _, _, received in batch:
+            monitoring.observe_inflight_wait(started - received)
+
+        results = process_batch([message for _, _, message, _ in batch], database, dataparser, preprocessor, model, device)
+
+        for (feed, connection, message, _), (accept, positive) in zip(batch, results):
+            # Page (if necessary), the pager workers send it in the background
+            if positive is not None:
+                communicator.schedule_page(*positive)
+            done.put((feed, accept, message, connection))
+        feeds.wakeup()
+        settle_pages(communicator, database)
+
+async def main_async(communicator: Communicator, feeds: list, database: Database, dataparser: DataParser, preprocessor: Preprocessor, flags):
+    '''
+    Same pipeline as main, but receiving from each feed, processing and acknowledging run as
+    separate asyncio tasks. Parsing, database writes and inference run on a single executor thread,
+    so the database connection is never used by two threads at once, and the frames of all feeds
+    are processed in the order they arrived. The frames waiting when processing starts, up to
+    --group-commit, are committed together before any of them is acknowledged.
+    '''
+    main_logger('INFO', 'Server started (async engine)')
+    monitoring.increase_num_of_startup()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = load_model(flags.model).to(device)
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1)
+    # bounded, so a slow processing stage stops the reader instead of buffering without limit
+    frames = asyncio.Queue(maxsize=flags.inflight)
+
+    await loop.run_in_executor(executor, resume_pages, communicator, database, flags)
+
+    async def read_frames(feed):
+        await feed.connect()
+        while True:
+            message = await feed.receive()
+            monitoring.increase_message_received()
+            if message == None:
+                monitoring.increase_null_messages()
+                feed.close_socket()
+                await feed.connect()
+                continue
+            # ACKs go back on the connection the message arrived on
+            await frames.put((message, feed, feed.writer, time.monotonic()))
+            monitoring.set_inflight_messages(frames.qsize())
+
+    async def accept_frames(reader, writer):
+        feed = AsyncCommunicator.accepted(reader, writer, socket_options(flags), flags.echo_control_id)
+        main_logger('INFO', f"Accepted MLLP connection from {feed.host}:{feed.port}")
+        monitoring.increase_connection_attempts()
+        while True:
+            message = await feed.receive()
+            if message == None:
+                feed.close_socket()
+                return None
+            monitoring.increase_message_received()
+            await frames.put((message, feed, writer, time.monotonic()))
+            monitoring.set_inflight_messages(frames.qsize())
+
+    async def process_frames():
+        while True:
+            # the frames already received are committed together, see process_batch
+            batch = [await frames.get()]
+            while len(batch) < flags.group_commit and not frames.empty():
+                batch.append(frames.get_nowait())
+            monitoring.set_inflight_messages(frames.qsize())
+            started = time.monotonic()
+            for _, _, _, received in batch:
+                monitoring.observe_inflight_wait(started - received)
+            results = await loop.run_in_executor(
+                executor, process_batch, [message for message, _, _, _ in batch], database, dataparser, preprocessor, model, device)
+            for (message, feed, writer, _), (accept, positive) in zip(batch, results):
+                if positive is not None:
+                    communicator.schedule_page(*positive)
+                await feed.acknowledge(writer, accept=accept, message=message)
+
+    async def settle_positives():
+        # pages are sent by the pager threads, this only records their outcome
+        while True:
+            await asyncio.sleep(SETTLE_INTERVAL_SECONDS)
+            await loop.run_in_executor(executor, settle_pages, communicator, database)
+
+    server = None
+    if flags.listen:
+        host, port = flags.listen.rsplit(":", 1)
+        server = await asyncio.start_server(accept_frames, host or None, int(port), backlog=MLLP_LISTEN_BACKLOG)
+    tasks = asyncio.gather(*[read_frames(feed) for feed in feeds], process_frames(), settle_positives())
+    # stop the tasks from the event loop, so the database is not closed under the executor thread
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, tasks.cancel)
+    try:
+        await tasks
+    except asyncio.CancelledError:
+        pass
+    finally:
+        executor.shutdown(wait=True)
+        if server is not None:
+            server.close()
+        for feed in feeds:
+            feed.close_socket()
 
 def signal_handler(signum, frame):
     main_logger('INFO', 'SIGTERM received, gracefully shutting down')
     monitoring.increase_num_of_shutdown()
+    if processing is not None:
+        stopping.set()
+        processing.join()
+    settle_pages(communicator, database)
     database.close()
     communicator.close()
+    if isinstance(feeds, MLLPMultiplexer):
+        feeds.close()
     # Perform any necessary cleanup here
     # save last received message
     # add log and output metrics
@@ -129,9 +379,16 @@ if __name__ == "__main__":
         signal.signal(signal.SIGINT, signal_handler)
         flags = get_arguments()
         set_log_path(flags.logs)
-        communicator = Communicator(flags.mllp, flags.pager)
-        database = Database(flags.database, flags.history)
-        dataparser = DataParser()
+        communicator = Communicator(pager_address=flags.pager, pager_timeout=flags.page_timeout)
+        mllp_addresses = flags.mllp.split(",") if flags.mllp else []
+        if flags.engine == 'async':
+            feeds = [AsyncCommunicator(mllp_address, socket_options(flags), flags.echo_control_id) for mllp_address in mllp_addresses]
+        else:
+            feeds = MLLPMultiplexer(mllp_addresses, socket_options(flags), flags.echo_control_id)
+            if flags.listen:
+                feeds.listen(flags.listen)
+        database = Database(flags.database, flags.history, flags.patient_cache_size, flags.cache_flush_interval, flags.synchronous)
+        dataparser = DataParser(pool=MessagePool())
         preprocessor = Preprocessor(database)
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -140,7 +397,11 @@ if __name__ == "__main__":
             print(f"Recovering {len(missed_messages)} missed messages")
             main_logger('INFO', f"Recovering {len(missed_messages)} missed messages")
             recover_messages(missed_messages, dataparser, preprocessor, load_model(flags.model), database, device)
-        main(communicator, database, dataparser, preprocessor, flags)
+        if flags.engine == 'async':
+            asyncio.run(main_async(communicator, feeds, database, dataparser, preprocessor, flags))
+            signal_handler(signal.SIGTERM, None)
+        else:
+            main(communicator, feeds, database, dataparser, preprocessor, flags)
     finally:
         server.shutdown()
         t.join()
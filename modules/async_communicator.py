@@ -0,0 +1,114 @@
+import asyncio
+import socket
+import time
+
+import modules.metrics_monitoring as monitoring
+from modules.communicator import Communicator, MLLPFrameDecoder, ReconnectBackoff, apply_socket_options, MLLP_BUFFER_SIZE, SOCKET_OPTIONS
+from modules.module_logging import communicatior_logger
+
+class AsyncCommunicator():
+    '''asyncio based counterpart of the Communicator class.
+
+    Frames are read from an asyncio stream, so reading from any number of MLLP servers,
+    processing and acknowledging can run as independent tasks on one event loop.
+    Attributes:
+        - mllp_address (str): The address of the MLLP server.
+        - socket_options (dict): Overrides of SOCKET_OPTIONS, the read timeout bounds each read.
+        - echo_control_id (bool): Whether ACKs echo the control ID of the acknowledged message.
+    '''
+    def __init__(self, mllp_address=None, socket_options=None, echo_control_id=False):
+        '''Constructor for the AsyncCommunicator class. The connection is opened by connect().'''
+        self.socket_options = dict(SOCKET_OPTIONS, **(socket_options or {}))
+        self.decoder = MLLPFrameDecoder()
+        self.reader = None
+        self.writer = None
+        # ACK encoding is shared with the blocking communicator
+        self.communicator = Communicator(echo_control_id=echo_control_id)
+        if mllp_address is not None:
+            self.mllp_address = mllp_address.replace("https://", "").replace("http://", "")
+            self.host, self.port = self.mllp_address.split(":")
+
+    @classmethod
+    def accepted(cls, reader, writer, socket_options=None, echo_control_id=False):
+        '''Wraps a connection accepted from a sender by asyncio.start_server.'''
+        communicator = cls(socket_options=socket_options, echo_control_id=echo_control_id)
+        communicator.reader, communicator.writer = reader, writer
+        communicator.host, communicator.port = writer.get_extra_info('peername')[:2]
+        apply_socket_options(writer.get_extra_info('socket'), communicator.socket_options)
+        return communicator
+
+    # MLLP server
+    async def connect(self):
+        '''
+        Connects to the MLLP server. Retries forever with exponential backoff, see ReconnectBackoff.
+        '''
+        backoff = ReconnectBackoff()
+        start = time.monotonic()
+        while True:
+            try:
+                communicatior_logger('INFO', f"Attempting to connect to {self.host}:{self.port}...")
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                apply_socket_options(sock, self.socket_options)
+                sock.setblocking(False)
+                try:
+                    await asyncio.get_running_loop().sock_connect(sock, (self.host, int(self.port)))
+                except Exception:
+                    sock.close()
+                    raise
+                self.reader, self.writer = await asyncio.open_connection(sock=sock)
+                self.decoder.reset()
+                communicatior_logger('INFO', f"Connected to MLLP server at {self.host}:{self.port}.")
+                print(f"Connected to MLLP server at {self.host}:{self.port}.")
+                monitoring.increase_connection_attempts()
+                monitoring.observe_reconnect_seconds(time.monotonic() - start)
+                return None
+            except Exception as e:
+                retry_delay = backoff.next_delay()
+                communicatior_logger('ERROR', f"Error occurred while trying to connect to MLLP server: {e}")
+                print(f"Error occurred while trying to connect to MLLP server: {e}, retrying in {retry_delay:.3f} seconds...")
+                monitoring.increase_connection_failures()
+                await asyncio.sleep(retry_delay)
+
+    async def receive(self):
+        '''Receives the next frame from the MLLP server.
+
+        Returns:
+            - message (bytes): The message received, or None if the connection was closed.
+        '''
+        try:
+            message = self.decoder.next_frame()
+            while message is None:
+                data = await asyncio.wait_for(self.reader.read(MLLP_BUFFER_SIZE), self.socket_options["read_timeout"])
+                if len(data) == 0:
+                    return None
+                self.decoder.feed(data)
+                message = self.decoder.next_frame()
+            return message
+        except Exception as e:
+            communicatior_logger('ERROR', f"Error occurred while trying to receive message from MLLP server: {e}")
+            print(f"Error occurred while trying to receive message from MLLP server: {e}")
+            return None
+
+    async def acknowledge(self, writer, accept=True, message=None):
+        '''Sends an acknowledgment message on the connection the message was received from.
+
+        Args:
+            - writer (asyncio.StreamWriter): The connection the acknowledged message arrived on.
+            - accept (bool): Whether to send AA or AE.
+            - message (bytes): The acknowledged message, its control ID is echoed if enabled.
+        '''
+        if writer.is_closing():
+            communicatior_logger('ERROR', "Connection closed before the message could be acknowledged")
+            return None
+        # the encoder reuses its buffer, so the transport must not keep a view of it
+        writer.write(bytes(self.communicator.ack_message(accept, message)))
+        try:
+            await writer.drain()
+        except Exception as e:
+            communicatior_logger('ERROR', f"Error occurred while trying to acknowledge message: {e}")
+
+    def close_socket(self):
+        '''Closes the connection to the MLLP server.'''
+        if self.writer is not None:
+            communicatior_logger('INFO', f"Closing connection to MLLP server at {self.host}:{self.port}..")
+            self.writer.close()
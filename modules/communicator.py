@@ -1,32 +1,162 @@
+import errno
+import os
+import queue
+import random
 import socket
 import time
-import urllib.request
-from enum import Enum
-from collections import deque 
 
 import modules.metrics_monitoring as monitoring
+from modules.mllp import MLLPDelimiter, MLLPFrameDecoder, MLLP_BUFFER_SIZE
 from modules.module_logging import communicatior_logger
+from modules.pager import PagerAPI, PagerClient, PagerDispatcher, PageRetryScheduler, CircuitBreaker, CircuitOpenError, PAGER_WORKERS, PAGER_TIMEOUT_SECONDS, PAGE_DEADLINE_SECONDS
 
-class MLLPDelimiter(Enum):
-    START_OF_BLOCK = 0x0b
-    END_OF_BLOCK = 0x1c
-    CARRIAGE_RETURN = 0x0d
+# options applied to the MLLP socket, see apply_socket_options
+SOCKET_OPTIONS = {
+    # send small ACK frames immediately instead of waiting on Nagle's algorithm
+    "tcp_nodelay": True,
+    # detect a dead peer after keepalive_idle + keepalive_interval * keepalive_count seconds
+    "keepalive": True,
+    "keepalive_idle": 10,
+    "keepalive_interval": 5,
+    "keepalive_count": 3,
+    # kernel buffer sizes in bytes, None keeps the system default
+    "recv_buffer": None,
+    "send_buffer": None,
+    # seconds without any data after which the connection is considered hung and reopened, None waits forever
+    "read_timeout": None,
+}
 
-class PagerAPI(Enum):
-    PAGE = "/page"
-    SHUTDOWN = "/shutdown"
+def apply_socket_options(sock, options):
+    '''
+    Applies the socket options to a TCP socket, before it connects so the buffer sizes
+    are taken into account for the TCP window. Keepalive tuning is skipped on platforms
+    that do not support it.
+    Args:
+        - sock (socket.socket): The socket to configure.
+        - options (dict): The options, with the keys of SOCKET_OPTIONS.
+    '''
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(options["tcp_nodelay"]))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(options["keepalive"]))
+    if options["keepalive"]:
+        for name, key in (("TCP_KEEPIDLE", "keepalive_idle"), ("TCP_KEEPINTVL", "keepalive_interval"), ("TCP_KEEPCNT", "keepalive_count")):
+            if hasattr(socket, name) and options[key] is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), options[key])
+    if options["recv_buffer"] is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, options["recv_buffer"])
+    if options["send_buffer"] is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, options["send_buffer"])
+
+RECONNECT_INITIAL_SECONDS = 0.01
+RECONNECT_MAX_SECONDS = 10
+
+class ReconnectBackoff():
+    '''Exponential backoff with jitter for reconnecting to the MLLP server.
+
+    The n-th delay is drawn from [d/2, d] where d = initial * 2^n, capped at maximum, so
+    reconnecting clients do not retry in lockstep.
+    '''
+    def __init__(self, initial=RECONNECT_INITIAL_SECONDS, maximum=RECONNECT_MAX_SECONDS):
+        '''Constructor for the ReconnectBackoff class.'''
+        self.initial = initial
+        self.maximum = maximum
+        self.attempts = 0
+
+    def next_delay(self):
+        '''Returns the delay before the next attempt and moves to the next step.'''
+        delay = min(self.maximum, self.initial * (2 ** self.attempts))
+        # the exponent stops growing once the delay is capped, a long outage would overflow the float
+        if delay < self.maximum:
+            self.attempts += 1
+        return random.uniform(delay / 2, delay)
+
+ACK_TIMESTAMP_FORMAT = "%Y%m%d%H%M%S"
+ACK_MAX_CONTROL_ID = 199
+
+def control_id(message):
+    '''
+    Returns the message control ID (MSH-10) of an MLLP framed message without decoding it.
+    Args:
+        - message (bytes): The framed HL7 message.
+    Returns:
+        - control_id (bytes): The control ID, empty if the message has none.
+    '''
+    end = message.find(b"\r")
+    fields = message[:end if end != -1 else len(message)].split(b"|", 10)
+    return fields[9] if len(fields) > 9 else b""
+
+class AckEncoder():
+    '''Encodes MLLP framed ACK messages without allocating.
+
+    Both ACKs are kept pre-framed in one buffer each, and only the 14 timestamp bytes are
+    patched, at most once per second. The control ID of the acknowledged message, if any,
+    is echoed in MSA-2 by writing it behind the fixed prefix of the same buffer.
+    Attributes:
+        - frames (dict): The AA and AE frame buffers, keyed by accept.
+        - prefix (int): Length of the frames up to and including the MSA acknowledgment code.
+        - timestamp (int): Offset of the timestamp in the frames.
+        - second (int): The second the frames were last patched for.
+    '''
+    def __init__(self):
+        head = b"\x0bMSH|^~\\&|||||"
+        self.timestamp = len(head)
+        self.frames = {}
+        for accept, code in ((True, b"AA"), (False, b"AE")):
+            msh = head + b"0" * len(time.strftime(ACK_TIMESTAMP_FORMAT)) + b"||ACK|||2.5\rMSA|" + code
+            self.prefix = len(msh)
+            # room for the frame end and the longest echoed control ID
+            self.frames[accept] = bytearray(msh + b"|" + b" " * ACK_MAX_CONTROL_ID + b"\r\x1c\r")
+        self.views = {accept: memoryview(frame) for accept, frame in self.frames.items()}
+        self.second = None
+
+    def encode(self, accept=True, control_id=b""):
+        '''
+        Encodes the ACK for the current second.
+        Args:
+            - accept (bool): Whether to send AA or AE.
+            - control_id (bytes): The control ID to echo in MSA-2, empty to leave it out.
+        Returns:
+            - frame (memoryview): The framed ACK, valid until the next call.
+        '''
+        now = int(time.time())
+        if now != self.second:
+            stamp = time.strftime(ACK_TIMESTAMP_FORMAT, time.localtime(now)).encode("ascii")
+            for frame in self.frames.values():
+                frame[self.timestamp:self.timestamp + len(stamp)] = stamp
+            self.second = now
+        frame = self.frames[accept]
+        end = self.prefix
+        if control_id:
+            control_id = control_id[:ACK_MAX_CONTROL_ID]
+            frame[end] = 0x7c
+            frame[end + 1:end + 1 + len(control_id)] = control_id
+            end += 1 + len(control_id)
+        frame[end:end + 3] = b"\r\x1c\r"
+        return self.views[accept][:end + 3]
 
 class Communicator():
     '''Communicator class for sending and receiving messages from MLLP and Pager servers.
     Attributes:
         - mllp_address (str): The address of the MLLP server.
         - pager_address (str): The address of the Pager server.
+        - pager_timeout (float): The time budget in seconds of one page attempt.
+        - socket_options (dict): Overrides of SOCKET_OPTIONS for the MLLP socket.
+        - echo_control_id (bool): Whether ACKs echo the control ID of the acknowledged message.
     '''
-    def __init__(self, mllp_address=None, pager_address=None):
+    def __init__(self, mllp_address=None, pager_address=None, pager_timeout=PAGER_TIMEOUT_SECONDS, socket_options=None, echo_control_id=False):
         '''Constructor for the Communicator class.'''
-        self.page_queue = deque()
+        self.socket_options = dict(SOCKET_OPTIONS, **(socket_options or {}))
+        self.echo_control_id = echo_control_id
+        self.ack_encoder = AckEncoder()
+        self.page_queue = queue.Queue()
+        self.decoder = MLLPFrameDecoder()
+        self.socket = None
+        self.pager = None
+        self.dispatcher = None
+        self.scheduler = None
         if pager_address is not None:
             self.pager_address = pager_address.replace("https://", "").replace("http://", "")
+            self.pager = PagerClient(self.pager_address, timeout=pager_timeout)
+            self.breaker = CircuitBreaker()
 
         if mllp_address is not None:
             self.mllp_address = mllp_address.replace("https://", "").replace("http://", "")
@@ -36,80 +166,106 @@ class Communicator():
     # MLLP server
     def connect(self):
         '''
-        Connects to the MLLP server. Retries 10 times with an increasing delay if the connection fails.
+        Connects to the MLLP server, closing the previous connection first.
+        Retries forever, starting within milliseconds and backing off exponentially with jitter,
+        so a brief outage costs little backlog while a long one does not spin.
         '''
-        retry_delay = 5  # Initial delay of 5 seconds
-        delay_increment = 5  # Linear backoff
-        max_backoff = 120  # Maximum delay of 120 seconds
-
+        self.close_socket()
+        backoff = ReconnectBackoff()
+        start = time.monotonic()
         while True:
             try:
-                print(f"Attempting to connect to {self.host}:{self.port}...")
                 communicatior_logger('INFO', f"Attempting to connect to {self.host}:{self.port}...")
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.socket.connect((self.host, int(self.port)))
+                self.open()
                 communicatior_logger('INFO', f"Connected to MLLP server at {self.host}:{self.port}.")
                 print(f"Connected to MLLP server at {self.host}:{self.port}.")
                 monitoring.increase_connection_attempts()
+                monitoring.observe_reconnect_seconds(time.monotonic() - start)
                 return None
             except Exception as e:
+                retry_delay = backoff.next_delay()
                 communicatior_logger('ERROR', f"Error occurred while trying to connect to MLLP server: {e}")
-                print(f"Error occurred while trying to connect to MLLP server: {e}")
-                print(f"Retrying in {retry_delay} seconds...")
+                print(f"Error occurred while trying to connect to MLLP server: {e}, retrying in {retry_delay:.3f} seconds...")
                 monitoring.increase_connection_failures()
-                self.close()
+                self.close_socket()
                 time.sleep(retry_delay)
-                if retry_delay < max_backoff:
-                    retry_delay += delay_increment  # Linear backoff
-                else:
-                    print(f"Maximum retry delay of {max_backoff} seconds reached. Retrying in {max_backoff} seconds...")
-                    retry_delay = max_backoff
 
+    def open(self, blocking=True):
+        '''
+        Makes a single attempt to connect to the MLLP server, see connect for retrying.
+        Args:
+            - blocking (bool): If False, returns while the connection is still in progress, for use
+              with a selector that reports the socket writable once it is established.
+        '''
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.decoder.reset()
+        apply_socket_options(self.socket, self.socket_options)
+        if blocking:
+            self.socket.connect((self.host, int(self.port)))
+            self.socket.settimeout(self.socket_options["read_timeout"])
+        else:
+            self.socket.setblocking(False)
+            error = self.socket.connect_ex((self.host, int(self.port)))
+            if error not in (0, errno.EINPROGRESS):
+                raise OSError(error, os.strerror(error))
 
     def receive(self):
         '''Receives a message from the MLLP server.
 
         In the case where the message is sent partially, the function will wait and 
         continue to receive the message until the end of the message is reached.
+        If no data arrives within the read timeout the connection is reopened.
+        Frames that arrived together with the returned one stay in the decoder and are
+        returned by the following calls without touching the socket.
 
         Returns:
             - message (bytes): The message received from the MLLP server.
         '''
-        try:
-            message = b""
-            while MLLPDelimiter.END_OF_BLOCK.value not in message:
-                buffer = self.socket.recv(1024)
-                if len(buffer) == 0:
+        message = self.decoder.next_frame()
+        while message is None:
+            try:
+                if self.decoder.recv_from(self.socket) == 0:
                     return None
-                message += buffer
-            return message
-        except Exception as e:
-            communicatior_logger('ERROR', f"Error occurred while trying to receive message from MLLP server: {e}")
-            print(f"Error occurred while trying to receive message from MLLP server: {e}")
-            self.connect()
-            message = self.receive()
-            return message
+            except Exception as e:
+                communicatior_logger('ERROR', f"Error occurred while trying to receive message from MLLP server: {e}")
+                print(f"Error occurred while trying to receive message from MLLP server: {e}")
+                self.connect()
+            message = self.decoder.next_frame()
+        return message
     
-    def acknowledge(self, accept=True):
-        '''Sends an acknowledgment message to the MLLP server with the current time.'''
-        current_time = time.strftime("%Y%m%d%H%M%S")
-        if accept:
-            ACK = [
-                f"MSH|^~\&|||||{current_time}||ACK|||2.5",
-                "MSA|AA",
-            ]
-        else:
-            ACK = [
-                f"MSH|^~\&|||||{current_time}||ACK|||2.5",
-                "MSA|AE",
-            ]
+    def acknowledge(self, accept=True, message=None):
+        '''Sends an acknowledgment message to the MLLP server with the current time.
+
+        Args:
+            - accept (bool): Whether to send AA or AE.
+            - message (bytes): The acknowledged message, its control ID is echoed if enabled.
+        '''
+        self.socket.sendall(self.ack_message(accept, message))
+
+    def ack_message(self, accept=True, message=None):
+        '''Encodes the MLLP framed acknowledgment message with the current time, see AckEncoder.
+
+        Returns:
+            - frame (memoryview): The framed ACK, only valid until the next acknowledgment.
+        '''
+        if not accept:
             communicatior_logger('ERROR', f"Requesting for retransmission of message, AE message sent")
-        self.socket.sendall(self.to_mllp(ACK))
+        if self.echo_control_id and message is not None:
+            return self.ack_encoder.encode(accept, control_id(message))
+        return self.ack_encoder.encode(accept)
 
     def close(self):
+        '''Closes the connection to the MLLP server and the pooled Pager connections.'''
+        self.close_socket()
+        if self.pager is not None:
+            self.pager.close()
+
+    def close_socket(self):
         '''Closes the connection to the MLLP server.'''
-        communicatior_logger('INFO', f"Closing connection to MLLP server at {self.host}:{self.port}..")
-        self.socket.close()
+        if self.socket is not None:
+            communicatior_logger('INFO', f"Closing connection to MLLP server at {self.host}:{self.port}..")
+            self.socket.close()
+            self.socket = None
 
     # Packing and unpacking MLLP messages
     def to_mllp(self, segments):
@@ -121,31 +277,38 @@ class Communicator():
     
     # Pager server
     def page(self, mrn, timestamp=None):
-        '''Sends a page request to the Pager server.
+        '''Sends a page request to the Pager server on a pooled keep-alive connection.
+        The request goes through the circuit breaker, and fails fast while the Pager server is unhealthy.
 
         Args:
             - mrn (str): The medical record number of the patient to page.
             - timestamp (str): The timestamp of the message.
         '''
         try:
-            request = mrn
-            if timestamp is not None:
-                request = f"{mrn},{timestamp}"
-            request_bytes = bytes(request, "ascii")
-            r = urllib.request.urlopen(
-                f"http://{self.pager_address}{PagerAPI.PAGE.value}", 
-                data=request_bytes
-            )
-            return r
+            return self.breaker.call(self.pager.page, mrn, timestamp)
+        except CircuitOpenError:
+            return None
         except Exception as e:
             communicatior_logger('ERROR', f"Error occurred while trying to page {mrn}: {e}")
             print(f"Error occurred while trying to page {mrn}: {e}")
             monitoring.increase_page_failures()
             return None
 
+    def start_paging(self, workers=PAGER_WORKERS, deadline=PAGE_DEADLINE_SECONDS):
+        '''Starts the retry scheduler and the background workers that drain page_queue.'''
+        self.scheduler = PageRetryScheduler(self.page_queue, deadline=deadline)
+        self.dispatcher = PagerDispatcher(self.page, self.page_queue, workers, on_complete=self.scheduler.on_complete)
+
+    def schedule_page(self, mrn, timestamp, created=None, attempts=0, next_attempt=None):
+        '''Schedules a page with the retry scheduler, see PageRetryScheduler.schedule.'''
+        self.scheduler.schedule(mrn, timestamp, created, attempts, next_attempt)
+
+    def completed_pages(self):
+        '''Yields (event, mrn, timestamp, attempts, next_attempt) for every page outcome since the last call.'''
+        if self.scheduler is None:
+            return iter(())
+        return self.scheduler.events()
+
     def shutdown_server(self):
         '''Sends a shutdown request to the Pager server.'''
-        r = urllib.request.urlopen(
-            f"http://{self.pager_address}{PagerAPI.SHUTDOWN.value}"
-        )
-
+        self.pager.request("GET", PagerAPI.SHUTDOWN.value)
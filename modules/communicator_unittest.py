@@ -1,8 +1,9 @@
 import socket
+import threading
 import time
 import unittest
 
-from communicator import Communicator
+from communicator import AckEncoder, Communicator, MLLPFrameDecoder, ReconnectBackoff, SOCKET_OPTIONS, apply_socket_options, control_id
 
 class CommunicatorTest(unittest.TestCase):
     def setUp(self):
@@ -57,5 +58,108 @@ class CommunicatorTest(unittest.TestCase):
         mllp = self.communicator.to_mllp(self.ACK_segments)
         self.assertEqual(mllp, self.ACK_mllp)
 
+class MLLPFrameDecoderTest(unittest.TestCase):
+    def setUp(self):
+        self.frame_1 = b"\x0bMSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331035800||ADT^A03|||2.5\rPID|1||829339\r\x1c\r"
+        self.frame_2 = b"\x0bMSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331113300||ORU^R01|||2.5\rPID|1||257406\rOBR|1||||||20240331113300\rOBX|1|SN|CREATININE||92.95579346699137\r\x1c\r"
+        self.server, self.client = socket.socketpair()
+        self.decoder = MLLPFrameDecoder(buffer_size=64)
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+    def test_back_to_back_frames(self):
+        self.client.sendall(self.frame_1 + self.frame_2)
+        frames = []
+        while len(frames) < 2:
+            self.assertGreater(self.decoder.recv_from(self.server), 0)
+            frames.extend(self.decoder.frames())
+        self.assertEqual(frames, [self.frame_1, self.frame_2])
+        self.assertEqual(self.decoder.pending(), 0)
+
+    def test_partial_frame_kept_for_next_call(self):
+        self.decoder.feed(self.frame_1 + self.frame_2[:10])
+        self.assertEqual(list(self.decoder.frames()), [self.frame_1])
+        self.assertEqual(self.decoder.pending(), 10)
+        self.decoder.feed(self.frame_2[10:])
+        self.assertEqual(list(self.decoder.frames()), [self.frame_2])
+
+    def test_carriage_return_in_next_chunk(self):
+        self.decoder.feed(self.frame_1[:-1])
+        self.assertEqual(self.decoder.next_frame(), self.frame_1[:-1])
+        self.decoder.feed(self.frame_1[-1:] + self.frame_2)
+        self.assertEqual(self.decoder.next_frame(), self.frame_2)
+
+class ReconnectBackoffTest(unittest.TestCase):
+    def test_exponential_with_jitter(self):
+        backoff = ReconnectBackoff(initial=0.01, maximum=0.1)
+        delays = [backoff.next_delay() for _ in range(6)]
+        for i, delay in enumerate(delays):
+            expected = min(0.1, 0.01 * 2 ** i)
+            self.assertGreaterEqual(delay, expected / 2)
+            self.assertLessEqual(delay, expected)
+
+    def test_long_outage(self):
+        backoff = ReconnectBackoff(initial=0.01, maximum=0.1)
+        delays = [backoff.next_delay() for _ in range(1100)]
+        for delay in delays[4:]:
+            self.assertGreaterEqual(delay, 0.05)
+            self.assertLessEqual(delay, 0.1)
+
+class AckEncoderTest(unittest.TestCase):
+    def setUp(self):
+        self.encoder = AckEncoder()
+        self.message = b"\x0bMSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||202401201630||ADT^A01|MSG00042||2.5\rPID|1||478237423\r\x1c\r"
+
+    def test_matches_to_mllp(self):
+        current_time = time.strftime("%Y%m%d%H%M%S")
+        for accept, code in ((True, "AA"), (False, "AE")):
+            expected = Communicator().to_mllp([f"MSH|^~\\&|||||{current_time}||ACK|||2.5", f"MSA|{code}"])
+            self.assertEqual(bytes(self.encoder.encode(accept)), expected)
+
+    def test_echo_control_id(self):
+        self.assertEqual(control_id(self.message), b"MSG00042")
+        frame = bytes(self.encoder.encode(True, control_id(self.message)))
+        self.assertTrue(frame.endswith(b"\rMSA|AA|MSG00042\r\x1c\r"))
+        # a shorter ACK after a longer one leaves nothing behind
+        self.assertTrue(bytes(self.encoder.encode(True)).endswith(b"\rMSA|AA\r\x1c\r"))
+        self.assertEqual(control_id(b"\x0bMSH|^~\\&|||||202401201630||ADT^A01\r\x1c\r"), b"")
+
+class SocketOptionsTest(unittest.TestCase):
+    def test_apply_socket_options(self):
+        options = dict(SOCKET_OPTIONS, tcp_nodelay=True, keepalive_idle=7, recv_buffer=65536)
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            apply_socket_options(sock, options)
+            self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            self.assertTrue(sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE), 7)
+            # linux doubles the requested size for bookkeeping
+            self.assertGreaterEqual(sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), 65536)
+
+    def test_read_timeout_reconnects(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+            server.bind(("localhost", 0))
+            server.listen(2)
+            communicator = Communicator(f"localhost:{server.getsockname()[1]}", socket_options={"read_timeout": 0.1})
+            first, _ = server.accept()
+            # the first connection stays silent, the reopened one delivers a frame
+            server.settimeout(5)
+            start = time.monotonic()
+            second = None
+            def deliver():
+                nonlocal second
+                second, _ = server.accept()
+                second.sendall(b"\x0bMSH|^~\\&\r\x1c\r")
+            t = threading.Thread(target=deliver)
+            t.start()
+            self.assertEqual(communicator.receive(), b"\x0bMSH|^~\\&\r\x1c\r")
+            self.assertGreaterEqual(time.monotonic() - start, 0.1)
+            t.join()
+            communicator.close()
+            first.close()
+            second.close()
+
 if __name__ == "__main__":
     unittest.main()
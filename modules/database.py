@@ -1,12 +1,49 @@
-import csv
-from datetime import datetime
 import sqlite3
+import time
+import numpy as np
+import modules.history_loader as history_loader
 import modules.metrics_monitoring as monitoring
+import modules.series as series
+import modules.timestamps as timestamps
 from modules.module_logging import database_logger
+from modules.patient_cache import PatientCache, cache_key, PATIENT_CACHE_SIZE, PATIENT_CACHE_FLUSH_SECONDS
 import os
 
+# result_values and result_times are the packed series of the patient's last RECENT_RESULTS test results, see series,
+# every test result is in lab_results
+RECENT_RESULTS = 9
+PATIENT_COLUMNS = ("mrn", "dob", "gender", "name", "last_test", "result_values", "result_times", "to_page", "paged")
+SELECT_PATIENT = f"SELECT {', '.join(PATIENT_COLUMNS)} FROM patients_info WHERE mrn=?"
+# writes the test results of a patient, registering the patient first if needed
+UPSERT_TEST_RESULTS = '''INSERT INTO patients_info (mrn, dob, gender, name, last_test, result_values, result_times, to_page, paged)
+               VALUES (?, '', '', '', ?, ?, ?, '', 0)
+               ON CONFLICT(mrn) DO UPDATE SET last_test=excluded.last_test, result_values=excluded.result_values, result_times=excluded.result_times'''
+# ts is the time of the test in seconds since the epoch, results with the same ts are in the order they were stored
+CREATE_LAB_RESULTS = '''CREATE TABLE IF NOT EXISTS lab_results (
+               mrn INTEGER NOT NULL,
+               ts INTEGER NOT NULL,
+               value REAL NOT NULL)'''
+CREATE_LAB_RESULTS_INDEX = "CREATE INDEX IF NOT EXISTS lab_results_mrn_ts ON lab_results (mrn, ts)"
+INSERT_LAB_RESULT = "INSERT INTO lab_results (mrn, ts, value) VALUES (?, ?, ?)"
+# the last n results of a patient in order, with the days to the next one, 0 for the last, in one indexed query
+SELECT_LAST_RESULTS = f'''SELECT value, COALESCE((LEAD(ts) OVER (ORDER BY ts, rowid) - ts) / {float(timestamps.SECONDS_PER_DAY)}, 0)
+               FROM (SELECT rowid, ts, value FROM lab_results WHERE mrn = ? ORDER BY ts DESC, rowid DESC LIMIT ?)
+               ORDER BY ts, rowid'''
+SELECT_LAST_TIMES = "SELECT ts, value FROM lab_results WHERE mrn = ? ORDER BY ts DESC, rowid DESC LIMIT ?"
+# a patient already waiting to be paged keeps the page, its attempts and deadline, see PageRetryScheduler.schedule
+INSERT_PENDING_PAGE = '''INSERT INTO pending_pages (mrn, timestamp, created, attempts, next_attempt)
+               VALUES (?, ?, ?, 0, ?)
+               ON CONFLICT(mrn) DO NOTHING'''
+# in WAL mode a commit appends to the log, FULL syncs it on every commit, NORMAL only at checkpoints,
+# which survives the process dying but not the machine losing power
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+DATABASE_SYNCHRONOUS = "FULL"
+# messages whose writes are committed in one transaction, see Database.begin_group
+GROUP_COMMIT_MESSAGES = 16
+
 class Database:
-    def __init__(self, file_path=None, history_file_path=None):
+    def __init__(self, file_path=None, history_file_path=None, cache_size=PATIENT_CACHE_SIZE, flush_interval=PATIENT_CACHE_FLUSH_SECONDS,
+                 synchronous=DATABASE_SYNCHRONOUS):
         '''
         Main class for reading and storing the data, the data is stored in cache
         Attributes:
@@ -14,13 +51,31 @@ class Database:
                         Each patient's data is stored as a dictionary with the following
                         keys: test_results, gender, dob, name, last_test, paged
                         Where paged is a flag for avoiding paging the same patient multiple times
+            cache (PatientCache): The rows of the recently used patients, so a test result is
+                        stored without reading the patient from the database again
+            flush_interval (float): Seconds between writes of the cached test results, 0 writes every
+                        result through. Results written behind are lost if the process dies before the next flush
+            synchronous (str): The synchronous mode of the WAL journal, see SYNCHRONOUS_MODES
+            grouping (bool): Whether a group commit is open, the writes are committed by commit_group
         '''
+        self.cache = PatientCache(cache_size)
+        # (mrn, ts, value) of the lab results written behind, see flush
+        self.pending_results = []
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.grouping = False
         self.initializing = False
         if file_path is not None:
             if not os.path.exists(file_path) and history_file_path is not None:
                 self.initializing = True
-            self.conn = sqlite3.connect(file_path)
+            # the async engine runs every database call on one dedicated executor thread
+            self.conn = sqlite3.connect(file_path, check_same_thread=False)
             self.curs = self.conn.cursor()
+            if synchronous.upper() not in SYNCHRONOUS_MODES:
+                raise ValueError(f"Invalid synchronous mode {synchronous}, expected one of {', '.join(SYNCHRONOUS_MODES)}")
+            # readers do not block the writer, and a commit appends to the log instead of rewriting pages
+            self.curs.execute("PRAGMA journal_mode=WAL")
+            self.curs.execute(f"PRAGMA synchronous={synchronous.upper()}")
             database_logger('INFO', f"Connected to database at {file_path}.")
         else:
             database_logger('ERROR', f"Error occurred while trying to connect to database")
@@ -33,51 +88,159 @@ class Database:
                gender INTEGER,
                name TEXT,
                last_test TEXT,
-               test_results TEXT,
-               test_dates TEXT,
+               result_values BLOB,
+               result_times BLOB,
                to_page TEXT,
                paged INTEGER)''')
+        self.migrate_series()
+        self.create_lab_results()
+        self.create_pending_pages()
         self.conn.commit()
 
         if self.initializing:
             self.load_csv(history_file_path, file_path)
         
 
-    def load_csv(self, file_path, db_path):
+    def create_pending_pages(self):
+        '''
+        Create the table of positives waiting to be paged, used by the pager retry scheduler
+        created is the time the positive was detected, next_attempt the time of the next page attempt,
+        both in seconds since the epoch
+        The first time the table is created it is filled from patients_info.to_page, afterwards
+        restarts only read this table instead of scanning every patient
+        '''
+        exists = self.table_exists('pending_pages')
+        self.curs.execute('''CREATE TABLE IF NOT EXISTS pending_pages (
+               mrn INTEGER PRIMARY KEY,
+               timestamp TEXT,
+               created REAL,
+               attempts INTEGER,
+               next_attempt REAL)''')
+        if not exists:
+            now = time.time()
+            self.curs.execute("INSERT INTO pending_pages (mrn, timestamp, created, attempts, next_attempt) SELECT mrn, to_page, ?, 0, ? FROM patients_info WHERE to_page != ''", (now, now))
+
+    def migrate_series(self):
+        '''
+        Migrate a database storing the test results as comma separated test_results and test_dates
+        to the packed result_values and result_times series, in one transaction
+        test_dates are the days from each test to the next, the times are computed back from last_test
+        The results are also stored in lab_results from the text, before the series round them to float32
+        '''
+        self.curs.execute("PRAGMA table_info(patients_info)")
+        columns = [column[1] for column in self.curs.fetchall()]
+        if "result_values" in columns:
+            return
+        database_logger('INFO', "Migrating test results to packed series")
+        fill_lab_results = not self.table_exists('lab_results')
+        self.curs.execute(CREATE_LAB_RESULTS)
+        self.curs.execute(CREATE_LAB_RESULTS_INDEX)
+        self.curs.execute("ALTER TABLE patients_info ADD COLUMN result_values BLOB")
+        self.curs.execute("ALTER TABLE patients_info ADD COLUMN result_times BLOB")
+        self.curs.execute("SELECT mrn, last_test, test_results, test_dates FROM patients_info")
+        updates, results = [], []
+        for mrn, last_test, test_results, test_dates in self.curs.fetchall():
+            values, times = [], []
+            if last_test and test_results not in (None, ''):
+                values = [float(x) for x in str(test_results).split(',')]
+                times = series.times_from_gaps(str(test_dates).split(','), timestamps.parse_iso(last_test))
+            if fill_lab_results:
+                results.extend((mrn, ts, value) for ts, value in zip(times, values))
+                values, times = values[-RECENT_RESULTS:], times[-RECENT_RESULTS:]
+            updates.append((series.pack_values(values), series.pack_times(times), mrn))
+        self.curs.executemany(INSERT_LAB_RESULT, results)
+        self.curs.executemany("UPDATE patients_info SET result_values=?, result_times=? WHERE mrn=?", updates)
+        self.curs.execute("ALTER TABLE patients_info DROP COLUMN test_results")
+        self.curs.execute("ALTER TABLE patients_info DROP COLUMN test_dates")
+        self.conn.commit()
+
+    def table_exists(self, name):
+        '''Returns whether the database has the table'''
+        self.curs.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name=?", (name,))
+        return self.curs.fetchone()[0] == 1
+
+    def create_lab_results(self):
+        '''
+        Create the table of every lab result, one row per result, indexed by (mrn, ts)
+        The first time the table is created it is filled from the series of patients_info, which are
+        then cut to the last RECENT_RESULTS results. The series hold float32 values, a database
+        still storing the results as text is filled from the text instead, see migrate_series
+        '''
+        exists = self.table_exists('lab_results')
+        self.curs.execute(CREATE_LAB_RESULTS)
+        self.curs.execute(CREATE_LAB_RESULTS_INDEX)
+        if exists:
+            return
+        self.curs.execute("SELECT mrn, result_values, result_times FROM patients_info")
+        rows = self.curs.fetchall()
+        results, windows = [], []
+        for mrn, result_values, result_times in rows:
+            if not result_values:
+                continue
+            values, times = series.unpack_values(result_values), series.unpack_times(result_times)
+            results.extend((mrn, ts, value) for ts, value in zip(times, values))
+            windows.append((series.pack_values(values[-RECENT_RESULTS:]), series.pack_times(times[-RECENT_RESULTS:]), mrn))
+        if results:
+            database_logger('INFO', f"Moving {len(results)} test results to lab_results")
+        self.curs.executemany(INSERT_LAB_RESULT, results)
+        self.curs.executemany("UPDATE patients_info SET result_values=?, result_times=? WHERE mrn=?", windows)
+
+    def load_csv(self, file_path, db_path, processes=None):
         '''
-        Load data from a csv file and store it in the data attribute
+        Load the history csv file into the database, in one transaction on a connection of its own
+        The csv is parsed in ranges across a process pool, see history_loader, and the rows are inserted
+        with executemany, the index of lab_results is built once they are all inserted
+        Loading stops at the first invalid row, the rows before it are kept
         Args:
             file_path (str): The path to the csv file
+            db_path (str): The path to the database
+            processes (int): The number of processes parsing the csv, os.cpu_count() if None
         '''
+        started = time.perf_counter()
         conn = sqlite3.connect(db_path)
-        curs = conn.cursor()
-        curs.execute('''CREATE TABLE IF NOT EXISTS patients_info (
+        for pragma in history_loader.LOADER_PRAGMAS:
+            conn.execute(pragma)
+        conn.execute('BEGIN')
+        conn.execute('''CREATE TABLE IF NOT EXISTS patients_info (
                 mrn INTEGER PRIMARY KEY,
                 dob TEXT,
                 gender INTEGER,
                 name TEXT,
                 last_test TEXT,
-                test_results REAL,
-                test_dates REAL,
+                result_values BLOB,
+                result_times BLOB,
                 to_page INTEGER,
                 paged INTEGER)''')
-        conn.commit()
-        with open(file_path, newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            for i, row in enumerate(reader):
-                if i == 0:
-                    continue
-                mrn = row[0]
-                processed_dates = self.process_dates(row[1:])
-                if processed_dates is None:
-                    return None
-                test_results, test_dates, last_test = processed_dates
-                test_results = ','.join(test_results)
-                test_dates = [str(x) for x in test_dates]
-                test_dates = ','.join(test_dates)
-                data_template = (mrn, '', '', '', last_test, test_results, test_dates, "", 0)
-                curs.execute("INSERT INTO patients_info (mrn, dob, gender, name, last_test, test_results, test_dates, to_page, paged) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", data_template)      
-                conn.commit()   
+        conn.execute(CREATE_LAB_RESULTS)
+        conn.execute("DROP INDEX IF EXISTS lab_results_mrn_ts")
+        patients = results = 0
+        try:
+            for chunk in history_loader.parse_history(file_path, processes):
+                ends = np.cumsum(chunk.counts)
+                conn.executemany(INSERT_LAB_RESULT, zip(np.repeat(chunk.mrns, chunk.counts).tolist(), chunk.times.tolist(), chunk.values.tolist()))
+                # the series are packed straight from the arrays, see series
+                values, times = chunk.values.astype(series.VALUE.format), chunk.times.astype(series.TIME.format)
+                conn.executemany("INSERT INTO patients_info (mrn, dob, gender, name, last_test, result_values, result_times, to_page, paged) VALUES (?, '', '', '', ?, ?, ?, '', 0)",
+                                 ((mrn, last_test, values[max(end - RECENT_RESULTS, end - count):end].tobytes(), times[max(end - RECENT_RESULTS, end - count):end].tobytes())
+                                  for mrn, last_test, count, end in zip(chunk.mrns, chunk.last_tests, chunk.counts.tolist(), ends.tolist())))
+                patients += len(chunk.mrns)
+                results += len(chunk.values)
+                if chunk.error is not None:
+                    kind, message = chunk.error
+                    database_logger('ERROR', message)
+                    if kind == "order":
+                        monitoring.increase_DATABASE_ERROR_dates_not_in_order()
+                    else:
+                        monitoring.increase_DATABASE_ERROR_invalid_test_results_length()
+                    break
+            conn.execute(CREATE_LAB_RESULTS_INDEX)
+            conn.commit()
+        finally:
+            conn.close()
+        elapsed = time.perf_counter() - started
+        rows_per_second = results / elapsed if elapsed > 0 else 0
+        monitoring.set_DATABASE_history_load(elapsed, rows_per_second)
+        database_logger('INFO', f"Loaded {patients} patients and {results} test results from {file_path} in {elapsed:.2f}s, {rows_per_second:.0f} rows/s")
 
     def process_dates(self, test_results):
         '''
@@ -96,7 +259,7 @@ class Database:
             monitoring.increase_DATABASE_ERROR_invalid_test_results_length()
             return None
         curr_date = test_results[0]
-        curr_date = datetime.strptime(curr_date, '%Y-%m-%d %H:%M:%S')
+        curr_date = timestamps.parse_iso(curr_date)
         # remove all emtpy strings
         test_results = [x for x in test_results if x != '']
         wrong_date_format = False
@@ -105,13 +268,13 @@ class Database:
                 test_results[i+2] = 0
                 break
             next_date = test_results[i+2]
-            next_date = datetime.strptime(next_date, '%Y-%m-%d %H:%M:%S')
+            next_date = timestamps.parse_iso(next_date)
             if next_date < curr_date:
-                database_logger('ERROR', f"Dates are not in order: {next_date} is less than {curr_date}")
+                database_logger('ERROR', f"Dates are not in order: {timestamps.format_iso(next_date)} is less than {timestamps.format_iso(curr_date)}")
                 monitoring.increase_DATABASE_ERROR_dates_not_in_order()
                 return None
-            # compute time difference, in seconds
-            diff = (next_date - curr_date).total_seconds() / (60*60*24)
+            # compute time difference, in days
+            diff = (next_date - curr_date) / timestamps.SECONDS_PER_DAY
             test_results[i] = diff
             curr_date = next_date
         last_test = test_results[-2]
@@ -120,88 +283,249 @@ class Database:
         test_results = test_results[1::2]
         return test_results, test_dates, last_test
 
-    def get(self, mrn):
+    def get(self, mrn, test_results=True):
         '''
         Get the patient's data from the database
         Args:
             mrn (str): The medical record number of the patient
+            test_results (bool): Whether to include the whole history from lab_results as the comma
+                        separated test_results and test_dates, see recent_results for the last results only
         Returns:
             dict: The patient's data    
         '''
-        self.curs.execute("SELECT * FROM patients_info WHERE mrn=?", (mrn,))
+        row = self.patient(mrn)
+        if row is None:
+            return None
+        patient = {column: row[column] for column in PATIENT_COLUMNS if column not in ("result_values", "result_times")}
+        if test_results:
+            values, test_dates = self.last_results(mrn, -1)
+            patient["test_results"] = ','.join(str(x) for x in values)
+            patient["test_dates"] = ','.join(str(x) for x in test_dates)
+        return patient
+
+    def recent_results(self, mrn, k):
+        '''
+        Get the last test results of the patient, from the cached row if there are no more than RECENT_RESULTS
+        Args:
+            mrn (str): The medical record number of the patient
+            k (int): The number of test results, fewer if the patient has fewer
+        Returns:
+            list: The values of the test results, in order
+            list: The days from each test to the next, 0 for the last test
+        '''
+        if k > RECENT_RESULTS:
+            return self.last_results(mrn, k)
+        row = self.patient(mrn)
+        if row is None:
+            return [], []
+        return list(series.last_values(row["result_values"], k)), series.gaps(series.last_times(row["result_times"], k))
+
+    def last_results(self, mrn, n):
+        '''
+        Get the last test results of the patient from lab_results, in one indexed query however long the history is
+        Args:
+            mrn (str): The medical record number of the patient
+            n (int): The number of test results, fewer if the patient has fewer, -1 for all of them
+        Returns:
+            list: The values of the test results, in order
+            list: The days from each test to the next, 0 for the last test
+        '''
+        key = cache_key(mrn)
+        pending = [(ts, value) for pending_key, ts, value in self.pending_results if pending_key == key]
+        if pending:
+            # results written behind are not in lab_results yet, they are the last ones
+            self.curs.execute(SELECT_LAST_TIMES, (mrn, n))
+            rows = self.curs.fetchall()[::-1] + pending
+            if n >= 0:
+                rows = rows[max(len(rows) - n, 0):]
+            return [value for _, value in rows], series.gaps([ts for ts, _ in rows])
+        self.curs.execute(SELECT_LAST_RESULTS, (mrn, n))
+        rows = self.curs.fetchall()
+        return [value for value, _ in rows], [gap for _, gap in rows]
+
+    def patient(self, mrn):
+        '''
+        Get the cached row of the patient, reading it from the database and caching it on a miss
+        Args:
+            mrn (str): The medical record number of the patient
+        Returns:
+            dict: The patient's row, None if the patient does not exist
+        '''
+        key = cache_key(mrn)
+        if key is not None:
+            row = self.cache.get(key)
+            if row is not None:
+                return row
+        self.curs.execute(SELECT_PATIENT, (mrn,))
         result = self.curs.fetchone()
         # this should never be triggered, used for debugging, delete after testing
         if result is None:
             return None
-        else:
-            return {
-                "mrn": result[0],
-                "dob": result[1],
-                "gender": result[2],
-                "name": result[3],
-                "last_test": result[4],
-                "test_results": result[5],
-                "test_dates": result[6],
-                "to_page": result[7],
-                "paged": result[8]
-            }
-        
-
+        row = dict(zip(PATIENT_COLUMNS, result))
+        if key is not None:
+            self.write_rows(self.cache.put(key, row))
+        return row
 
-    def set(self, mrn, date, value):
+    def set(self, mrn, date, value, commit=True):
         '''
         Add a new test result to the patient's data
         We do not accept new test results for patients who are not registered or have no historial test results
         We also do not accept test results that are not in order
+        The result is written through, or written behind by flush if there is a flush interval
         Args:
             mrn (str): The medical record number of the patient
             date (str): The date of the test
             value (float): The value of the test
+            commit (bool): Whether to commit, False leaves the transaction open for more results
         '''        
-        self.curs.execute("SELECT COUNT(*) FROM patients_info WHERE mrn=?", (mrn,))
-        result = self.curs.fetchone()
-        if result[0] == 1:
-            self.curs.execute("SELECT test_results, test_dates, last_test FROM patients_info WHERE mrn=?", (mrn,))
-            existing_data = self.curs.fetchone()
-            test_results, test_dates, last_test = existing_data
+        row = self.patient(mrn)
+        if row is not None:
+            last_test = row["last_test"]
             if last_test != '':
                 
-                last_date = datetime.strptime(last_test, '%Y-%m-%d %H:%M:%S')
-                strp_new_date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
+                last_date = timestamps.parse_iso(last_test)
+                strp_new_date = timestamps.parse_iso(date)
                 # error handling: when the new test date is in incorrect order, change the test date to the current date
                 # TODO: in data parser, we could set the date to a very old date to trigger the if statement
                 # or we can let the data parser to convert the date to the current date
                 if strp_new_date < last_date:
-                    strp_new_date = datetime.now()
-                    date = strp_new_date.strftime('%Y-%m-%d %H:%M:%S')
-                test_results = test_results + ',' + str(value) if test_results else str(value)
-                test_dates = test_dates.split(',')
-                test_dates[-1] = (strp_new_date - last_date).total_seconds() / (60*60*24)
-                test_dates.append(0)
-                test_dates = ','.join([str(x) for x in test_dates])
-                self.curs.execute("UPDATE patients_info SET test_results=?, test_dates=?, last_test=? WHERE mrn=?", (test_results, test_dates, date, mrn))
+                    strp_new_date = timestamps.now()
+                    date = timestamps.format_iso(strp_new_date)
+                # appending packs only the new result, the window is never unpacked
+                result_values = series.append_value(row["result_values"], float(value), RECENT_RESULTS)
+                result_times = series.append_time(row["result_times"], strp_new_date, RECENT_RESULTS)
             else:
-                test_results = str(value)
-                test_dates = str(0)
-                self.curs.execute("UPDATE patients_info SET test_results=?, test_dates=?, last_test=? WHERE mrn=?", (test_results, test_dates, date, mrn))
-            self.conn.commit()
-        elif result[0] == 0:
+                strp_new_date = timestamps.parse_iso(date)
+                result_values = series.pack_values([float(value)])
+                result_times = series.pack_times([strp_new_date])
+            row.update(result_values=result_values, result_times=result_times, last_test=date)
+        else:
             # register the patient first
-            data_template = (mrn, "", "", "", str(date), str(value), str(0), "", 0)
-            self.curs.execute("INSERT INTO patients_info (mrn, dob, gender, name, last_test, test_results, test_dates, to_page, paged) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", data_template)
+            strp_new_date = timestamps.parse_iso(date)
+            row = dict(zip(PATIENT_COLUMNS, (cache_key(mrn), "", "", "", str(date), series.pack_values([float(value)]),
+                                             series.pack_times([strp_new_date]), "", 0)))
+        key = cache_key(mrn)
+        if self.flush_interval > 0 and key is not None:
+            self.pending_results.append((key, strp_new_date, float(value)))
+            self.write_rows(self.cache.put(key, row, dirty=True))
+            self.flush_due()
+            return
+        self.curs.execute(UPSERT_TEST_RESULTS, (mrn, row["last_test"], row["result_values"], row["result_times"]))
+        self.curs.execute(INSERT_LAB_RESULT, (mrn, strp_new_date, float(value)))
+        if key is not None:
+            self.write_rows(self.cache.put(key, row))
+        if commit:
+            self.commit()
+
+    def write_rows(self, rows, results=()):
+        '''
+        Write the test results of cached rows to the database and commit, see PatientCache
+        Args:
+            rows (list): (key, row) of every row to write
+            results (list): (mrn, ts, value) of lab results to write with them
+        '''
+        if not rows and not results:
+            return
+        self.curs.executemany(UPSERT_TEST_RESULTS, [(key, row["last_test"], row["result_values"], row["result_times"]) for key, row in rows])
+        self.curs.executemany(INSERT_LAB_RESULT, results)
+        self.commit()
+        monitoring.increase_patient_cache_flushed_rows(len(rows))
+
+    def commit(self):
+        '''
+        Commit the open transaction, unless a group commit is open, see begin_group
+        '''
+        if not self.grouping and self.conn.in_transaction:
             self.conn.commit()
-        else:
-            database_logger('ERROR', f"Multiple patients with the same MRN: {mrn}")
-            monitoring.increase_DATABASE_ERROR_multiple_patients_same_mrn()
-        
+
+    def begin_group(self):
+        '''
+        Open a group commit, the writes of the next messages are committed in one transaction by commit_group
+        instead of one transaction each, so a batch of messages pays for one sync of the log
+        '''
+        self.grouping = True
+
+    def commit_group(self, messages):
+        '''
+        Close the group commit and commit its writes, the messages must only be acknowledged after this returns
+        Args:
+            messages (int): The number of messages in the group
+        '''
+        self.grouping = False
+        self.commit()
+        monitoring.observe_DATABASE_group_commit(messages)
+
+    def flush(self):
+        '''
+        Write the test results written behind in the cache to the database, in one transaction
+        '''
+        self.last_flush = time.monotonic()
+        results, self.pending_results = self.pending_results, []
+        self.write_rows(self.cache.take_dirty(), results)
+
+    def rollback_group(self):
+        '''
+        Close the group commit and roll back its writes, when processing one of its messages failed,
+        so none of them is stored twice when they are delivered again
+        The cached rows may hold writes that were rolled back, the cache is emptied, and the results
+        written behind but not written yet are lost, as if the process had died
+        '''
+        self.grouping = False
+        self.conn.rollback()
+        self.cache = PatientCache(self.cache.size)
+        self.pending_results = []
+
+    def flush_due(self):
+        '''
+        Write the test results behind if the flush interval has passed, called between messages
+        so the results of a quiet feed are not kept in memory longer than the interval
+        '''
+        if self.flush_interval > 0 and time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def set_many(self, mrn, results):
+        '''
+        Add the test results of a lab panel to the patient's data in one transaction, see set
+        Args:
+            mrn (str): The medical record number of the patient
+            results (list): The (date, value) of every test result, in order
+        '''
+        for date, value in results:
+            self.set(mrn, date, value, commit=False)
+        self.commit()
+
     def settle_positives(self):
         '''
-        Settle all the patients who have been paged
+        Settle all the patients who have been detected positive but not paged yet
+        Called between messages, it also writes the test results behind when the flush interval has passed
+        Returns:
+            list: (mrn, timestamp) of every pending page
         '''
-        self.curs.execute("SELECT mrn, to_page FROM patients_info WHERE to_page != ''")
+        self.flush_due()
+        self.curs.execute("SELECT mrn, timestamp FROM pending_pages ORDER BY next_attempt")
         result = self.curs.fetchall()
         return result
 
+    def pending_pages(self):
+        '''
+        Get the persisted state of every pending page, so the retry scheduler can resume after a restart
+        Returns:
+            list: (mrn, timestamp, created, attempts, next_attempt) of every pending page
+        '''
+        self.curs.execute("SELECT mrn, timestamp, created, attempts, next_attempt FROM pending_pages ORDER BY next_attempt")
+        return self.curs.fetchall()
+
+    def reschedule_page(self, mrn, attempts, next_attempt):
+        '''
+        Persist the retry state of a pending page after a failed attempt
+        Args:
+            mrn (str): The medical record number of the patient
+            attempts (int): The number of failed attempts so far
+            next_attempt (float): The time of the next attempt, in seconds since the epoch
+        '''
+        self.curs.execute("UPDATE pending_pages SET attempts = ?, next_attempt = ? WHERE mrn = ?", (attempts, next_attempt, mrn))
+        self.commit()
+
     def register(self, mrn, gender, dob, name):
         '''
         Register a new patient in the database
@@ -217,14 +541,17 @@ class Database:
         result = self.curs.fetchone()
         if result[0] == 1:
             self.curs.execute("UPDATE patients_info SET gender = ?, dob = ?, name = ? WHERE mrn = ?", (gender, dob, name, mrn))
+            self.cache.update(cache_key(mrn), gender=gender, dob=dob, name=name)
         elif result[0] == 0:
-            data_template = (mrn, dob, gender, name, '', '', '', "", 0)
-            self.curs.execute("INSERT INTO patients_info (mrn, dob, gender, name, last_test, test_results, test_dates, to_page, paged) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", data_template)
+            data_template = (mrn, dob, gender, name, '', b'', b'', "", 0)
+            self.curs.execute("INSERT INTO patients_info (mrn, dob, gender, name, last_test, result_values, result_times, to_page, paged) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", data_template)
+            # the test results of a patient written behind but not registered yet are kept, see UPSERT_TEST_RESULTS
+            self.cache.update(cache_key(mrn), gender=gender, dob=dob, name=name)
         else:
             database_logger('ERROR', f"Multiple patients with the same MRN: {mrn}")
             monitoring.increase_DATABASE_ERROR_multiple_patients_same_mrn()
             return None
-        self.conn.commit()
+        self.commit()
         
     def is_positive(self, mrn, timestamp):
         '''
@@ -234,11 +561,16 @@ class Database:
         Returns:
             bool: True if the patient has been paged, False otherwise
         '''
+        # a patient so far only written behind is not in patients_info yet
+        self.write_rows(self.cache.take(cache_key(mrn)))
         self.curs.execute("SELECT COUNT(*) FROM patients_info WHERE mrn=?", (mrn,))
         result = self.curs.fetchone()
         if result[0] == 1:
             self.curs.execute("UPDATE patients_info SET to_page = ? WHERE mrn = ?", (timestamp, mrn))
-            self.conn.commit()
+            self.cache.update(cache_key(mrn), to_page=timestamp)
+            now = time.time()
+            self.curs.execute(INSERT_PENDING_PAGE, (mrn, timestamp, now, now))
+            self.commit()
         elif result[0] == 0:
             database_logger('ERROR', f"Patient with MRN {mrn} does not exist")
             monitoring.increase_DATABASE_ERROR_missing_mrn()
@@ -254,13 +586,15 @@ class Database:
         Args:
             mrn (str): The medical record number of the patient
         '''
+        # a patient so far only written behind is not in patients_info yet
+        self.write_rows(self.cache.take(cache_key(mrn)))
         self.curs.execute("SELECT COUNT(*) FROM patients_info WHERE mrn=?", (mrn,))
         result = self.curs.fetchone()
         if result[0] == 1:
-            self.curs.execute("UPDATE patients_info SET paged = ? WHERE mrn = ?", (1, mrn))
-            self.conn.commit()
-            self.curs.execute("UPDATE patients_info SET to_page = '' WHERE mrn = ?", (mrn,))
-            self.conn.commit()
+            self.curs.execute("UPDATE patients_info SET paged = 1, to_page = '' WHERE mrn = ?", (mrn,))
+            self.curs.execute("DELETE FROM pending_pages WHERE mrn = ?", (mrn,))
+            self.commit()
+            self.cache.update(cache_key(mrn), paged=1, to_page='')
         elif result[0] == 0:
             database_logger('ERROR', f"Patient with MRN {mrn} does not exist")
             monitoring.increase_DATABASE_ERROR_page_nonexistent_patient()
@@ -275,4 +609,6 @@ class Database:
         Close the database connection
         '''
         database_logger('INFO', f"Closing connection to database")
+        self.grouping = False
+        self.flush()
         self.conn.close()
\ No newline at end of file
@@ -1,7 +1,9 @@
 import unittest
 from database import Database
+import series
 from datetime import datetime
 import os
+import sqlite3
 from metrics_monitoring import database_metrics
 
 class TestDatabase(unittest.TestCase):
@@ -83,6 +85,134 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(test_dates[:2], [1.0, 1.0])
         self.assertLessEqual(patient['last_test'], now)
 
+    def test_set_many(self):
+        self.db.set_many('2', [('2020-01-04 00:00:00', 4), ('2020-01-05 00:00:00', 5)])
+        patient = self.db.get('2')
+        self.assertEqual([float(x) for x in patient['test_results'].split(',')], [1.0, 2.0, 3.0, 4.0, 5.0])
+        self.assertEqual([float(x) for x in patient['test_dates'].split(',')], [1.0, 1.0, 1.0, 1.0, 0.0])
+        self.assertEqual(patient['last_test'], '2020-01-05 00:00:00')
+        self.assertFalse(self.db.conn.in_transaction)
+
+    def test_write_behind(self):
+        self.db.close()
+        db = Database('./data/history_test.db', flush_interval=3600)
+        db.set('2', '2020-01-04 00:00:00', 4)
+        db.set('124', '2020-01-01 00:00:00', 1)
+        # the cached rows have the results, the database does not yet
+        self.assertEqual(db.get('2')['test_results'], '1.0,2.0,3.0,4.0')
+        db.curs.execute("SELECT result_values FROM patients_info WHERE mrn=2")
+        self.assertEqual(series.unpack_values(db.curs.fetchone()[0]), (1.0, 2.0, 3.0))
+        # registering a patient written behind keeps the results
+        db.register('124', 1, '1990-01-01', 'Jane Doe')
+        db.flush()
+        db.cache = type(db.cache)()
+        self.assertEqual(db.get('2')['test_results'], '1.0,2.0,3.0,4.0')
+        patient = db.get('124')
+        self.assertEqual((patient['test_results'], patient['name'], patient['gender']), ('1.0', 'Jane Doe', 1))
+        db.set('2', '2020-01-05 00:00:00', 5)
+        db.close()
+        self.db = Database('./data/history_test.db')
+        self.assertEqual(self.db.get('2')['test_results'], '1.0,2.0,3.0,4.0,5.0')
+
+    def test_positive_written_behind(self):
+        self.db.close()
+        self.db = Database('./data/history_test.db', flush_interval=3600)
+        # the patient is only in the cache until it is detected positive
+        self.db.set('126', '2020-01-01 00:00:00', 1)
+        self.db.is_positive('126', '20200101000000')
+        self.assertEqual(self.db.settle_positives(), [(126, '20200101000000')])
+        self.db.paged('126')
+        self.assertEqual(self.db.settle_positives(), [])
+        self.db.curs.execute("SELECT paged, to_page FROM patients_info WHERE mrn=126")
+        self.assertEqual(self.db.curs.fetchone(), (1, ''))
+
+    def test_flush_due(self):
+        self.db.close()
+        db = Database('./data/history_test.db', flush_interval=3600)
+        db.set('2', '2020-01-04 00:00:00', 4)
+        reader = sqlite3.connect('./data/history_test.db')
+        db.flush_due()
+        self.assertEqual(reader.execute("SELECT COUNT(*) FROM lab_results WHERE mrn=2").fetchone()[0], 3)
+        # the feed stays quiet for the interval, the next check between messages writes the results
+        db.last_flush -= 3600
+        db.flush_due()
+        self.assertEqual(reader.execute("SELECT COUNT(*) FROM lab_results WHERE mrn=2").fetchone()[0], 4)
+        values = reader.execute("SELECT result_values FROM patients_info WHERE mrn=2").fetchone()[0]
+        self.assertEqual(series.unpack_values(values), (1.0, 2.0, 3.0, 4.0))
+        reader.close()
+        self.db = db
+
+    def test_group_commit(self):
+        self.db.curs.execute("PRAGMA journal_mode")
+        self.assertEqual(self.db.curs.fetchone()[0], 'wal')
+        reader = sqlite3.connect('./data/history_test.db')
+        self.db.begin_group()
+        self.db.set('1', '2020-01-04 00:00:00', 4)
+        self.db.register('125', 1, '1990-01-01', 'Jane Doe')
+        # nothing is committed until the group is
+        self.assertTrue(self.db.conn.in_transaction)
+        self.assertEqual(reader.execute("SELECT COUNT(*) FROM patients_info WHERE mrn=125").fetchone()[0], 0)
+        self.db.commit_group(2)
+        self.assertFalse(self.db.conn.in_transaction)
+        self.assertEqual(reader.execute("SELECT COUNT(*) FROM patients_info WHERE mrn=125").fetchone()[0], 1)
+        self.assertEqual(reader.execute("SELECT COUNT(*) FROM lab_results WHERE mrn=1").fetchone()[0], 4)
+        reader.close()
+
+    def test_rollback_group(self):
+        self.db.begin_group()
+        self.db.set('1', '2020-01-04 00:00:00', 4)
+        self.db.register('125', 1, '1990-01-01', 'Jane Doe')
+        self.db.rollback_group()
+        self.assertFalse(self.db.conn.in_transaction)
+        self.assertEqual(self.db.get('1')['test_results'], '1.0,2.0,3.0')
+        self.assertEqual(self.db.recent_results('1', 9), ([1.0, 2.0, 3.0], [1.0, 1.0, 0]))
+        self.assertIsNone(self.db.get('125'))
+
+    def test_recent_results(self):
+        self.db.set('1', '2020-01-05 00:00:00', 5)
+        self.assertEqual(self.db.recent_results('1', 2), ([3.0, 5.0], [2.0, 0]))
+        self.assertEqual(self.db.recent_results('1', 9), ([1.0, 2.0, 3.0, 5.0], [1.0, 1.0, 2.0, 0]))
+        self.assertEqual(self.db.recent_results('123', 9), ([], []))
+
+    def test_migrate_series(self):
+        self.db.close()
+        conn = sqlite3.connect('./data/history_test.db')
+        conn.execute("DROP TABLE patients_info")
+        conn.execute("DROP TABLE lab_results")
+        conn.execute('''CREATE TABLE patients_info (mrn INTEGER PRIMARY KEY, dob TEXT, gender INTEGER, name TEXT,
+                        last_test TEXT, test_results TEXT, test_dates TEXT, to_page TEXT, paged INTEGER)''')
+        conn.execute("INSERT INTO patients_info VALUES (1, '1990-01-01', 1, 'Jane Doe', '2020-01-03 12:00:00', '1,2.5,3', '1.0,1.5,0', '', 0)")
+        conn.execute("INSERT INTO patients_info VALUES (3, '1990-01-01', 1, 'Jane Roe', '2020-01-02 00:00:00', '95.24,103.17', '1.0,0', '', 0)")
+        conn.execute("INSERT INTO patients_info VALUES (2, '1990-01-01', 0, 'John Doe', '', '', '', '', 0)")
+        conn.commit()
+        conn.close()
+        self.db = Database('./data/history_test.db')
+        patient = self.db.get('1')
+        self.assertEqual((patient['name'], patient['test_results'], patient['test_dates']), ('Jane Doe', '1.0,2.5,3.0', '1.0,1.5,0'))
+        self.assertEqual(self.db.get('2')['test_results'], '')
+        self.db.set('2', '2020-01-01 00:00:00', 1)
+        self.assertEqual(self.db.recent_results('2', 9), ([1.0], [0]))
+        self.assertEqual(self.db.last_results('1', 9), ([1.0, 2.5, 3.0], [1.0, 1.5, 0]))
+        # lab_results holds the values of the text, not the float32 of the series
+        self.assertEqual(self.db.last_results('3', 9), ([95.24, 103.17], [1.0, 0]))
+        self.assertEqual(self.db.get('3')['test_results'], '95.24,103.17')
+
+    def test_last_results(self):
+        for day in range(4, 16):
+            self.db.set('1', f'2020-01-{day:02d} 00:00:00', day)
+        values, test_dates = self.db.last_results('1', 12)
+        self.assertEqual(values, [float(x) for x in range(4, 16)])
+        self.assertEqual(test_dates, [1.0] * 11 + [0])
+        self.assertEqual(self.db.recent_results('1', 12), (values, test_dates))
+        self.assertEqual(len(self.db.get('1')['test_results'].split(',')), 15)
+        # patients_info keeps only the last RECENT_RESULTS results
+        self.db.curs.execute("SELECT result_values FROM patients_info WHERE mrn=1")
+        self.assertEqual(series.unpack_values(self.db.curs.fetchone()[0]), tuple(float(x) for x in range(7, 16)))
+        self.assertEqual(self.db.recent_results('1', 9), self.db.last_results('1', 9))
+        self.db.curs.execute("SELECT COUNT(*) FROM lab_results WHERE mrn=2")
+        self.assertEqual(self.db.curs.fetchone()[0], 3)
+        self.assertEqual(self.db.last_results('123', 9), ([], []))
+
     def test_register(self):
         # register a new patient with no historial test results
         self.db.register('30', 0, '1990-01-01', 'John Doe')
@@ -121,5 +251,23 @@ class TestDatabase(unittest.TestCase):
         result = self.db.settle_positives()
         self.assertEqual(result, [(1, timestamp)])
 
+    def test_pending_pages(self):
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.db.is_positive('1', timestamp)
+        mrn, page_timestamp, created, attempts, next_attempt = self.db.pending_pages()[0]
+        self.assertEqual((mrn, page_timestamp, attempts), (1, timestamp, 0))
+        self.assertEqual(created, next_attempt)
+
+        self.db.reschedule_page('1', 3, next_attempt + 10)
+        self.assertEqual(self.db.pending_pages()[0][3:], (3, next_attempt + 10))
+
+        # a second positive before the page is sent keeps the page, its attempts and creation time
+        self.db.is_positive('1', '2099-01-01 00:00:00')
+        self.assertEqual(self.db.pending_pages(), [(1, timestamp, created, 3, next_attempt + 10)])
+
+        self.db.paged('1')
+        self.assertEqual(self.db.pending_pages(), [])
+        self.assertEqual(self.db.settle_positives(), [])
+
 if __name__ == '__main__':
     unittest.main()
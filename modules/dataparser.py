@@ -1,25 +1,108 @@
+import numpy as np
+
 from . import messagetypes
+from modules import timestamps
+from modules.hl7schema import Field, compile_extractor
 from modules.module_logging import dataparser_logger
 
+MESSAGE_CLASSES = {b'ORU^R01': messagetypes.Oru_r01, b'ADT^A01': messagetypes.Adt_a01, b'ADT^A03': messagetypes.Adt_a03}
+# codes of the message_type column of parse_many, 0 is an unsupported type
+A01_CODE, A03_CODE, ORU_CODE = 1, 2, 3
+MESSAGE_TYPE_CODES = {b'ADT^A01': A01_CODE, b'ADT^A03': A03_CODE, b'ORU^R01': ORU_CODE}
+GENDER_CODES = {'M': 0, 'F': 1}
+PARSE_MANY_COLUMNS = {
+    'message_type': np.int8,
+    'mrn': np.int64,
+    'msg_timestamp': np.int64,
+    'obr_timestamp': np.int64,
+    'creatinine': np.float32,
+    'dob': np.int64,
+    'gender': np.int8,
+    'error': np.bool_,
+}
+
+# finds PID by its segment ID, it need not follow MSH
+extract_mrn = compile_extractor((Field('mrn', 'PID', 3, 'str'),))
+
+class MessageView():
+    '''
+    Lazy view of a message, returned by DataParser.view once only its MSH segment is split
+    The fields are decoded, and the segments after MSH split, when they are accessed,
+    so a message routed on its type alone is never parsed further
+    Attributes:
+        message_type: str [MSH-9]
+        msg_timestamp: str [MSH-7, decoded when accessed]
+        mrn: str [PID-3, decoded when accessed, None if there is no PID-3]
+    '''
+    __slots__ = ('dataparser', 'msh', 'body', 'message_type')
+
+    def __init__(self, dataparser, msh: list[bytes], body: bytes):
+        self.dataparser = dataparser
+        self.msh = msh
+        self.body = body
+        self.message_type = msh[8].decode()
+
+    @property
+    def msg_timestamp(self):
+        return self.msh[6].decode(errors='replace')
+
+    @property
+    def mrn(self):
+        fields = extract_mrn(self.msh, self.body)
+        return fields[0] if fields is not None else None
+
+    def parse(self):
+        '''
+        Parses the whole message, returns the message object of its type as DataParser.parse_message
+        '''
+        return self.dataparser.build_message(self.msh, self.body)
+
 class DataParser():
     '''
     Main class for parsing HL7 messages
-    Message types that are supported: ORU^R01, ADT^A01, ADT^A03
+    Message types that are supported: ORU^R01, ADT^A01, ADT^A03, and any registered with register
     Attributes:
         ORU: str
         A01: str
         A03: str
+        pool: MessagePool
+        message_classes: dict[bytes, type]
     '''
-    def __init__(self):
+    def __init__(self, pool: messagetypes.MessagePool = None):
         '''
         Constructor for DataParser with supported message types
             self.ORU: str
             self.A01: str
             self.A03: str
+            self.pool: MessagePool [Recycles the parsed messages if set, see release]
+            self.message_classes: dict[bytes, type] [The class of each supported message type, see register]
         '''
         self.ORU = 'ORU^R01'
         self.A01 = 'ADT^A01'
         self.A03 = 'ADT^A03'
+        self.pool = pool
+        self.message_classes = dict(MESSAGE_CLASSES)
+
+    def new_message(self, message_class: type):
+        '''
+        Returns an empty message of the type, from the pool if there is one
+
+        Arguments:
+            message_class: type [The message type class]
+        '''
+        if self.pool is None:
+            return message_class()
+        return self.pool.acquire(message_class)
+
+    def release(self, message: messagetypes.MLLPMessage):
+        '''
+        Returns a parsed message to the pool once it has been processed, does nothing without a pool
+
+        Arguments:
+            message: MLLPMessage [The message returned by parse_message]
+        '''
+        if self.pool is not None:
+            self.pool.release(message)
 
     def remove_start_and_end(self, message: bytes, start=b'\x0b', end=b'\x1c'):
         '''
@@ -67,43 +150,199 @@ class DataParser():
             elif msg_type == self.A03:
                 return self.A03
             else:
-                dataparser_logger.error(f'Invalid message type: {msg_type}')
+                dataparser_logger('ERROR', f'Invalid message type: {msg_type}')
                 return msg_type
         except Exception:
-            dataparser_logger.error('Invalid message format: missing required fields')
+            dataparser_logger('ERROR', 'Invalid message format: missing required fields')
             return None
 
+    def split_header(self, message: bytes):
+        '''
+        Removes the framing and splits the MSH segment, up to MSH-9, the other segments are not split
+
+        Argument:
+            message: bytes [The message to be processed]
+        Returns:
+            msh: list[bytes] [The MSH fields]
+            body: bytes [The segments after MSH]
+        '''
+        # as remove_start_and_end, only the first start and end characters are framing
+        start = message.find(b'\x0b') + 1
+        end = message.find(b'\x1c', start)
+        header = message[start:end if end != -1 else len(message)].lstrip(b'\r').split(b'\r', 1)
+        return header[0].split(b'|', 9), header[1] if len(header) == 2 else b''
+
+    def check_message_type(self, msh: list[bytes]):
+        '''
+        Returns MSH-9 if it is a supported message type, logs why the message is invalid and returns None otherwise
+
+        Argument:
+            msh: list[bytes] [The MSH fields]
+        '''
+        if len(msh) < 9:
+            dataparser_logger('ERROR', 'Invalid message format: missing required fields')
+            return None
+        if msh[8] not in self.message_classes:
+            dataparser_logger('ERROR', f'Invalid message type: {msh[8].decode(errors="replace")}')
+            return None
+        return msh[8]
+
+    def extract_fields(self, message: bytes):
+        '''
+        Extracts the fields that set_fields of the message type takes from the frame, see extract_body_fields
+
+        Argument:
+            message: bytes [The message to be processed]
+        Returns:
+            msg_type: bytes [MSH-9, None if there is no MSH-9]
+            fields: tuple[str] [The fields, None if the type is not supported or a field is missing or not UTF-8]
+        '''
+        msh, body = self.split_header(message)
+        if len(msh) < 9:
+            return None, None
+        return msh[8], self.extract_body_fields(msh, body)
+
+    def extract_body_fields(self, msh: list[bytes], body: bytes):
+        '''
+        Extracts the fields that set_fields of the message type takes from the split MSH segment and the other segments
+
+        The extractor of the message type is compiled from its fields, see hl7schema.compile_extractor:
+        the frame is not decoded or split as a whole, only the segments used are split, each up to
+        the last field used, and only those fields are decoded.
+
+        Arguments:
+            msh: list[bytes] [The MSH fields, up to MSH-9 at least]
+            body: bytes [The segments after MSH]
+        Returns:
+            fields: tuple[str] [The fields, None if the type is not supported or a field is missing or not UTF-8]
+        '''
+        message_class = self.message_classes.get(msh[8])
+        if message_class is None:
+            return None
+        return message_class.extract(msh, body)
+
+    def register(self, message_class: type):
+        '''
+        Adds a message type to the supported ones, see messagetypes.message_class
+
+        Argument:
+            message_class: type [The message type class, with its message_type and fields]
+        '''
+        self.message_classes[message_class.message_type.encode()] = message_class
+
     def parse_message(self, message: bytes):
         '''
         Parses the message and returns the message object of the appropriate type
         Message type: ORU^R01, ADT^A01, ADT^A03
-        
+        Only the fields used are decoded, see extract_body_fields
+
         Argument:
-            message: bytes [The message to be processed]
+            message: bytes [The message to be processed, bytearray and memoryview are copied once]
         '''
-        message = self.remove_start_and_end(message)
-        message = message.decode('utf-8')
-        message_segments = self.segment_message(message)
-        msg_type = self.get_message_type(message_segments)
-        message_obj = None
-        if msg_type == self.ORU:
-            message_obj = messagetypes.Oru_r01()
-            is_processed = message_obj.process_message(message_segments)
-        elif msg_type == self.A01:
-            message_obj = messagetypes.Adt_a01()
-            is_processed = message_obj.process_message(message_segments)
-        elif msg_type == self.A03:
-            message_obj = messagetypes.Adt_a03()
-            is_processed = message_obj.process_message(message_segments)
-        else:
-            dataparser_logger.error(f'Invalid message type: {msg_type}')
+        if not isinstance(message, bytes):
+            message = bytes(message)
+        msh, body = self.split_header(message)
+        if self.check_message_type(msh) is None:
             return None
-        
+        return self.build_message(msh, body)
+
+    def view(self, message: bytes):
+        '''
+        Returns a lazy view of the message, only the MSH segment is split, see MessageView
+        Like parse_message, returns None if the message type is missing or not supported
+
+        Argument:
+            message: bytes [The message to be processed, bytearray and memoryview are copied once]
+        '''
+        if not isinstance(message, bytes):
+            message = bytes(message)
+        msh, body = self.split_header(message)
+        if self.check_message_type(msh) is None:
+            return None
+        return MessageView(self, msh, body)
+
+    def build_message(self, msh: list[bytes], body: bytes):
+        '''
+        Returns the message object of the type of a message with a supported type, None if the message is invalid
+
+        Arguments:
+            msh: list[bytes] [The MSH fields, up to MSH-9 at least]
+            body: bytes [The segments after MSH]
+        '''
+        fields = self.extract_body_fields(msh, body)
+        if fields is None:
+            dataparser_logger('ERROR', f'Invalid message format for {msh[8].decode()}: missing required fields')
+            return None
+        message_obj = self.new_message(self.message_classes[msh[8]])
+        is_processed = message_obj.set_fields(*fields)
+
         if is_processed:
             return message_obj
         else:
+            self.release(message_obj)
             return None
 
+    def parse_many(self, frames):
+        '''
+        Parses many messages into columns, without creating a message object per message
+        A row is an error if parse_message would return None for the message, if its MRN is not
+        a number, if it is an ORU^R01 without a creatinine result, or if its type has no code.
+        The other columns of an error row are 0, an ORU^R01 row holds its first creatinine result.
+
+        Arguments:
+            frames: iterable[bytes] [The messages to be processed]
+        Returns:
+            columns: dict[str, numpy.ndarray] [One row per message, with the columns
+                message_type: int8 [MESSAGE_TYPE_CODES of the message type, 0 if not supported or registered]
+                mrn: int64 [PID-3]
+                msg_timestamp: int64 [MSH-7, in seconds since the epoch]
+                obr_timestamp: int64 [OBR-7, in seconds since the epoch, for ORU^R01]
+                creatinine: float32 [OBX-5, for ORU^R01]
+                dob: int64 [PID-7, in seconds since the epoch, for ADT^A01]
+                gender: int8 [0 for Male, 1 for Female, for ADT^A01]
+                error: bool [Whether the message is invalid]]
+        '''
+        rows = []
+        for message in frames:
+            if not isinstance(message, bytes):
+                message = bytes(message)
+            msg_type, fields = self.extract_fields(message)
+            code = MESSAGE_TYPE_CODES.get(msg_type, 0)
+            obr_timestamp = creatinine = dob = gender = 0
+            try:
+                if fields is None or code == 0:
+                    raise ValueError()
+                msg_timestamp = timestamps.parse_hl7(fields[0])
+                mrn = int(fields[1])
+                if code == ORU_CODE:
+                    creatinine_result = None
+                    # only the creatinine results are validated, see Oru_r01
+                    for result_timestamp, obx_type, obx_value in fields[2]:
+                        if obx_type != messagetypes.CREATININE:
+                            continue
+                        if len(result_timestamp) != 14 or not obx_value:
+                            raise ValueError()
+                        result_timestamp, obx_value = timestamps.parse_hl7(result_timestamp), float(obx_value)
+                        if creatinine_result is None:
+                            creatinine_result = result_timestamp, obx_value
+                    if creatinine_result is None:
+                        raise ValueError()
+                    obr_timestamp, creatinine = creatinine_result
+                elif code == A01_CODE:
+                    if not fields[2] or len(fields[3]) != 8:
+                        raise ValueError()
+                    dob = timestamps.parse_hl7(fields[3])
+                    gender = GENDER_CODES[fields[4]]
+            except (ValueError, KeyError):
+                rows.append((code, 0, 0, 0, 0, 0, 0, True))
+                continue
+            rows.append((code, mrn, msg_timestamp, obr_timestamp, creatinine, dob, gender, False))
+        errors = sum(row[-1] for row in rows)
+        if errors:
+            dataparser_logger('ERROR', f'Invalid messages: {errors} of {len(rows)} could not be parsed')
+        columns = zip(*rows) if rows else [()] * len(PARSE_MANY_COLUMNS)
+        return {name: np.array(column, dtype=dtype) for (name, dtype), column in zip(PARSE_MANY_COLUMNS.items(), columns)}
+
 if __name__ == '__main__':
     adt_ao1_message = b'\x0bMSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240102135300||ADT^A01|||2.5\rPID|1||497030||ROSCOE DOHERTY||19870515|M\r\x1c\r'
     adt_ao3_message = b'\x0bMSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331035800||ADT^A03|||2.5\rPID|1||829339\r\x1c\r'
@@ -168,5 +168,102 @@ class DataparserUnitTest(unittest.TestCase):
         result = self.obj.parse_message(message)
         self.assertEqual(result, expected_result)
 
+    def test_process_message_memoryview(self):
+        message = bytearray(b'\x0bMSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331113300||ORU^R01|||2.5\rPID|1||257406\rOBR|1||||||20240331113300\rOBX|1|SN|CREATININE||92.95579346699137\r\x1c\r')
+        result = self.obj.parse_message(memoryview(message))
+        self.assertEqual(result.mrn, '257406')
+        self.assertEqual(result.obr_timestamp, '2024-03-31 11:33:00')
+        self.assertEqual(result.obx_value, 92.95579346699137)
+
+    def test_process_message_missing_segment(self):
+        message = b'\x0bMSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331113300||ORU^R01|||2.5\rPID|1||257406\r\x1c\r'
+        expected_result = None
+        result = self.obj.parse_message(message)
+        self.assertEqual(result, expected_result)
+
+    def test_process_message_panel(self):
+        message = b'\x0bMSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331113300||ORU^R01|||2.5\rPID|1||257406\rOBR|1||||||20240331113300\rOBX|1|SN|SODIUM||140\rOBX|2|SN|CREATININE||92.5\r\rOBX|3|SN|CREATININE||93.5\r\x1c\r'
+        result = self.obj.parse_message(message)
+        self.assertEqual(result.creatinine_results(), [('2024-03-31 11:33:00', 92.5), ('2024-03-31 11:33:00', 93.5)])
+        self.assertEqual(self.obj.parse_many([message])['creatinine'].tolist(), [92.5])
+        # a text result does not invalidate the creatinine results of the panel
+        message = message.replace(b'SN|SODIUM||140', b'TX|COMMENT||see note')
+        self.assertEqual(self.obj.parse_message(message).creatinine_results(), [('2024-03-31 11:33:00', 92.5), ('2024-03-31 11:33:00', 93.5)])
+        self.assertEqual(self.obj.parse_many([message])['creatinine'].tolist(), [92.5])
+
+    ### For register function
+    def test_register_message_type(self):
+        messagetypes = dataparser.messagetypes
+        fields = messagetypes.HEADER_FIELDS + messagetypes.PATIENT_FIELDS + (
+            messagetypes.Field('location', 'PV1', 3, 'str', required=False),)
+        self.obj.register(messagetypes.message_class('ADT^A08', fields))
+        # segments are found by their ID, wherever they are
+        message = b'\x0bMSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240102135300||ADT^A08|||2.5\rEVN|A08\rPV1|1|I|WARD 4\rPID|1||497030||ROSCOE DOHERTY||19870515|M\r\x1c\r'
+        result = self.obj.parse_message(message)
+        self.assertEqual(type(result).__name__, 'Adt_a08')
+        self.assertEqual((result.message_type, result.mrn, result.dob, result.gender, result.location),
+                         ('ADT^A08', '497030', '1987-05-15', 0, 'WARD 4'))
+        self.assertIsNone(self.obj.parse_message(message.replace(b'|M\r', b'|X\r')))
+        # other parsers are not changed
+        self.assertIsNone(dataparser.DataParser().parse_message(message))
+
+    ### For view function
+    def test_view_ADT_A03(self):
+        message = b'\x0bMSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331035800||ADT^A03|||2.5\rPID|1||829339\r\x1c\r'
+        view = self.obj.view(message)
+        self.assertEqual(view.message_type, 'ADT^A03')
+        self.assertEqual(view.msg_timestamp, '20240331035800')
+        self.assertEqual(view.mrn, '829339')
+
+    def test_view_EVN_before_PID(self):
+        message = b'\x0bMSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331035800||ADT^A03|||2.5\rEVN|A03|20240331035800\rPID|1||829339\r\x1c\r'
+        view = self.obj.view(message)
+        self.assertEqual(view.mrn, '829339')
+        self.assertEqual(view.mrn, view.parse().mrn)
+
+    def test_view_parse(self):
+        message = b'\x0bMSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331113300||ORU^R01|||2.5\rPID|1||257406\rOBR|1||||||20240331113300\rOBX|1|SN|CREATININE||92.95579346699137\r\x1c\r'
+        result = self.obj.view(message).parse()
+        self.assertEqual(result.message_type, 'ORU^R01')
+        self.assertEqual(result.obx_value, 92.95579346699137)
+
+    def test_view_unsupported_message_type(self):
+        message = b'\x0bMSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331035800||ADT^A02|||2.5\rPID|1||829339\r\x1c\r'
+        self.assertIsNone(self.obj.view(message))
+        self.assertIsNone(self.obj.view(b'\x0bMSH|^~\&|SIMULATION\r\x1c\r'))
+
+    def test_view_missing_mrn(self):
+        message = b'\x0bMSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331035800||ADT^A03|||2.5\r\x1c\r'
+        self.assertIsNone(self.obj.view(message).mrn)
+
+    ### For parse_many function
+    def test_parse_many(self):
+        frames = [
+            b'\x0bMSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240102135300||ADT^A01|||2.5\rPID|1||497030||ROSCOE DOHERTY||19870515|M\r\x1c\r',
+            b'\x0bMSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331113300||ORU^R01|||2.5\rPID|1||257406\rOBR|1||||||20240331113300\rOBX|1|SN|CREATININE||92.95579346699137\r\x1c\r',
+            b'\x0bMSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331035800||ADT^A03|||2.5\rPID|1||829339\r\x1c\r',
+            # invalid date of birth, unknown type, other test and missing OBX
+            b'\x0bMSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240102135300||ADT^A01|||2.5\rPID|1||497030||ROSCOE DOHERTY||19870532|M\r\x1c\r',
+            b'\x0bMSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331035800||ADT^A02|||2.5\rPID|1||829339\r\x1c\r',
+            b'\x0bMSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331113300||ORU^R01|||2.5\rPID|1||257406\rOBR|1||||||20240331113300\rOBX|1|SN|SODIUM||140\r\x1c\r',
+            b'\x0bMSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331113300||ORU^R01|||2.5\rPID|1||257406\rOBR|1||||||20240331113300\r\x1c\r',
+        ]
+        result = self.obj.parse_many(frames)
+        self.assertEqual(result['error'].tolist(), [False, False, False, True, True, True, True])
+        self.assertEqual(result['message_type'].tolist(), [dataparser.A01_CODE, dataparser.ORU_CODE, dataparser.A03_CODE,
+                                                           dataparser.A01_CODE, 0, dataparser.ORU_CODE, dataparser.ORU_CODE])
+        self.assertEqual(result['mrn'][:3].tolist(), [497030, 257406, 829339])
+        self.assertEqual(result['msg_timestamp'][1], 1711884780)
+        self.assertEqual(result['obr_timestamp'][1], 1711884780)
+        self.assertEqual(result['creatinine'].dtype, 'float32')
+        self.assertAlmostEqual(result['creatinine'][1], 92.955795, places=4)
+        self.assertEqual(result['dob'][0], 548035200)
+        self.assertEqual(result['gender'][0], 0)
+
+    def test_parse_many_empty(self):
+        result = self.obj.parse_many([])
+        self.assertEqual(len(result['error']), 0)
+        self.assertEqual(result['mrn'].dtype, 'int64')
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,107 @@
+import collections
+import concurrent.futures
+import csv
+import io
+import itertools
+import os
+
+import numpy as np
+
+# bytes of the history CSV parsed by one worker, a smaller file is parsed in the calling process
+HISTORY_CHUNK_BYTES = 1 << 22
+# set on the loading connection only, a crash while loading leaves a database that must be deleted
+# the journal is the WAL of the database, see Database, it cannot be changed while the database is open
+LOADER_PRAGMAS = ("PRAGMA synchronous=OFF", "PRAGMA temp_store=MEMORY", "PRAGMA cache_size=-65536")
+
+# the parsed rows of a chunk, the test results of every patient are consecutive in times and values
+# error is None, or (kind, message) of the first invalid row, the rows before it are parsed
+HistoryChunk = collections.namedtuple("HistoryChunk", ["mrns", "last_tests", "counts", "times", "values", "error"])
+
+def split_chunks(file_path, chunk_bytes=HISTORY_CHUNK_BYTES):
+    '''
+    Split the history CSV into byte ranges of whole rows, after the header
+    Args:
+        file_path (str): The path to the csv file
+        chunk_bytes (int): The approximate size of a range
+    Returns:
+        list: (start, end) of every range
+    '''
+    chunks = []
+    with open(file_path, 'rb') as f:
+        f.readline()
+        start = f.tell()
+        size = f.seek(0, os.SEEK_END)
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            # the row the range ends in belongs to it, the file holds no quoted line breaks
+            f.readline()
+            end = f.tell()
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+def parse_chunk(file_path, start, end):
+    '''
+    Parse a range of rows of the history CSV, the dates of the whole range are parsed and checked at once
+    Rows are mrn, then pairs of date and result, the trailing empty pairs are ignored. Parsing stops at
+    the first row with an odd number of cells or dates out of order, see Database.process_dates
+    Args:
+        file_path (str): The path to the csv file
+        start (int), end (int): The range of rows, see split_chunks
+    Returns:
+        HistoryChunk: The rows before the first invalid row
+    Raises:
+        ValueError: If a date or result cannot be parsed
+    '''
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode()
+    mrns, last_tests, counts, dates, values = [], [], [], [], []
+    error = None
+    for row in csv.reader(io.StringIO(text)):
+        if not row:
+            continue
+        cells = [x for x in row[1:] if x != '']
+        if len(row) < 3 or len(row) % 2 == 0 or not cells or len(cells) % 2 != 0:
+            error = ("length", f"Invalid test results length: {len(row) - 1}")
+            break
+        mrns.append(int(row[0]))
+        last_tests.append(cells[-2])
+        counts.append(len(cells) // 2)
+        dates.extend(cells[::2])
+        values.extend(cells[1::2])
+    counts = np.array(counts, dtype=np.int64)
+    times = np.array(dates, dtype='datetime64[s]').astype(np.int64)
+    values = np.array(values, dtype=np.float64)
+    # a test before the previous one of the same patient, the first test of a patient has no previous one
+    ends = np.cumsum(counts)
+    out_of_order = np.diff(times) < 0
+    out_of_order[ends[:-1] - 1] = False
+    if out_of_order.any():
+        position = int(np.argmax(out_of_order))
+        row = int(np.searchsorted(ends, position, side='right'))
+        kept = int(ends[row - 1]) if row else 0
+        error = ("order", f"Dates are not in order: {dates[position + 1]} is less than {dates[position]}")
+        mrns, last_tests, counts, times, values = mrns[:row], last_tests[:row], counts[:row], times[:kept], values[:kept]
+    return HistoryChunk(mrns, last_tests, counts, times, values, error)
+
+def parse_history(file_path, processes=None):
+    '''
+    Parse the history CSV in ranges across a process pool, see parse_chunk
+    Args:
+        file_path (str): The path to the csv file
+        processes (int): The number of worker processes, os.cpu_count() if None
+    Returns:
+        iterator: The HistoryChunk of every range, in the order of the file
+    '''
+    chunks = split_chunks(file_path)
+    processes = min(processes or os.cpu_count() or 1, len(chunks))
+    if processes <= 1:
+        yield from (parse_chunk(file_path, start, end) for start, end in chunks)
+        return
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+    try:
+        yield from executor.map(parse_chunk, itertools.repeat(file_path), *zip(*chunks))
+    finally:
+        # the caller stops at the first invalid row, the ranges after it are not parsed
+        executor.shutdown(cancel_futures=True)
@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+
+from history_loader import parse_chunk, parse_history, split_chunks
+
+HEADER = "mrn,date1,result1,date2,result2,date3,result3\n"
+
+class HistoryLoaderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "history.csv")
+
+    def tearDown(self):
+        os.remove(self.filename)
+        os.rmdir(self.directory)
+
+    def write(self, *rows):
+        with open(self.filename, "w") as w:
+            w.write(HEADER + "".join(row + "\n" for row in rows))
+
+    def test_parse_chunk(self):
+        self.write("1,2020-01-01 00:00:00,1,2020-01-02 12:00:00,2.5,,",
+                   "2,2020-01-03 00:00:00,3,,,,")
+        chunk = parse_chunk(self.filename, *split_chunks(self.filename)[0])
+        self.assertEqual(chunk.mrns, [1, 2])
+        self.assertEqual(chunk.last_tests, ["2020-01-02 12:00:00", "2020-01-03 00:00:00"])
+        self.assertEqual(chunk.counts.tolist(), [2, 1])
+        self.assertEqual(chunk.times.tolist(), [1577836800, 1577836800 + 1.5 * 86400, 1577836800 + 2 * 86400])
+        self.assertEqual(chunk.values.tolist(), [1.0, 2.5, 3.0])
+        self.assertIsNone(chunk.error)
+
+    def test_invalid_row(self):
+        self.write("1,2020-01-01 00:00:00,1,,,,",
+                   "2,2020-01-02 00:00:00,1,2020-01-01 00:00:00,2,,",
+                   "3,2020-01-01 00:00:00,1,,,,")
+        chunk = parse_chunk(self.filename, *split_chunks(self.filename)[0])
+        self.assertEqual((chunk.mrns, chunk.values.tolist()), ([1], [1.0]))
+        self.assertEqual(chunk.error[0], "order")
+        self.write("1,2020-01-01 00:00:00,1,,,,", "2,2020-01-01 00:00:00")
+        chunk = parse_chunk(self.filename, *split_chunks(self.filename)[0])
+        self.assertEqual((chunk.mrns, chunk.error[0]), ([1], "length"))
+        self.write("1,2020/01/01,1,,,,")
+        self.assertRaises(ValueError, parse_chunk, self.filename, *split_chunks(self.filename)[0])
+
+    def test_chunks(self):
+        self.write(*(f"{mrn},2020-01-01 00:00:00,{mrn},2020-01-02 00:00:00,{mrn},," for mrn in range(100)))
+        chunks = split_chunks(self.filename, 64)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(chunks[-1][1], os.path.getsize(self.filename))
+        mrns = [mrn for start, end in chunks for mrn in parse_chunk(self.filename, start, end).mrns]
+        self.assertEqual(mrns, list(range(100)))
+        self.assertEqual([mrn for chunk in parse_history(self.filename, 1) for mrn in chunk.mrns], list(range(100)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+import collections
+
+from modules.module_logging import messagetypes_logger
+from modules.timestamps import hl7_to_iso
+
+# MSH is split up to MSH-9 before the message type is known, see DataParser.split_header
+MSH_MAX_FIELD = 9
+
+Field = collections.namedtuple('Field', ['name', 'segment', 'index', 'kind', 'required', 'repeat'], defaults=[True, False])
+Field.__doc__ = '''
+A field of a message type
+
+Attributes:
+    name: str [The attribute of the message the field is set to]
+    segment: str [The segment ID, e.g. PID]
+    index: int [The HL7 field number, e.g. 3 for PID-3]
+    kind: str [The conversion of the field, one of KINDS]
+    required: bool [Whether the message is invalid if the field is empty]
+    repeat: bool [Whether the field is part of the repeated group, see compile_extractor]
+'''
+
+def to_date(value: str):
+    '''Converts an HL7 date (YYYYMMDD) to an ISO date'''
+    if len(value) != 8:
+        raise ValueError(f'expected a date (YYYYMMDD) but found: {value}')
+    return hl7_to_iso(value)
+
+def to_timestamp(value: str):
+    '''Converts an HL7 timestamp (YYYYMMDDHHMMSS) to an ISO timestamp'''
+    if len(value) != 14:
+        raise ValueError(f'expected a timestamp (YYYYMMDDHHMMSS) but found: {value}')
+    return hl7_to_iso(value)
+
+def to_gender(value: str):
+    '''Converts M to 0 and F to 1'''
+    if value == 'M':
+        return 0
+    if value == 'F':
+        return 1
+    raise ValueError(f'expected binary gender (F or M) but found: {value}')
+
+# the conversion of each kind of field, None keeps the decoded string
+KINDS = {
+    'str': None,
+    'float': float,
+    'date': to_date,
+    'timestamp': to_timestamp,
+    'gender': to_gender,
+}
+
+def field_variable(segment: str):
+    '''The variable holding the split fields of a segment in compiled code'''
+    return segment.lower()
+
+def compile_extractor(fields: tuple):
+    '''
+    Compiles the fields of a message type into a function extracting them from a message,
+    so every message type has the same fast path as hand written code
+
+    MSH-7 is read from the split MSH segment, the other segments are found by their ID, the first
+    one of each ID is used. The repeated fields form one result per segment of the last repeated field,
+    each with the other repeated fields of the latest segment before it, e.g. the OBX segments of
+    a panel with the timestamp of their OBR segment.
+    Arguments:
+        fields: tuple[Field] [The fields of the message type]
+    Returns:
+        extract: function [Takes the MSH fields (list[bytes]) and the segments after MSH (bytes),
+                           returns the decoded fields in order with the repeated fields as one list of tuples
+                           at the position of the first, or None if a segment or field is missing or not UTF-8]
+    '''
+    singles, group = {}, {}
+    for field in fields:
+        if field.segment == 'MSH':
+            if field.repeat or not 1 < field.index <= MSH_MAX_FIELD:
+                raise ValueError(f'MSH-{field.index} cannot be extracted')
+            continue
+        segments = group if field.repeat else singles
+        segments[field.segment] = max(segments.get(field.segment, 0), field.index)
+    if set(singles) & set(group):
+        raise ValueError(f'segments {set(singles) & set(group)} are both repeated and not')
+    child = next((field.segment for field in reversed(fields) if field.repeat), None)
+
+    def value(field):
+        if field.segment == 'MSH':
+            # MSH-1 is the field separator itself
+            return f'msh[{field.index - 1}].decode()'
+        return f'{field_variable(field.segment)}[{field.index}].decode()'
+
+    lines = ['def extract(msh, body):']
+    for segment in list(singles) + list(group):
+        lines.append(f'    {field_variable(segment)} = None')
+    if group:
+        lines.append('    results = []')
+    lines.append('    try:')
+    if singles or group:
+        lines.append("        for segment in body.split(b'\\r'):")
+        lines.append('            segment_id = segment[:4]')
+        for i, (segment, index) in enumerate(list(singles.items()) + list(group.items())):
+            variable = field_variable(segment)
+            lines.append(f"            {'if' if i == 0 else 'elif'} segment_id == b'{segment}|':")
+            if segment in singles:
+                lines.append(f'                if {variable} is None:')
+                lines.append(f"                    {variable} = segment.split(b'|', {index + 1})")
+            else:
+                lines.append(f"                {variable} = segment.split(b'|', {index + 1})")
+            if segment == child:
+                result = ', '.join(value(field) for field in fields if field.repeat)
+                lines.append(f'                results.append(({result},))')
+    values = []
+    for field in fields:
+        if not field.repeat:
+            values.append(value(field))
+        elif 'results' not in values:
+            values.append('results')
+    lines.append(f"        return ({', '.join(values)},)")
+    # a missing segment is None
+    lines.append('    except (IndexError, TypeError, UnicodeDecodeError):')
+    lines.append('        return None')
+    namespace = {}
+    exec('\n'.join(lines), namespace)
+    return namespace['extract']
+
+def compile_validator(message_type: str, fields: tuple, strict=None):
+    '''
+    Compiles the fields of a message type into a method validating the extracted fields and setting the attributes
+
+    Arguments:
+        message_type: str [The message type, for logging]
+        fields: tuple[Field] [The fields of the message type]
+        strict: function [Takes a repeated group as extracted, returns whether the message is invalid if the group is,
+                          the other invalid groups are skipped. None if every group must be valid]
+    Returns:
+        set_fields: function [Takes the message and the fields returned by the extractor, returns whether they are valid]
+    '''
+    singles = [field for field in fields if not field.repeat]
+    repeated = [field for field in fields if field.repeat]
+    arguments = []
+    for field in fields:
+        if not field.repeat:
+            arguments.append(field.name)
+        elif 'results' not in arguments:
+            arguments.append('results')
+
+    def converted(field, name):
+        return name if KINDS[field.kind] is None else f'convert_{field.kind}({name})'
+
+    missing = [f'not {field.name}' for field in singles if field.required]
+    lines = [f"def set_fields(self, {', '.join(arguments)}):"]
+    if repeated:
+        names = [f'_{field.name}' for field in repeated]
+        required = [name for field, name in zip(repeated, names) if field.required]
+        if strict is None:
+            missing.append('not results')
+            if required:
+                missing.append(f"not all({' and '.join(required)} for {', '.join(names)} in results)")
+    if missing:
+        lines.append(f"    if {' or '.join(missing)}:")
+        lines.append(f"        messagetypes_logger('ERROR', 'Invalid message format for {message_type}: missing required fields')")
+        lines.append('        return False')
+    lines.append('    try:')
+    for field in singles:
+        lines.append(f'        self.{field.name} = {converted(field, field.name)}')
+    if repeated:
+        result = ', '.join(converted(field, name) for field, name in zip(repeated, names))
+        if strict is None:
+            lines.append(f"        self.results = [({result},) for {', '.join(names)} in results]")
+    lines.append('    except ValueError as e:')
+    lines.append(f"        messagetypes_logger('ERROR', f'Invalid message format for {message_type}: {{e}}')")
+    lines.append('        return False')
+    if repeated and strict is not None:
+        # each group is validated on its own, only an invalid strict group invalidates the message
+        lines.append('    self.results = []')
+        lines.append('    for group in results:')
+        lines.append(f"        {', '.join(names)}, = group")
+        lines.append('        try:')
+        if required:
+            lines.append(f"            if not ({' and '.join(required)}):")
+            lines.append("                raise ValueError('missing required fields')")
+        lines.append(f'            self.results.append(({result},))')
+        lines.append('        except ValueError as e:')
+        lines.append('            if strict(group):')
+        lines.append(f"                messagetypes_logger('ERROR', f'Invalid message format for {message_type}: {{e}}')")
+        lines.append('                return False')
+        lines.append(f"            messagetypes_logger('WARNING', f'Skipping an invalid result of {message_type}: {{e}}')")
+        lines.append('    if not self.results:')
+        lines.append(f"        messagetypes_logger('ERROR', 'Invalid message format for {message_type}: missing required fields')")
+        lines.append('        return False')
+    lines.append('    return True')
+    namespace = {'messagetypes_logger': messagetypes_logger, 'strict': strict}
+    namespace.update((f'convert_{kind}', convert) for kind, convert in KINDS.items() if convert is not None)
+    exec('\n'.join(lines), namespace)
+    return namespace['set_fields']
@@ -0,0 +1,56 @@
+import unittest
+
+from hl7schema import Field, compile_extractor, compile_validator
+
+FIELDS = (
+    Field('msg_timestamp', 'MSH', 7, 'str'),
+    Field('mrn', 'PID', 3, 'str'),
+    Field('obr_timestamp', 'OBR', 7, 'timestamp', repeat=True),
+    Field('obx_type', 'OBX', 3, 'str', repeat=True),
+    Field('obx_value', 'OBX', 5, 'float', repeat=True),
+)
+MSH = b'MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331113300||ORU^R01|||2.5'.split(b'|', 9)
+
+class Message:
+    pass
+
+class HL7SchemaTest(unittest.TestCase):
+    def setUp(self):
+        self.extract = compile_extractor(FIELDS)
+        self.set_fields = compile_validator('ORU^R01', FIELDS)
+
+    def test_extract_groups(self):
+        body = b'PID|1||257406\rOBR|1||||||20240331113300\rOBX|1|SN|CREATININE||92.5\rOBR|2||||||20240331120000\rOBX|1|SN|SODIUM||140'
+        self.assertEqual(self.extract(MSH, body), ('20240331113300', '257406', [
+            ('20240331113300', 'CREATININE', '92.5'), ('20240331120000', 'SODIUM', '140')]))
+
+    def test_extract_missing(self):
+        # no PID, a result before its OBR, a PID without PID-3
+        for body in (b'OBR|1||||||20240331113300\rOBX|1|SN|CREATININE||92.5',
+                     b'PID|1||257406\rOBX|1|SN|CREATININE||92.5\rOBR|1||||||20240331113300',
+                     b'PID|1\rOBR|1||||||20240331113300\rOBX|1|SN|CREATININE||92.5'):
+            self.assertIsNone(self.extract(MSH, body))
+
+    def test_set_fields(self):
+        message = Message()
+        self.assertTrue(self.set_fields(message, '20240331113300', '257406', [('20240331113300', 'CREATININE', '0')]))
+        self.assertEqual(message.results, [('2024-03-31 11:33:00', 'CREATININE', 0.0)])
+        self.assertFalse(self.set_fields(message, '20240331113300', '257406', []))
+        self.assertFalse(self.set_fields(message, '20240331113300', '257406', [('20240331113300', 'CREATININE', 'x')]))
+        self.assertFalse(self.set_fields(message, '20240331113300', '257406', [('202403311133', 'CREATININE', '1')]))
+
+    def test_set_fields_strict(self):
+        set_fields = compile_validator('ORU^R01', FIELDS, strict=lambda result: result[1] == 'CREATININE')
+        message = Message()
+        results = [('20240331113300', 'COMMENT', 'see note'), ('', 'SODIUM', '140'), ('20240331113300', 'CREATININE', '92.5')]
+        self.assertTrue(set_fields(message, '20240331113300', '257406', results))
+        self.assertEqual(message.results, [('2024-03-31 11:33:00', 'CREATININE', 92.5)])
+        self.assertFalse(set_fields(message, '20240331113300', '257406', results + [('20240331113300', 'CREATININE', '')]))
+        self.assertFalse(set_fields(message, '20240331113300', '257406', results[:2]))
+
+    def test_invalid_schema(self):
+        self.assertRaises(ValueError, compile_extractor, (Field('version', 'MSH', 12, 'str'),))
+        self.assertRaises(ValueError, compile_extractor, (Field('mrn', 'PID', 3, 'str'), Field('name', 'PID', 5, 'str', repeat=True)))
+
+if __name__ == '__main__':
+    unittest.main()
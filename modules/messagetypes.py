@@ -1,75 +1,140 @@
-from datetime import datetime
+from modules.hl7schema import Field, compile_extractor, compile_validator
 from modules.module_logging import messagetypes_logger
 
+MESSAGE_POOL_SIZE = 64
+CREATININE = 'CREATININE'
+
+# the fields every message type has
+HEADER_FIELDS = (
+    Field('msg_timestamp', 'MSH', 7, 'str'),
+    Field('mrn', 'PID', 3, 'str'),
+)
+# the fields of the message types that carry patient information
+PATIENT_FIELDS = (
+    Field('name', 'PID', 5, 'str'),
+    Field('dob', 'PID', 7, 'date'),
+    Field('gender', 'PID', 8, 'gender'),
+)
+
+def is_creatinine(result: tuple):
+    '''
+    Returns whether a result of an ORU^R01 message, as extracted, is a creatinine result
+
+    Arguments:
+        result: tuple [(OBR-7, OBX-3, OBX-5)]
+    '''
+    return result[1] == CREATININE
+
 class MLLPMessage:
     '''
     Base class for MLLP message types
+    The attributes of every message type are slots, the message type and its fields are class attributes
+    The fields of a message type, see hl7schema.Field, are compiled once when its class is created into
+        extract: function [Extracts the fields from a message, see hl7schema.compile_extractor]
+        set_fields: function [Validates the extracted fields and sets the attributes, see hl7schema.compile_validator]
+    A message type with repeated fields may set strict_result, see hl7schema.compile_validator, to skip the other invalid results
     '''
+    __slots__ = ('msg_timestamp', 'mrn')
+    message_type = None
+    fields = ()
+    strict_result = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.extract = staticmethod(compile_extractor(cls.fields))
+        cls.validate_fields = compile_validator(cls.message_type, cls.fields, cls.strict_result)
+        # a message type may add to the validation, calling validate_fields first
+        if 'set_fields' not in cls.__dict__:
+            cls.set_fields = cls.validate_fields
+        cls.attributes = tuple(field.name for field in cls.fields if not field.repeat)
+
     def __init__(self):
-        self.msg_timestamp = None
-        self.mrn = None
+        for name in self.attributes:
+            setattr(self, name, None)
 
-class Adt_a01(MLLPMessage):
+    def process_message(self, message_segments: list[str]):
+        '''
+        Processes the message and sets the attributes of the appropriate class
+
+        Arguments:
+            message_segments: list[str] [The list of segments of the message]
+        '''
+        fields = None
+        if message_segments:
+            fields = self.extract(message_segments[0].encode().split(b'|', 9), '\r'.join(message_segments[1:]).encode())
+        if fields is None:
+            messagetypes_logger('ERROR', f'Invalid message format for {self.message_type}: missing required fields')
+            return False
+        return self.set_fields(*fields)
+
+def message_class(message_type: str, fields: tuple):
     '''
-    Class for ADT^A01 message type
+    Creates the class of a message type that needs no code of its own, only its fields
+
+    Arguments:
+        message_type: str [The message type, e.g. ADT^A08]
+        fields: tuple[Field] [The fields of the message type]
+    '''
+    slots = tuple(field.name for field in fields if not field.repeat and field.name not in MLLPMessage.__slots__)
+    if any(field.repeat for field in fields):
+        slots += ('results',)
+    return type(message_type.replace('^', '_').capitalize(), (MLLPMessage,),
+                {'__slots__': slots, 'message_type': message_type, 'fields': fields})
+
+class MessagePool:
+    '''
+    Recycles message objects, so replaying many messages does not allocate one per message
 
     Attributes:
-        message_type: str [Message type]
-        name: str [Patient name]
-        dob: str [Date of birth
-        msg_timestamp: str [Timestamp of the message]
-        mrn: int [Medical record number]
+        size: int [Number of free messages kept per message type]
+        free: dict [The free messages of each message type]
     '''
-    def __init__(self):
-        '''
-        Constructor for ADT^A01 message type
+    def __init__(self, size: int = MESSAGE_POOL_SIZE):
+        self.size = size
+        self.free = {}
 
-        Attributes:
-            message_type: str [Message type]
-            name: str [Patient name]
-            dob: str [Date of birth]
-            gender: int [0 for Male, 1 for Female]
+    def acquire(self, message_class: type):
         '''
-        super().__init__()
-        self.message_type = 'ADT^A01'
-        self.name = None
-        self.dob = None
-        self.gender = None
+        Returns a message of the type with every attribute unset, a released one if there is any
 
-    def process_message(self, message_segments: list[str]):
+        Arguments:
+            message_class: type [One of Adt_a01, Adt_a03 or Oru_r01]
         '''
-        Processes the message and sets the attributes of the appropriate class
+        free = self.free.get(message_class)
+        if free:
+            message = free.pop()
+            message.__init__()
+            return message
+        return message_class()
+
+    def release(self, message: MLLPMessage):
+        '''
+        Returns the message to the pool, it must not be used after
 
         Arguments:
-            message_segments: list[str] [The list of segments of the message]
+            message: MLLPMessage [The message, None is ignored]
         '''
-        try:
-            msh = message_segments[0].split('|')
-            pid = message_segments[1].split('|')
-            self.msg_timestamp = msh[6]
-            self.mrn = pid[3]
-            self.name = pid[5]
-            self.dob = datetime.strptime(pid[7], '%Y%m%d').strftime('%Y-%m-%d')
-            self.gender = pid[8]
-            if not self.msg_timestamp or \
-                not self.mrn or \
-                not self.name or \
-                not self.dob or \
-                not self.gender:
-                messagetypes_logger('ERROR', 'Invalid message format for ADT^A01: missing required fields')
-                return False
-            # parse gender after checking for missing fields, as gender = 0 may trigger a Exception
-            if self.gender == 'M':
-                self.gender = 0
-            elif self.gender == 'F':
-                self.gender = 1
-            else:
-                messagetypes_logger('ERROR', f'Error for ADT^A01: expected binary gender (F or M) but found: {self.gender}')
-                return False
-        except Exception:
-            messagetypes_logger('ERROR', 'Invalid message format for ADT^A01: missing required fields')
-            return False
-        return True
+        if message is None:
+            return
+        free = self.free.setdefault(type(message), [])
+        if len(free) < self.size:
+            free.append(message)
+
+class Adt_a01(MLLPMessage):
+    '''
+    Class for ADT^A01 message type
+
+    Attributes:
+        message_type: str [Message type]
+        name: str [Patient name]
+        dob: str [Date of birth]
+        gender: int [0 for Male, 1 for Female]
+        msg_timestamp: str [Timestamp of the message]
+        mrn: int [Medical record number]
+    '''
+    __slots__ = ('name', 'dob', 'gender')
+    message_type = 'ADT^A01'
+    fields = HEADER_FIELDS + PATIENT_FIELDS
 
 
 class Adt_a03(MLLPMessage):
@@ -81,89 +146,69 @@ class Adt_a03(MLLPMessage):
         msg_timestamp: str [Timestamp of the message]
         mrn: int [Medical record number]
     '''
-    def __init__(self):
-        '''
-        Constructor for ADT^A03 message type
-
-        Attributes:
-            message_type: str [Message type]
-        '''
-        super().__init__()
-        self.message_type = 'ADT^A03'
-
-    def process_message(self, message_segments: list[str]):
-        '''
-        Processes the message and sets the attributes of the appropriate class
-        
-        Arguments:
-            message_segments: list[str] [The list of segments of the message]
-        '''
-        try:
-            msh = message_segments[0].split('|')
-            pid = message_segments[1].split('|')
-            self.msg_timestamp = msh[6]
-            self.mrn = pid[3]
-            if not self.msg_timestamp or not self.mrn:
-                messagetypes_logger('ERROR', 'Invalid message format for ADT^A03: missing required fields')
-                return False
-        except Exception:
-            messagetypes_logger('ERROR', 'Invalid message format for ADT^A03: missing required fields')
-            return False
-        return True
+    __slots__ = ()
+    message_type = 'ADT^A03'
+    fields = HEADER_FIELDS
 
 class Oru_r01(MLLPMessage):
     '''
     Class for ORU^R01 message type
+    A panel may carry several results, each OBX segment is a result of the OBR segment before it
 
     Attributes:
         message_type: str [Message type]
+        results: list[tuple] [(obr_timestamp, obx_type, obx_value) of every result, in message order]
         obr_timestamp: str [Timestamp of the observation]
         obx_type: str [Type of observation]
         obx_value: float [Value of the observation]
         msg_timestamp: str [Timestamp of the message]
         mrn: int [Medical record number]
+    The observation attributes are the first creatinine result, or the first result if there is none
+    An invalid creatinine result invalidates the message, the other invalid results are skipped
     '''
+    __slots__ = ('results', 'obr_timestamp', 'obx_type', 'obx_value')
+    message_type = 'ORU^R01'
+    fields = HEADER_FIELDS + (
+        Field('obr_timestamp', 'OBR', 7, 'timestamp', repeat=True),
+        Field('obx_type', 'OBX', 3, 'str', repeat=True),
+        Field('obx_value', 'OBX', 5, 'float', repeat=True),
+    )
+    strict_result = staticmethod(is_creatinine)
+
     def __init__(self):
         '''
         Constructor for ORU^R01 message type
 
         Attributes:
-            message_type: str [Message type]
+            results: list[tuple] [Every result of the panel]
             obr_timestamp: str [Timestamp of the observation]
             obx_type: str [Type of observation]
             obx_value: float [Value of the observation]
         '''
         super().__init__()
-        self.message_type = 'ORU^R01'
+        self.results = []
         self.obr_timestamp = None
         self.obx_type = None
         self.obx_value = None
 
-    def process_message(self, message_segments: list[str]):
+    def set_fields(self, msg_timestamp: str, mrn: str, results: list[tuple]):
         '''
-        Processes the message and sets the attributes of the appropriate class
+        Validates the fields extracted from the message and sets the attributes
+        The message is invalid if any of its creatinine results is, or if it has no valid result
 
         Arguments:
-            message_segments: list[str] [The list of segments of the message]
+            msg_timestamp: str [MSH-7]
+            mrn: str [PID-3]
+            results: list[tuple] [(OBR-7 as YYYYMMDDHHMMSS, OBX-3, OBX-5) of every OBX segment]
         '''
-        try:
-            msh = message_segments[0].split('|')
-            pid = message_segments[1].split('|')
-            obr = message_segments[2].split('|')
-            obx = message_segments[3].split('|')
-            self.msg_timestamp = msh[6]
-            self.mrn = pid[3]
-            self.obr_timestamp =  datetime.strptime(obr[7], '%Y%m%d%H%M%S').strftime('%Y-%m-%d %H:%M:%S')
-            self.obx_type = obx[3]
-            self.obx_value = float(obx[5])
-            if not self.msg_timestamp or \
-            not self.mrn or \
-            not self.obr_timestamp or \
-            not self.obx_type or \
-            not self.obx_value:
-                messagetypes_logger('ERROR', 'Invalid message format for ORU^R01: missing required fields')
-                return False
-        except Exception:
-            messagetypes_logger('ERROR', 'Invalid message format for ORU^R01: missing required fields')
+        if not self.validate_fields(msg_timestamp, mrn, results):
             return False
+        self.obr_timestamp, self.obx_type, self.obx_value = next(
+            (result for result in self.results if result[1] == CREATININE), self.results[0])
         return True
+
+    def creatinine_results(self):
+        '''
+        Returns the (obr_timestamp, obx_value) of every creatinine result of the panel
+        '''
+        return [(obr_timestamp, obx_value) for obr_timestamp, obx_type, obx_value in self.results if obx_type == CREATININE]
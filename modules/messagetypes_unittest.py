@@ -126,5 +126,56 @@ class MessageTypesUnitTest(unittest.TestCase):
 
     
 
+    def test_process_message_oru_r01_panel(self):
+        message_segments = ['MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331113300||ORU^R01|||2.5',
+                            'PID|1||257406', 'OBR|1||||||20240331113300', 'OBX|1|SN|SODIUM||140',
+                            'OBX|2|SN|CREATININE||92.5', 'OBR|2||||||20240331123300', 'OBX|1|SN|CREATININE||101.5']
+        result = self.obj3.process_message(message_segments)
+        self.assertEqual(result, True)
+        self.assertEqual(self.obj3.results, [('2024-03-31 11:33:00', 'SODIUM', 140.0),
+                                             ('2024-03-31 11:33:00', 'CREATININE', 92.5),
+                                             ('2024-03-31 12:33:00', 'CREATININE', 101.5)])
+        # the observation attributes are the first creatinine result
+        self.assertEqual((self.obj3.obx_type, self.obj3.obx_value), ('CREATININE', 92.5))
+        self.assertEqual(self.obj3.creatinine_results(), [('2024-03-31 11:33:00', 92.5), ('2024-03-31 12:33:00', 101.5)])
+
+    def test_process_message_oru_r01_mixed_panel(self):
+        message_segments = ['MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331113300||ORU^R01|||2.5',
+                            'PID|1||257406', 'OBR|1||||||20240331113300', 'OBX|1|TX|COMMENT||haemolysed sample',
+                            'OBX|2|SN|CREATININE||92.5', 'OBR|2||||||', 'OBX|1|SN|SODIUM||140', 'OBR|3||||||20240331123300',
+                            'OBX|1|SN|CREATININE||101.5']
+        result = self.obj3.process_message(message_segments)
+        self.assertEqual(result, True)
+        # the text and undated results are skipped, the creatinine results are kept
+        self.assertEqual(self.obj3.results, [('2024-03-31 11:33:00', 'CREATININE', 92.5),
+                                             ('2024-03-31 12:33:00', 'CREATININE', 101.5)])
+        self.assertEqual(self.obj3.creatinine_results(), [('2024-03-31 11:33:00', 92.5), ('2024-03-31 12:33:00', 101.5)])
+
+    def test_process_invalid_oru_r01_panel_result(self):
+        message_segments = ['MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331113300||ORU^R01|||2.5',
+                            'PID|1||257406', 'OBR|1||||||20240331113300', 'OBX|1|SN|CREATININE||92.5', 'OBX|2|SN|CREATININE||']
+        is_processed = self.obj3.process_message(message_segments)
+        self.assertEqual(is_processed, False)
+
+    ### MessagePool
+    def test_message_has_no_instance_dict(self):
+        self.assertFalse(hasattr(self.obj3, '__dict__'))
+        self.assertRaises(AttributeError, setattr, self.obj3, 'name', 'ROSCOE DOHERTY')
+
+    def test_message_pool_recycles_reset_messages(self):
+        pool = messagetypes.MessagePool(size=1)
+        message_segments = ['MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240102135300||ADT^A01|||2.5', 
+                            'PID|1||497030||ROSCOE DOHERTY||19870515|M']
+        self.obj1.process_message(message_segments)
+        pool.release(self.obj1)
+        pool.release(messagetypes.Adt_a01())
+        message = pool.acquire(messagetypes.Adt_a01)
+        self.assertIs(message, self.obj1)
+        self.assertEqual((message.mrn, message.name, message.gender), (None, None, None))
+        self.assertEqual(message.message_type, 'ADT^A01')
+        # only one free message per type is kept
+        self.assertIsNot(pool.acquire(messagetypes.Adt_a01), self.obj1)
+        self.assertIsInstance(pool.acquire(messagetypes.Oru_r01), messagetypes.Oru_r01)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,4 +1,4 @@
-from prometheus_client import start_http_server, Summary, Counter, Gauge
+from prometheus_client import start_http_server, Summary, Counter, Gauge, Histogram
 
 import random
 import time
@@ -30,7 +30,10 @@ message_metrics = {
     "invalid_messages": Counter('invalid_messages', 'Number of invalid messages received'),
     "num_blood_test_results": Counter('blood_test_messages', 'Number of blood test results received'),
     "num_admission_messages_received": Counter('admission_messages', 'Number of admission messages received'),
-    "num_discharge_messages_received": Counter('discharge_messages_received', 'Number of discharge messages received')
+    "num_discharge_messages_received": Counter('discharge_messages_received', 'Number of discharge messages received'),
+    "inflight_messages": Gauge('inflight_messages', 'Number of messages received but not acknowledged yet'),
+    "inflight_wait": Histogram('inflight_wait_seconds', 'Time a received message waited before processing started',
+                               buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)),
 }
 
 def increase_message_received():
@@ -57,13 +60,27 @@ def increase_discharge_message():
     message_metrics['num_discharge_messages_received'].inc()
     return True
 
+def set_inflight_messages(count):
+    message_metrics['inflight_messages'].set(count)
+    return True
+
+def observe_inflight_wait(seconds):
+    message_metrics['inflight_wait'].observe(seconds)
+    return True
+
 
 
 # Connection metrics
 communicator_metrics = {
     "connection_attempts": Counter('connection_attempts', 'Number of connection attempts'),
     "connection_failures": Counter('connection_failures', 'Number of connection failures'),
-    "page_failures": Counter('page_failures', 'Number of page failures')
+    "reconnect_seconds": Histogram('reconnect_seconds', 'Time from losing the MLLP connection to reconnecting',
+                                   buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)),
+    "page_failures": Counter('page_failures', 'Number of page failures'),
+    "page_latency": Histogram('page_latency_seconds', 'Time spent sending one page request'),
+    "page_deadline_exceeded": Counter('page_deadline_exceeded', 'Number of pages not sent within their deadline'),
+    "pager_circuit_state": Gauge('pager_circuit_state', 'State of the pager circuit breaker: 0 closed, 1 half-open, 2 open'),
+    "pager_circuit_rejections": Counter('pager_circuit_rejections', 'Number of pages rejected while the pager circuit was open'),
 }
 
 def increase_connection_attempts():
@@ -74,13 +91,34 @@ def increase_connection_failures():
     communicator_metrics['connection_failures'].inc()
     return True
 
+def observe_reconnect_seconds(seconds):
+    communicator_metrics['reconnect_seconds'].observe(seconds)
+    return True
+
 def increase_page_failures():
     communicator_metrics['page_failures'].inc()
     return True
 
+def observe_page_latency(seconds):
+    communicator_metrics['page_latency'].observe(seconds)
+    return True
+
+def increase_page_deadline_exceeded():
+    communicator_metrics['page_deadline_exceeded'].inc()
+    return True
+
+def set_pager_circuit_state(state):
+    communicator_metrics['pager_circuit_state'].set(state)
+    return True
+
+def increase_pager_circuit_rejections():
+    communicator_metrics['pager_circuit_rejections'].inc()
+    return True
+
 # Prediction metrics
 prediction_metrics = {
     "sum_blood_test_results": Counter('sum_blood_test_results', 'Sum of blood test results'),
+    "num_creatinine_results": Counter('creatinine_results', 'Number of creatinine results received, a panel may carry several'),
     "running_mean_blood_test_results": Gauge('running_mean_blood_test_results', 'Running mean of blood test results'),
     "positive_predictions": Counter('positive_predictions', 'Number of positive predictions'),
     "positive_prediction_rate": Gauge('positive_prediction_rate', 'Positive prediction rate')
@@ -88,12 +126,13 @@ prediction_metrics = {
 
 def increase_sum_blood_test_results(value):
     prediction_metrics['sum_blood_test_results'].inc(value)
+    prediction_metrics['num_creatinine_results'].inc()
     return True
 
 def update_running_mean_blood_test_results():
     prediction_metrics['running_mean_blood_test_results'].set(
             prediction_metrics['sum_blood_test_results']._value.get() 
-            / message_metrics['num_blood_test_results']._value.get())
+            / prediction_metrics['num_creatinine_results']._value.get())
     return True
 
 def increase_positive_predictions():
@@ -114,6 +153,10 @@ database_metrics = {
     "DATABASE_ERROR_invalid_test_results_length": Counter('invalid_test_results_length', 'Number of invalid test results length'),
     "DATABASE_ERROR_multiple_patients_same_mrn": Counter('multiple_patients_same_mrn', 'Number of multiple patients with same mrn'),
     "DATABASE_ERROR_page_nonexistent_patient": Counter('page_non_existent_patient', 'Number of paging for non_existent patient'),
+    "DATABASE_history_load_seconds": Gauge('history_load_seconds', 'Time spent loading the history csv'),
+    "DATABASE_history_rows_per_second": Gauge('history_rows_per_second', 'Test results per second inserted loading the history csv'),
+    "DATABASE_group_commit_messages": Histogram('group_commit_messages', 'Number of messages whose writes were committed in one transaction',
+                                                buckets=(1, 2, 4, 8, 16, 32, 64)),
 }
 
 def increase_DATABASE_file_path_connection_attempts():
@@ -144,6 +187,39 @@ def increase_DATABASE_ERROR_page_nonexistent_patient():
     database_metrics['DATABASE_ERROR_page_non-existent_patient'].inc()
     return True
 
+def set_DATABASE_history_load(seconds, rows_per_second):
+    database_metrics['DATABASE_history_load_seconds'].set(seconds)
+    database_metrics['DATABASE_history_rows_per_second'].set(rows_per_second)
+    return True
+
+def observe_DATABASE_group_commit(messages):
+    database_metrics['DATABASE_group_commit_messages'].observe(messages)
+    return True
+
+### Patient cache metrics
+patient_cache_metrics = {
+    "patient_cache_hits": Counter('patient_cache_hits', 'Number of patient lookups served from the cache'),
+    "patient_cache_misses": Counter('patient_cache_misses', 'Number of patient lookups read from the database'),
+    "patient_cache_evictions": Counter('patient_cache_evictions', 'Number of patients evicted from the cache'),
+    "patient_cache_flushed_rows": Counter('patient_cache_flushed_rows', 'Number of patients whose cached test results were written behind'),
+}
+
+def increase_patient_cache_hits():
+    patient_cache_metrics['patient_cache_hits'].inc()
+    return True
+
+def increase_patient_cache_misses():
+    patient_cache_metrics['patient_cache_misses'].inc()
+    return True
+
+def increase_patient_cache_evictions():
+    patient_cache_metrics['patient_cache_evictions'].inc()
+    return True
+
+def increase_patient_cache_flushed_rows(count):
+    patient_cache_metrics['patient_cache_flushed_rows'].inc(count)
+    return True
+
 ### Preprocessor metrics
 preprocessor_metrics = {
     "num_of_preprocess_failures": Counter('num_of_preprocess_failures', 'Number of preprocess failures'),
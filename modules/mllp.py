@@ -0,0 +1,211 @@
+import array
+import mmap
+from enum import Enum
+
+class MLLPDelimiter(Enum):
+    START_OF_BLOCK = 0x0b
+    END_OF_BLOCK = 0x1c
+    CARRIAGE_RETURN = 0x0d
+
+MLLP_BUFFER_SIZE = 4096
+
+# the delimiters as ints and bytes, looking up the enum members is slow in the frame loop
+START_OF_BLOCK_BYTE = MLLPDelimiter.START_OF_BLOCK.value
+CARRIAGE_RETURN_BYTE = MLLPDelimiter.CARRIAGE_RETURN.value
+START_OF_BLOCK = bytes([MLLPDelimiter.START_OF_BLOCK.value])
+END_OF_BLOCK = bytes([MLLPDelimiter.END_OF_BLOCK.value])
+FRAME_END = bytes([MLLPDelimiter.END_OF_BLOCK.value, MLLPDelimiter.CARRIAGE_RETURN.value])
+
+class MLLPEncodingError(Exception):
+    '''Raised when a buffer or file that must hold nothing but MLLP frames holds anything else.'''
+
+def to_mllp(message):
+    '''Frames an HL7 message, the segments joined by carriage returns, as MLLP.'''
+    return START_OF_BLOCK + message + FRAME_END
+
+def index_frames(buffer, source, start=0):
+    '''Finds the frames of a buffer that holds nothing but MLLP frames, strictly as the simulator sends them.
+
+    The frame boundaries are found with find, the buffer is never copied, so it may be an mmap
+    of a file larger than memory.
+    Args:
+        - buffer (bytes, bytearray or mmap): The frames.
+        - source (str): Where the buffer comes from, for errors.
+        - start (int): Offset of the first frame.
+    Returns:
+        - offsets (array.array): The start and end offsets of the message of every complete frame, without its framing.
+        - consumed (int): Offset one past the last complete frame, the start of an incomplete one.
+    Raises:
+        - MLLPEncodingError: If there is anything else than a frame between two frames.
+    '''
+    offsets = array.array('q')
+    append = offsets.append
+    find = buffer.find
+    position = start
+    end = len(buffer)
+    while position < end:
+        if buffer[position] != START_OF_BLOCK_BYTE:
+            raise MLLPEncodingError(f"{source}: bad MLLP encoding: want {hex(START_OF_BLOCK_BYTE)}, found {hex(buffer[position])}")
+        end_of_block = find(END_OF_BLOCK, position + 1)
+        if end_of_block == -1 or end_of_block + 1 == end:
+            break
+        if buffer[end_of_block + 1] != CARRIAGE_RETURN_BYTE:
+            raise MLLPEncodingError(f"{source}: bad MLLP encoding: want {hex(CARRIAGE_RETURN_BYTE)}, found {hex(buffer[end_of_block + 1])}")
+        append(position + 1)
+        append(end_of_block)
+        position = end_of_block + 2
+    return offsets, position
+
+def decode_frames(buffer, source):
+    '''Returns the messages of the complete frames in the buffer, and the bytes after them, see index_frames.'''
+    offsets, consumed = index_frames(buffer, source)
+    return [buffer[offsets[i]:offsets[i + 1]] for i in range(0, len(offsets), 2)], buffer[consumed:]
+
+class MLLPFile():
+    '''The messages of an MLLP file, such as a replay corpus, read lazily through mmap.
+
+    Opening the file only indexes its frames, the messages are read from the page cache when
+    they are accessed, so a file larger than memory is loaded in the time find takes to scan it.
+    Attributes:
+        - filename (str): The file.
+        - buffer (mmap.mmap): The mapped file, empty bytes for an empty file.
+        - offsets (array.array): The start and end offsets of every message, see index_frames.
+    '''
+    def __init__(self, filename):
+        '''Constructor for the MLLPFile class, raises MLLPEncodingError unless the file holds nothing but complete frames.'''
+        self.filename = filename
+        with open(filename, "rb") as r:
+            # mmap cannot map an empty file
+            self.buffer = mmap.mmap(r.fileno(), 0, access=mmap.ACCESS_READ) if r.seek(0, 2) else b""
+        self.offsets, consumed = index_frames(self.buffer, filename)
+        if consumed != len(self.buffer):
+            self.close()
+            raise MLLPEncodingError(f"{filename}: Unexpected data at end of file")
+
+    def __len__(self):
+        return len(self.offsets) // 2
+
+    def __getitem__(self, i):
+        '''Returns the i-th message, without its framing, as bytes.'''
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("MLLPFile index out of range")
+        return self.buffer[self.offsets[2 * i]:self.offsets[2 * i + 1]]
+
+    def __iter__(self):
+        offsets, buffer = self.offsets, self.buffer
+        for i in range(0, len(offsets), 2):
+            yield buffer[offsets[i]:offsets[i + 1]]
+
+    def frames(self):
+        '''Yields every message framed as MLLP, as received from a feed.'''
+        offsets, buffer = self.offsets, self.buffer
+        for i in range(0, len(offsets), 2):
+            yield buffer[offsets[i] - 1:offsets[i + 1] + 2]
+
+    def close(self):
+        '''Unmaps the file, the messages already read stay valid.'''
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class MLLPFrameDecoder():
+    '''Incremental decoder for MLLP framed messages.
+
+    Bytes are received straight into a preallocated buffer with recv_into, and every
+    complete frame found in the buffer is returned. Bytes following the last complete
+    frame are kept for the next call, so back-to-back frames arriving in one recv are
+    never dropped.
+    Attributes:
+        - buffer (bytearray): The receive buffer, grown only when a single frame does not fit.
+        - start (int): Offset of the first byte that has not been consumed yet.
+        - end (int): Offset one past the last byte received.
+    '''
+    def __init__(self, buffer_size=MLLP_BUFFER_SIZE):
+        '''Constructor for the MLLPFrameDecoder class.'''
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def reset(self):
+        '''Discards any buffered bytes, e.g. after reconnecting.'''
+        self.start = 0
+        self.end = 0
+
+    def pending(self):
+        '''Returns the number of buffered bytes that are not part of a returned frame.'''
+        return self.end - self.start
+
+    def _reserve(self):
+        '''Makes room at the end of the buffer, compacting before growing it.'''
+        if self.end < len(self.buffer):
+            return
+        if self.start > 0:
+            remaining = self.end - self.start
+            self.view[:remaining] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = remaining
+            return
+        # a single frame is larger than the buffer, double it
+        self.view.release()
+        self.buffer.extend(bytes(len(self.buffer)))
+        self.view = memoryview(self.buffer)
+
+    def recv_from(self, sock):
+        '''Receives from the socket directly into the free part of the buffer.
+
+        Returns:
+            - received (int): The number of bytes received, 0 if the peer closed the connection.
+        '''
+        self._reserve()
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        '''Copies already received bytes into the buffer.'''
+        data = memoryview(data)
+        while len(data) > 0:
+            self._reserve()
+            n = min(len(data), len(self.buffer) - self.end)
+            self.view[self.end:self.end + n] = data[:n]
+            self.end += n
+            data = data[n:]
+
+    def next_frame(self):
+        '''Returns the next complete frame in the buffer, or None if there is none yet.
+
+        A frame runs from the START_OF_BLOCK byte up to and including END_OF_BLOCK and the
+        trailing CARRIAGE_RETURN when it has been received. Bytes before a START_OF_BLOCK
+        are not part of any frame and are skipped.
+        '''
+        start_of_block = self.buffer.find(MLLPDelimiter.START_OF_BLOCK.value, self.start, self.end)
+        if start_of_block == -1:
+            self.start = self.end
+            return None
+        self.start = start_of_block
+        end_of_block = self.buffer.find(MLLPDelimiter.END_OF_BLOCK.value, start_of_block, self.end)
+        if end_of_block == -1:
+            return None
+        frame_end = end_of_block + 1
+        if frame_end < self.end and self.buffer[frame_end] == MLLPDelimiter.CARRIAGE_RETURN.value:
+            frame_end += 1
+        frame = bytes(self.view[start_of_block:frame_end])
+        self.start = frame_end
+        if self.start == self.end:
+            self.start = self.end = 0
+        return frame
+
+    def frames(self):
+        '''Yields every complete frame currently in the buffer.'''
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+
+from mllp import MLLPEncodingError, MLLPFile, decode_frames, to_mllp
+
+ADT_A03 = b"MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331035800||ADT^A03|||2.5\rPID|1||829339\r"
+ORU_R01 = b"MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331113300||ORU^R01|||2.5\rPID|1||257406\rOBR|1||||||20240331113300\rOBX|1|SN|CREATININE||92.95579346699137\r"
+
+class DecodeFramesTest(unittest.TestCase):
+    def test_partial_frame_remains(self):
+        buffer = to_mllp(ADT_A03) + to_mllp(ORU_R01)[:-1]
+        self.assertEqual(decode_frames(buffer, "test"), ([ADT_A03], to_mllp(ORU_R01)[:-1]))
+        self.assertEqual(decode_frames(b"", "test"), ([], b""))
+
+    def test_bad_encoding(self):
+        self.assertRaises(MLLPEncodingError, decode_frames, b"x" + to_mllp(ADT_A03), "test")
+        self.assertRaises(MLLPEncodingError, decode_frames, to_mllp(ADT_A03)[:-1] + b"x", "test")
+
+class MLLPFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "messages.mllp")
+
+    def tearDown(self):
+        os.remove(self.filename)
+        os.rmdir(self.directory)
+
+    def write(self, data):
+        with open(self.filename, "wb") as w:
+            w.write(data)
+
+    def test_messages(self):
+        self.write(to_mllp(ADT_A03) + to_mllp(ORU_R01) + to_mllp(ADT_A03))
+        with MLLPFile(self.filename) as messages:
+            self.assertEqual(len(messages), 3)
+            self.assertEqual(list(messages), [ADT_A03, ORU_R01, ADT_A03])
+            self.assertEqual(messages[-2], ORU_R01)
+            self.assertRaises(IndexError, messages.__getitem__, 3)
+            self.assertEqual(list(messages.frames())[1], to_mllp(ORU_R01))
+
+    def test_empty_file(self):
+        self.write(b"")
+        with MLLPFile(self.filename) as messages:
+            self.assertEqual(list(messages), [])
+
+    def test_unexpected_data_at_end(self):
+        self.write(to_mllp(ADT_A03) + to_mllp(ORU_R01)[:10])
+        self.assertRaises(MLLPEncodingError, MLLPFile, self.filename)
+
+if __name__ == "__main__":
+    unittest.main()
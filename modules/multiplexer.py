@@ -0,0 +1,233 @@
+import collections
+import os
+import selectors
+import socket
+import time
+
+import modules.metrics_monitoring as monitoring
+from modules.communicator import Communicator, ReconnectBackoff, apply_socket_options, MLLP_BUFFER_SIZE, SOCKET_OPTIONS
+from modules.module_logging import communicatior_logger
+
+MULTIPLEXER_POLL_SECONDS = 1
+MLLP_LISTEN_BACKLOG = 128
+
+class MLLPMultiplexer():
+    '''Receives HL7 messages from several MLLP connections on one selector.
+
+    Every feed is a Communicator with its own socket, framing buffer and ACK encoder.
+    Feeds are either dialled out to MLLP servers, or accepted from senders connecting to
+    a listening port. Connections are opened without blocking and a dialled feed that is
+    down is redialled with its own backoff, so an outage of one feed never stalls the others,
+    while an accepted feed is dropped when its sender disconnects. Complete frames are
+    returned one at a time, taking turns between the feeds that have some, and each feed
+    in the order it received them.
+    Attributes:
+        - feeds (list): The Communicator of each MLLP server dialled out to.
+        - inbound (set): The Communicator of each connection accepted from a sender.
+        - listeners (list): The listening sockets.
+        - ready (collections.deque): The feeds that may have complete frames in their decoder.
+        - redials (dict): The monotonic time each disconnected feed is redialled at.
+        - outages (dict): The monotonic time each feed that is not connected was lost at.
+    '''
+    def __init__(self, mllp_addresses=(), socket_options=None, echo_control_id=False, poll_interval=MULTIPLEXER_POLL_SECONDS):
+        '''Constructor for the MLLPMultiplexer class, starts connecting to every feed.'''
+        self.selector = selectors.DefaultSelector()
+        self.socket_options = dict(SOCKET_OPTIONS, **(socket_options or {}))
+        self.echo_control_id = echo_control_id
+        self.listeners = []
+        self.inbound = set()
+        # lets another thread interrupt select, see wakeup
+        self.waker, self.wakee = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wakee.setblocking(False)
+        self.selector.register(self.wakee, selectors.EVENT_READ, None)
+        self.poll_interval = poll_interval
+        self.ready = collections.deque()
+        self.redials = {}
+        self.backoffs = {}
+        self.last_received = {}
+        self.outages = {}
+        self.feeds = []
+        for mllp_address in mllp_addresses:
+            feed = Communicator(socket_options=self.socket_options, echo_control_id=echo_control_id)
+            feed.mllp_address = mllp_address.replace("https://", "").replace("http://", "")
+            feed.host, feed.port = feed.mllp_address.split(":")
+            self.feeds.append(feed)
+            self.dial(feed)
+
+    def listen(self, listen_address):
+        '''
+        Accepts MLLP connections from senders on the address, as many as they open.
+        Args:
+            - listen_address (str): The host:port to listen on, an empty host listens on all interfaces.
+        '''
+        host, port = listen_address.rsplit(":", 1)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, int(port)))
+        listener.listen(MLLP_LISTEN_BACKLOG)
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ, None)
+        self.listeners.append(listener)
+        communicatior_logger('INFO', f"Listening for MLLP connections on {host}:{port}")
+        print(f"Listening for MLLP connections on {host}:{port}")
+
+    def accept(self, listener):
+        '''Accepts a pending connection on the listening socket as a new feed.'''
+        try:
+            client, (host, port) = listener.accept()
+        except BlockingIOError:
+            return None
+        feed = Communicator(socket_options=self.socket_options, echo_control_id=self.echo_control_id)
+        feed.host, feed.port = host, port
+        feed.socket = client
+        apply_socket_options(client, self.socket_options)
+        client.setblocking(True)
+        self.selector.register(client, selectors.EVENT_READ, feed)
+        self.inbound.add(feed)
+        self.last_received[feed] = time.monotonic()
+        communicatior_logger('INFO', f"Accepted MLLP connection from {host}:{port}.")
+        monitoring.increase_connection_attempts()
+
+    def dial(self, feed):
+        '''Starts connecting the feed, the selector reports its socket writable once connected.'''
+        communicatior_logger('INFO', f"Attempting to connect to {feed.host}:{feed.port}...")
+        self.outages.setdefault(feed, time.monotonic())
+        try:
+            feed.open(blocking=False)
+            self.selector.register(feed.socket, selectors.EVENT_WRITE, feed)
+        except OSError as e:
+            self.redial(feed, e)
+
+    def disconnect(self, feed):
+        '''Closes the connection of the feed, dropping the frame it was receiving.'''
+        if feed.socket is not None:
+            self.selector.unregister(feed.socket)
+        feed.close_socket()
+        self.last_received.pop(feed, None)
+        if feed in self.ready:
+            self.ready.remove(feed)
+
+    def redial(self, feed, error=None):
+        '''Closes the connection of the feed and, if it was dialled out, schedules the next attempt with its backoff.'''
+        self.disconnect(feed)
+        if feed in self.inbound:
+            self.inbound.remove(feed)
+            if error is not None:
+                communicatior_logger('ERROR', f"Error occurred on MLLP connection from {feed.host}:{feed.port}: {error}")
+            communicatior_logger('INFO', f"MLLP connection from {feed.host}:{feed.port} closed.")
+            return None
+        backoff = self.backoffs.setdefault(feed, ReconnectBackoff())
+        retry_delay = backoff.next_delay()
+        if error is not None:
+            communicatior_logger('ERROR', f"Error occurred on MLLP server {feed.host}:{feed.port}: {error}")
+            print(f"Error occurred on MLLP server {feed.host}:{feed.port}: {error}, retrying in {retry_delay:.3f} seconds...")
+            monitoring.increase_connection_failures()
+        self.redials[feed] = time.monotonic() + retry_delay
+
+    def receive(self):
+        '''Receives the next message from any feed, waiting at most the poll interval for one.
+
+        Returns:
+            - feed (Communicator): The feed the message arrived on, to acknowledge it on.
+            - message (bytes): The message received, or None if no message is complete yet.
+        '''
+        if not self.ready:
+            self.poll()
+        while self.ready:
+            feed = self.ready.popleft()
+            message = feed.decoder.next_frame()
+            if message is not None:
+                # the feed goes to the back, so a busy feed does not starve the others
+                self.ready.append(feed)
+                return feed, message
+        return None, None
+
+    def poll(self):
+        '''Redials the feeds that are due and receives from every readable connection.'''
+        now = time.monotonic()
+        for feed, redial_at in list(self.redials.items()):
+            if redial_at <= now:
+                del self.redials[feed]
+                self.dial(feed)
+        read_timeout = self.socket_options["read_timeout"]
+        if read_timeout is not None:
+            for feed, last_received in list(self.last_received.items()):
+                if now - last_received > read_timeout:
+                    self.redial(feed, TimeoutError("no data within the read timeout"))
+        timeout = min([self.poll_interval] + [redial_at - now for redial_at in self.redials.values()])
+        for key, events in self.selector.select(max(timeout, 0)):
+            feed = key.data
+            if key.fileobj is self.wakee:
+                self.wakee.recv(MLLP_BUFFER_SIZE)
+                continue
+            if feed is None:
+                self.accept(key.fileobj)
+                continue
+            if events & selectors.EVENT_WRITE:
+                self.connected(feed)
+                continue
+            try:
+                received = feed.decoder.recv_from(feed.socket)
+            except OSError as e:
+                self.redial(feed, e)
+                continue
+            if received == 0:
+                monitoring.increase_null_messages()
+                self.redial(feed)
+                continue
+            self.last_received[feed] = time.monotonic()
+            if feed not in self.ready:
+                self.ready.append(feed)
+
+    def connected(self, feed):
+        '''Completes a non-blocking connect, the socket blocks from then on so ACKs are sent in full.'''
+        error = feed.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error != 0:
+            self.redial(feed, OSError(error, os.strerror(error)))
+            return None
+        feed.socket.setblocking(True)
+        self.selector.modify(feed.socket, selectors.EVENT_READ, feed)
+        self.backoffs.pop(feed, None)
+        self.last_received[feed] = time.monotonic()
+        communicatior_logger('INFO', f"Connected to MLLP server at {feed.host}:{feed.port}.")
+        print(f"Connected to MLLP server at {feed.host}:{feed.port}.")
+        monitoring.increase_connection_attempts()
+        monitoring.observe_reconnect_seconds(time.monotonic() - self.outages.pop(feed))
+
+    def wakeup(self):
+        '''Makes a poll that is waiting in select return, may be called from any thread.'''
+        try:
+            self.waker.send(b"\0")
+        except BlockingIOError:
+            # a wakeup is pending already
+            pass
+
+    def acknowledge(self, feed, accept=True, message=None, connection=None):
+        '''Acknowledges the message on the feed it arrived on, redialling the feed if it was lost.
+
+        Args:
+            - feed (Communicator): The feed the message arrived on.
+            - accept (bool): Whether to send AA or AE.
+            - message (bytes): The acknowledged message.
+            - connection (socket.socket): The socket the message arrived on, if the feed may have
+              reconnected since. The ACK is dropped if it has, the sender sends the message again.
+        '''
+        if feed.socket is None or (connection is not None and feed.socket is not connection):
+            communicatior_logger('ERROR', f"Connection to {feed.host}:{feed.port} closed before the message could be acknowledged")
+            return None
+        try:
+            feed.acknowledge(accept, message)
+        except OSError as e:
+            self.redial(feed, e)
+
+    def close(self):
+        '''Closes the connections to every feed and the listening sockets.'''
+        for feed in self.feeds + list(self.inbound):
+            self.disconnect(feed)
+        for listener in self.listeners:
+            self.selector.unregister(listener)
+            listener.close()
+        self.selector.close()
+        self.waker.close()
+        self.wakee.close()
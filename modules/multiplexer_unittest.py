@@ -0,0 +1,142 @@
+import socket
+import threading
+import time
+import unittest
+
+from multiplexer import MLLPMultiplexer
+
+ADT_A01 = b"\x0bMSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||202401201630||ADT^A01|||2.5\rPID|1||%d||ELIZABETH HOLMES||19840203|F\r\x1c\r"
+
+class MLLPMultiplexerTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+        for _ in range(2):
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.bind(("localhost", 0))
+            server.listen(1)
+            server.settimeout(5)
+            self.servers.append(server)
+        # nothing listens on the last feed
+        addresses = [f"localhost:{server.getsockname()[1]}" for server in self.servers] + ["localhost:1"]
+        self.feeds = MLLPMultiplexer(addresses, poll_interval=0.05)
+        self.clients = []
+        for server in self.servers:
+            self.clients.append(server.accept()[0])
+
+    def tearDown(self):
+        self.feeds.close()
+        for s in self.clients + self.servers:
+            s.close()
+
+    def receive(self, count):
+        received = []
+        deadline = time.time() + 5
+        while len(received) < count and time.time() < deadline:
+            feed, message = self.feeds.receive()
+            if message is not None:
+                received.append((self.feeds.feeds.index(feed), message))
+                self.feeds.acknowledge(feed, True, message)
+        return received
+
+    def test_receives_from_every_feed_in_order(self):
+        self.clients[0].sendall(ADT_A01 % 1 + ADT_A01 % 2)
+        self.clients[1].sendall(ADT_A01 % 3)
+        received = self.receive(3)
+        self.assertEqual([m for f, m in received if f == 0], [ADT_A01 % 1, ADT_A01 % 2])
+        self.assertEqual([m for f, m in received if f == 1], [ADT_A01 % 3])
+        # every feed gets the ACKs of its own messages
+        for client, count in zip(self.clients, (2, 1)):
+            client.settimeout(5)
+            acks = b""
+            while acks.count(b"\x1c\r") < count:
+                acks += client.recv(1024)
+            self.assertEqual(acks.count(b"MSA|AA"), count)
+
+    def test_reconnects_closed_feed(self):
+        self.clients[0].close()
+        self.servers[0].settimeout(0.05)
+        for _ in range(100):
+            # the feed is redialled while receiving
+            self.feeds.receive()
+            try:
+                self.clients[0], _ = self.servers[0].accept()
+                break
+            except TimeoutError:
+                pass
+        self.clients[0].sendall(ADT_A01 % 4)
+        self.assertEqual(self.receive(1), [(0, ADT_A01 % 4)])
+
+    def test_wakeup_interrupts_poll(self):
+        self.feeds.poll_interval = 5
+        timer = threading.Timer(0.05, self.feeds.wakeup)
+        timer.start()
+        start = time.time()
+        try:
+            self.assertEqual(self.feeds.receive(), (None, None))
+            self.assertLess(time.time() - start, 1)
+        finally:
+            # the wakeup must not run after tearDown closes the feeds
+            timer.join()
+
+    def test_ack_dropped_after_reconnect(self):
+        self.clients[0].sendall(ADT_A01 % 5)
+        (_, message), = self.receive_unacknowledged(1)
+        feed = self.feeds.feeds[0]
+        connection = feed.socket
+        self.feeds.redial(feed)
+        self.servers[0].settimeout(0.05)
+        while feed.socket is None or feed.socket is connection or feed not in self.feeds.last_received:
+            self.feeds.receive()
+        client, _ = self.servers[0].accept()
+        # the ACK does not go to the new connection
+        self.feeds.acknowledge(feed, True, message, connection)
+        client.settimeout(0.1)
+        self.assertRaises(TimeoutError, client.recv, 1024)
+        client.close()
+
+    def receive_unacknowledged(self, count):
+        received = []
+        deadline = time.time() + 5
+        while len(received) < count and time.time() < deadline:
+            feed, message = self.feeds.receive()
+            if message is not None:
+                received.append((feed, message))
+        return received
+
+class MLLPListenerTest(unittest.TestCase):
+    def setUp(self):
+        self.feeds = MLLPMultiplexer(poll_interval=0.05)
+        self.feeds.listen("localhost:0")
+        self.port = self.feeds.listeners[0].getsockname()[1]
+
+    def tearDown(self):
+        self.feeds.close()
+
+    def test_many_senders(self):
+        senders = [socket.create_connection(("localhost", self.port)) for _ in range(50)]
+        for i, sender in enumerate(senders):
+            # split frames are reassembled per connection
+            frame = ADT_A01 % i
+            sender.sendall(frame[:20])
+        for i, sender in enumerate(senders):
+            sender.sendall((ADT_A01 % i)[20:])
+        received = {}
+        deadline = time.time() + 5
+        while len(received) < len(senders) and time.time() < deadline:
+            feed, message = self.feeds.receive()
+            if message is not None:
+                received[feed] = message
+                self.feeds.acknowledge(feed, True, message)
+        self.assertEqual(sorted(received.values()), sorted(ADT_A01 % i for i in range(50)))
+        for sender in senders:
+            sender.settimeout(5)
+            self.assertIn(b"MSA|AA", sender.recv(1024))
+            sender.close()
+        # closed senders are dropped, not redialled
+        while self.feeds.inbound and time.time() < deadline:
+            self.feeds.receive()
+        self.assertEqual(self.feeds.inbound, set())
+        self.assertEqual(self.feeds.redials, {})
+
+if __name__ == "__main__":
+    unittest.main()
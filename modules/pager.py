@@ -0,0 +1,398 @@
+import heapq
+import http
+import math
+import http.client
+import queue
+import random
+import socket
+import threading
+import time
+from enum import Enum
+
+import modules.metrics_monitoring as monitoring
+from modules.module_logging import communicatior_logger
+
+class PagerAPI(Enum):
+    PAGE = "/page"
+    SHUTDOWN = "/shutdown"
+
+PAGER_POOL_SIZE = 4
+PAGER_WORKERS = 2
+# time budget for one page attempt, from connecting to reading the whole response
+PAGER_TIMEOUT_SECONDS = 2
+# the circuit opens after this many consecutive failed or slow pages
+PAGER_FAILURE_THRESHOLD = 3
+PAGER_SLOW_CALL_SECONDS = 1
+# how long an open circuit fails fast before letting one probe through
+PAGER_RESET_SECONDS = 5
+PAGE_RETRY_BASE_SECONDS = 0.25
+PAGE_RETRY_MAX_SECONDS = 30
+# a positive that is still not paged this long after detection is escalated
+PAGE_DEADLINE_SECONDS = 300
+
+class CircuitState(Enum):
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+class CircuitOpenError(Exception):
+    '''Raised instead of calling the Pager server while the circuit is open.'''
+
+class CircuitBreaker():
+    '''Circuit breaker that stops calling an unhealthy Pager server.
+
+    The circuit opens after failure_threshold consecutive calls that raised, returned a
+    server error, or took longer than slow_call_seconds. While open every call fails fast
+    with CircuitOpenError. After reset_seconds one probe call is let through (half-open):
+    if it succeeds the circuit closes again, otherwise it opens for another reset_seconds.
+    Attributes:
+        - state (CircuitState): The current state of the circuit.
+        - failures (int): The number of consecutive failed or slow calls.
+    '''
+    def __init__(self, failure_threshold=PAGER_FAILURE_THRESHOLD, slow_call_seconds=PAGER_SLOW_CALL_SECONDS, reset_seconds=PAGER_RESET_SECONDS):
+        '''Constructor for the CircuitBreaker class.'''
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_seconds = reset_seconds
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.lock = threading.Lock()
+        monitoring.set_pager_circuit_state(self.state.value)
+
+    def _set_state(self, state):
+        if state != self.state:
+            communicatior_logger('WARNING', f"Pager circuit {self.state.name} -> {state.name}")
+            self.state = state
+            monitoring.set_pager_circuit_state(state.value)
+
+    def _before_call(self):
+        '''Decides whether a call may go through, raising CircuitOpenError if not.'''
+        with self.lock:
+            if self.state == CircuitState.OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self._set_state(CircuitState.HALF_OPEN)
+            if self.state == CircuitState.CLOSED:
+                return None
+            if self.state == CircuitState.HALF_OPEN and not self.probing:
+                self.probing = True
+                return None
+        monitoring.increase_pager_circuit_rejections()
+        raise CircuitOpenError(f"Pager circuit is {self.state.name}")
+
+    def _after_call(self, healthy):
+        '''Records the outcome of a call that went through.'''
+        with self.lock:
+            self.probing = False
+            if healthy:
+                self.failures = 0
+                self._set_state(CircuitState.CLOSED)
+                return None
+            self.failures += 1
+            if self.state == CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state(CircuitState.OPEN)
+
+    def call(self, fn, *args):
+        '''Calls fn(*args) through the circuit and returns its response.'''
+        self._before_call()
+        start = time.monotonic()
+        try:
+            response = fn(*args)
+        except Exception:
+            self._after_call(False)
+            raise
+        slow = time.monotonic() - start > self.slow_call_seconds
+        self._after_call(not slow and response.status < http.HTTPStatus.INTERNAL_SERVER_ERROR)
+        return response
+
+class DeadlineSocket(socket.socket):
+    '''Socket of a Pager connection whose every blocking call waits only for the time left before its deadline.
+
+    A socket timeout bounds each recv on its own, so a server trickling its response one byte at a
+    time would keep an attempt going well past its budget.
+    Attributes:
+        - deadline (float): The time.monotonic() by which the current request must be done.
+    '''
+    deadline = None
+
+    @classmethod
+    def wrap(cls, sock, deadline):
+        '''Returns a DeadlineSocket taking over the connected socket.'''
+        wrapped = cls(sock.family, sock.type, sock.proto, fileno=sock.detach())
+        wrapped.deadline = deadline
+        return wrapped
+
+    def _settimeout_remaining(self):
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Pager request exceeded its time budget")
+        self.settimeout(remaining)
+
+    def recv_into(self, *args):
+        self._settimeout_remaining()
+        return super().recv_into(*args)
+
+    def recv(self, *args):
+        self._settimeout_remaining()
+        return super().recv(*args)
+
+    def sendall(self, *args):
+        self._settimeout_remaining()
+        return super().sendall(*args)
+
+class PagerConnection(http.client.HTTPConnection):
+    '''HTTP connection to the Pager server whose reads and writes all share the deadline of the request, see DeadlineSocket.'''
+    deadline = None
+
+    def connect(self):
+        super().connect()
+        self.sock = DeadlineSocket.wrap(self.sock, self.deadline)
+
+class PagerClient():
+    '''HTTP client for the Pager server that keeps a pool of keep-alive connections.
+
+    Connections are reused across pages as long as the server keeps them open, so a page
+    does not pay for a new TCP connection every time.
+    Attributes:
+        - host (str): The host of the Pager server.
+        - port (int): The port of the Pager server.
+        - timeout (float): Time budget in seconds for one request, from connecting to reading the response.
+    '''
+    def __init__(self, pager_address, pool_size=PAGER_POOL_SIZE, timeout=PAGER_TIMEOUT_SECONDS):
+        '''Constructor for the PagerClient class.'''
+        pager_address = pager_address.replace("https://", "").replace("http://", "")
+        host, port = pager_address.split(":")
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _acquire(self):
+        '''Returns an idle pooled connection, or a new one if the pool is empty.'''
+        try:
+            return self.pool.get_nowait(), True
+        except queue.Empty:
+            return PagerConnection(self.host, self.port, timeout=self.timeout), False
+
+    def _release(self, conn):
+        '''Returns a connection to the pool, closing it if the pool is full.'''
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, method, path, body=None):
+        '''Sends a request on a pooled connection and reads the whole response.
+
+        A pooled connection may have been closed by the server while idle, in which case
+        the request is retried once on a fresh connection. The whole request, including that
+        retry, has to finish within the time budget or TimeoutError is raised, however slowly
+        the server sends its response.
+        Returns:
+            - response (http.client.HTTPResponse): The response, with its body already read.
+        '''
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn, reused = self._acquire()
+            try:
+                # connecting waits for the time left, every later send and recv too, see DeadlineSocket
+                conn.timeout = self._remaining(deadline)
+                conn.deadline = deadline
+                if conn.sock is not None:
+                    conn.sock.deadline = deadline
+                conn.request(method, path, body=body, headers={"Content-Type": "text/plain"})
+                response = conn.getresponse()
+                response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            return response
+
+    def _remaining(self, deadline):
+        '''Returns the time left before the deadline, raising TimeoutError if there is none.'''
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Pager request exceeded its {self.timeout}s budget")
+        return remaining
+
+    def page(self, mrn, timestamp=None):
+        '''Sends a page request to the Pager server.
+
+        Args:
+            - mrn (str): The medical record number of the patient to page.
+            - timestamp (str): The timestamp of the message.
+        Returns:
+            - response (http.client.HTTPResponse): The response of the Pager server.
+        '''
+        request = str(mrn)
+        if timestamp is not None:
+            request = f"{mrn},{timestamp}"
+        return self.request("POST", PagerAPI.PAGE.value, body=bytes(request, "ascii"))
+
+    def close(self):
+        '''Closes every pooled connection.'''
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return None
+
+class PagerDispatcher():
+    '''Pages patients from background worker threads.
+
+    Workers drain the page queue and report each attempt on the completed queue as
+    (mrn, timestamp, success). The owner of the database drains completed_pages() and
+    records the outcome, so the database is never touched from a worker thread.
+    Attributes:
+        - page_queue (queue.Queue): The (mrn, timestamp) pairs waiting to be paged.
+        - completed (queue.Queue): The outcome of every page attempt.
+    '''
+    def __init__(self, page, page_queue, workers=PAGER_WORKERS, on_complete=None):
+        '''Constructor for the PagerDispatcher class.
+
+        Args:
+            - page (callable): Sends one page, page(mrn, timestamp), returning the response or None.
+            - page_queue (queue.Queue): The queue to drain.
+            - workers (int): The number of worker threads.
+            - on_complete (callable): Called from the worker with (mrn, timestamp, success)
+                instead of putting the outcome on the completed queue.
+        '''
+        self.page = page
+        self.page_queue = page_queue
+        self.completed = queue.Queue()
+        self.on_complete = on_complete if on_complete is not None else self.report
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self.work, name=f"pager-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def work(self):
+        '''Worker loop: pages queued patients forever.'''
+        while True:
+            mrn, timestamp = self.page_queue.get()
+            try:
+                start = time.perf_counter()
+                r = self.page(mrn, timestamp)
+                monitoring.observe_page_latency(time.perf_counter() - start)
+                success = r is not None and r.status == http.HTTPStatus.OK
+                self.on_complete(mrn, timestamp, success)
+            except Exception as e:
+                # the worker carries on, a dead worker would silently stop paging
+                communicatior_logger('ERROR', f"Pager worker failed on the page for MRN {mrn}: {e}")
+            finally:
+                self.page_queue.task_done()
+
+    def report(self, mrn, timestamp, success):
+        '''Default completion callback, queues the outcome for completed_pages().'''
+        self.completed.put((mrn, timestamp, success))
+
+    def completed_pages(self):
+        '''Yields the outcome of every page attempt finished since the last call, without blocking.'''
+        while True:
+            try:
+                yield self.completed.get_nowait()
+            except queue.Empty:
+                return None
+
+class PageRetryScheduler():
+    '''Retries failed pages on its own timer with exponential backoff and jitter.
+
+    Pending pages are kept in a heap ordered by their next attempt and handed to the page
+    queue when due, from a background thread, so a failed page is retried even if no new
+    message arrives. Outcomes are reported through events() as (event, mrn, timestamp,
+    attempts, next_attempt) with event one of 'paged', 'retry' or 'expired', so the owner of
+    the database can persist them. A page past its deadline is reported as 'expired' once
+    and keeps being retried.
+    Attributes:
+        - page_queue (queue.Queue): The queue drained by the pager workers.
+        - base_delay (float): The delay before the first retry, in seconds.
+        - max_delay (float): The maximum delay between retries, in seconds.
+        - deadline (float): The time allowed from detection to page, in seconds.
+    '''
+    def __init__(self, page_queue, base_delay=PAGE_RETRY_BASE_SECONDS, max_delay=PAGE_RETRY_MAX_SECONDS, deadline=PAGE_DEADLINE_SECONDS):
+        '''Constructor for the PageRetryScheduler class.'''
+        self.page_queue = page_queue
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.heap = []
+        # mrn -> [timestamp, created, attempts, expired]
+        self.pages = {}
+        self.condition = threading.Condition()
+        self.outcomes = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="pager-scheduler", daemon=True)
+        self.thread.start()
+
+    def schedule(self, mrn, timestamp, created=None, attempts=0, next_attempt=None):
+        '''Schedules a page, immediately unless next_attempt is given.
+
+        Args:
+            - mrn (str): The medical record number of the patient to page.
+            - timestamp (str): The timestamp of the message that was detected positive.
+            - created (float): When the positive was detected, in seconds since the epoch.
+            - attempts (int): The number of failed attempts so far, when resuming after a restart.
+            - next_attempt (float): When to send the page, in seconds since the epoch.
+        '''
+        now = time.time()
+        mrn = str(mrn)
+        with self.condition:
+            if mrn in self.pages:
+                return None
+            created = now if created is None else created
+            self.pages[mrn] = [timestamp, created, attempts, False]
+            heapq.heappush(self.heap, (now if next_attempt is None else next_attempt, mrn))
+            self.condition.notify()
+
+    def backoff(self, attempts):
+        '''Returns the delay before the next attempt, exponential in attempts with equal jitter.'''
+        # the exponent stops growing once the delay is capped, a long outage would overflow the float
+        exponent = min(attempts - 1, math.ceil(math.log2(self.max_delay / self.base_delay)))
+        delay = min(self.max_delay, self.base_delay * (2 ** exponent))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def on_complete(self, mrn, timestamp, success):
+        '''Completion callback for the pager workers.'''
+        mrn = str(mrn)
+        now = time.time()
+        with self.condition:
+            if success:
+                self.pages.pop(mrn, None)
+                self.outcomes.put(('paged', mrn, timestamp, None, None))
+                return None
+            page = self.pages[mrn]
+            page[2] += 1
+            attempts = page[2]
+            next_attempt = now + self.backoff(attempts)
+            if not page[3] and now - page[1] > self.deadline:
+                page[3] = True
+                self.outcomes.put(('expired', mrn, timestamp, attempts, next_attempt))
+            heapq.heappush(self.heap, (next_attempt, mrn))
+            self.outcomes.put(('retry', mrn, timestamp, attempts, next_attempt))
+            self.condition.notify()
+
+    def run(self):
+        '''Scheduler loop: hands every page to the pager workers when it is due.'''
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.time():
+                    timeout = self.heap[0][0] - time.time() if self.heap else None
+                    self.condition.wait(timeout)
+                _, mrn = heapq.heappop(self.heap)
+                timestamp = self.pages[mrn][0]
+            self.page_queue.put((mrn, timestamp))
+
+    def events(self):
+        '''Yields every outcome reported since the last call, without blocking.'''
+        while True:
+            try:
+                yield self.outcomes.get_nowait()
+            except queue.Empty:
+                return None
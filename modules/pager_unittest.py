@@ -0,0 +1,187 @@
+import http
+import http.server
+import queue
+import threading
+import time
+import unittest
+
+from pager import PagerClient, PagerDispatcher, PageRetryScheduler, CircuitBreaker, CircuitOpenError, CircuitState
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append((body, self.client_address))
+        if body == b"0":
+            # a hung pager
+            time.sleep(1)
+        if body == b"1":
+            # a pager trickling its response, each byte well within the time budget
+            self.send_response(http.HTTPStatus.OK)
+            self.send_header("Content-Length", "20")
+            self.end_headers()
+            for _ in range(20):
+                self.wfile.write(b"x")
+                self.wfile.flush()
+                time.sleep(0.05)
+            return None
+        status = http.HTTPStatus.OK if body.split(b",")[0].isdigit() else http.HTTPStatus.BAD_REQUEST
+        self.send_response(status)
+        self.send_header("Content-Length", "3")
+        self.end_headers()
+        self.wfile.write(b"ok\n")
+
+    def log_message(*args):
+        pass
+
+class PagerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("localhost", 0), KeepAliveHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.client = PagerClient(f"localhost:{self.server.server_address[1]}")
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_page_reuses_connection(self):
+        r = self.client.page("1234", "20240331113300")
+        self.assertEqual(r.status, http.HTTPStatus.OK)
+        r = self.client.page(5678)
+        self.assertEqual(r.status, http.HTTPStatus.OK)
+        bodies = [body for body, _ in self.server.requests]
+        self.assertEqual(bodies, [b"1234,20240331113300", b"5678"])
+        # both requests arrived from the same client port
+        self.assertEqual(self.server.requests[0][1], self.server.requests[1][1])
+
+    def test_bad_request(self):
+        r = self.client.page("NHS1234")
+        self.assertEqual(r.status, http.HTTPStatus.BAD_REQUEST)
+
+    def test_time_budget(self):
+        client = PagerClient(f"localhost:{self.server.server_address[1]}", timeout=0.2)
+        start = time.monotonic()
+        self.assertRaises(TimeoutError, client.page, "0")
+        self.assertLess(time.monotonic() - start, 0.5)
+        client.close()
+
+    def test_time_budget_slow_response(self):
+        client = PagerClient(f"localhost:{self.server.server_address[1]}", timeout=0.2)
+        start = time.monotonic()
+        self.assertRaises(TimeoutError, client.page, "1")
+        self.assertLess(time.monotonic() - start, 0.5)
+        client.close()
+
+    def test_dispatcher_reports_completion(self):
+        page_queue = queue.Queue()
+        dispatcher = PagerDispatcher(self.client.page, page_queue, workers=2)
+        page_queue.put(("1", "20240331113300"))
+        page_queue.put(("2", "20240331113300"))
+        page_queue.join()
+        completed = sorted(dispatcher.completed_pages())
+        self.assertEqual(completed, [("1", "20240331113300", True), ("2", "20240331113300", True)])
+
+class FakeResponse():
+    def __init__(self, status):
+        self.status = status
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=2, slow_call_seconds=0.05, reset_seconds=0.1)
+
+    def fail(self):
+        raise ConnectionRefusedError()
+
+    def test_opens_after_consecutive_failures(self):
+        self.assertRaises(ConnectionRefusedError, self.breaker.call, self.fail)
+        self.assertEqual(self.breaker.state, CircuitState.CLOSED)
+        self.assertRaises(ConnectionRefusedError, self.breaker.call, self.fail)
+        self.assertEqual(self.breaker.state, CircuitState.OPEN)
+        # fails fast without calling the pager
+        self.assertRaises(CircuitOpenError, self.breaker.call, lambda: self.fail())
+
+    def test_server_errors_and_slow_calls_count_as_failures(self):
+        self.breaker.call(lambda: FakeResponse(http.HTTPStatus.INTERNAL_SERVER_ERROR))
+        self.breaker.call(lambda: time.sleep(0.06) or FakeResponse(http.HTTPStatus.OK))
+        self.assertEqual(self.breaker.state, CircuitState.OPEN)
+
+    def test_bad_request_keeps_circuit_closed(self):
+        for _ in range(3):
+            self.breaker.call(lambda: FakeResponse(http.HTTPStatus.BAD_REQUEST))
+        self.assertEqual(self.breaker.state, CircuitState.CLOSED)
+
+    def test_half_open_probe(self):
+        for _ in range(2):
+            self.assertRaises(ConnectionRefusedError, self.breaker.call, self.fail)
+        time.sleep(0.11)
+        # a failed probe opens the circuit again
+        self.assertRaises(ConnectionRefusedError, self.breaker.call, self.fail)
+        self.assertEqual(self.breaker.state, CircuitState.OPEN)
+        time.sleep(0.11)
+        self.breaker.call(lambda: FakeResponse(http.HTTPStatus.OK))
+        self.assertEqual(self.breaker.state, CircuitState.CLOSED)
+
+class PageRetrySchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.attempts = []
+        self.page_queue = queue.Queue()
+        self.scheduler = PageRetryScheduler(self.page_queue, base_delay=0.02, max_delay=0.1, deadline=0)
+        self.dispatcher = PagerDispatcher(self.page, self.page_queue, workers=1, on_complete=self.scheduler.on_complete)
+
+    def page(self, mrn, timestamp):
+        # the pager is down for the first two attempts
+        self.attempts.append(time.time())
+        if len(self.attempts) <= 2:
+            return FakeResponse(http.HTTPStatus.SERVICE_UNAVAILABLE)
+        return FakeResponse(http.HTTPStatus.OK)
+
+    def events(self, count):
+        events = []
+        deadline = time.time() + 5
+        while len(events) < count and time.time() < deadline:
+            events.extend(self.scheduler.events())
+            time.sleep(0.01)
+        return events
+
+    def test_retries_until_paged(self):
+        self.scheduler.schedule("1", "20240331113300")
+        events = self.events(4)
+        # the deadline of 0 is missed on the first failure, and only reported once
+        self.assertEqual([e[0] for e in events], ['expired', 'retry', 'retry', 'paged'])
+        self.assertEqual([e[3] for e in events if e[0] == 'retry'], [1, 2])
+        self.assertEqual(len(self.attempts), 3)
+        self.assertGreaterEqual(self.attempts[1] - self.attempts[0], 0.01)
+        self.assertGreaterEqual(self.attempts[2] - self.attempts[1], 0.02)
+
+    def test_backoff_long_outage(self):
+        for attempts in (1, 1025, 5000):
+            delay = self.scheduler.backoff(attempts)
+            self.assertLessEqual(delay, 0.1)
+            self.assertGreaterEqual(delay, 0.01 if attempts == 1 else 0.05)
+
+    def test_worker_survives_failed_completion(self):
+        completions = []
+        def on_complete(mrn, timestamp, success):
+            completions.append(mrn)
+            if mrn == "1":
+                raise KeyError(mrn)
+        page_queue = queue.Queue()
+        PagerDispatcher(lambda mrn, timestamp: FakeResponse(http.HTTPStatus.OK), page_queue, workers=1, on_complete=on_complete)
+        page_queue.put(("1", "20240331113300"))
+        page_queue.put(("2", "20240331113300"))
+        page_queue.join()
+        self.assertEqual(completions, ["1", "2"])
+
+    def test_resume_with_persisted_state(self):
+        self.attempts = [0, 0]
+        next_attempt = time.time() + 0.05
+        self.scheduler.schedule(2, "20240331113300", created=time.time(), attempts=5, next_attempt=next_attempt)
+        self.assertEqual(self.events(1), [('paged', '2', "20240331113300", None, None)])
+        self.assertGreaterEqual(self.attempts[-1], next_attempt)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import collections
+
+import modules.metrics_monitoring as monitoring
+
+# patients kept in memory, the least recently used one is evicted beyond this
+PATIENT_CACHE_SIZE = 10000
+# seconds between writes of the cached test results to the database, 0 writes every result through
+PATIENT_CACHE_FLUSH_SECONDS = 0
+
+def cache_key(mrn):
+    '''
+    The key of a patient in the cache, the MRN as stored in the INTEGER PRIMARY KEY column,
+    so '42' and 42 are the same patient. None if the MRN is not a number, such a patient is never cached.
+    '''
+    try:
+        return int(mrn)
+    except (TypeError, ValueError):
+        return None
+
+class PatientCache():
+    '''
+    LRU cache of patient rows in front of the database, see Database
+    The rows are the dicts returned by Database.get. A dirty row holds test results that are not
+    written to the database yet, it is handed back to be written when it is evicted or flushed.
+    Attributes:
+        size (int): The maximum number of patients kept
+        rows (OrderedDict): The row of every cached patient, by cache_key, least recently used first
+        dirty (set): The keys of the rows not written to the database yet
+    '''
+    def __init__(self, size=PATIENT_CACHE_SIZE):
+        self.size = size
+        self.rows = collections.OrderedDict()
+        self.dirty = set()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, key):
+        '''
+        Get the cached row of a patient, and mark it as the most recently used
+        Args:
+            key (int): The cache_key of the patient
+        Returns:
+            dict: The cached row, None if the patient is not cached
+        '''
+        row = self.rows.get(key)
+        if row is None:
+            monitoring.increase_patient_cache_misses()
+            return None
+        self.rows.move_to_end(key)
+        monitoring.increase_patient_cache_hits()
+        return row
+
+    def put(self, key, row, dirty=False):
+        '''
+        Cache the row of a patient, evicting the least recently used patients beyond the size
+        Args:
+            key (int): The cache_key of the patient
+            row (dict): The row of the patient
+            dirty (bool): Whether the row is not written to the database yet
+        Returns:
+            list: (key, row) of every evicted dirty row, which must be written to the database
+        '''
+        self.rows[key] = row
+        self.rows.move_to_end(key)
+        if dirty:
+            self.dirty.add(key)
+        evicted = []
+        while len(self.rows) > self.size:
+            old_key, old_row = self.rows.popitem(last=False)
+            monitoring.increase_patient_cache_evictions()
+            if old_key in self.dirty:
+                self.dirty.discard(old_key)
+                evicted.append((old_key, old_row))
+        return evicted
+
+    def update(self, key, **fields):
+        '''
+        Update the fields of a cached row after they were written to the database, does nothing if the patient is not cached
+        Args:
+            key (int): The cache_key of the patient
+            fields: The new values of the fields
+        '''
+        row = self.rows.get(key)
+        if row is not None:
+            row.update(fields)
+
+    def take(self, key):
+        '''
+        Returns [(key, row)] if the row of the patient is dirty and marks it as written, [] otherwise
+        '''
+        if key not in self.dirty:
+            return []
+        self.dirty.discard(key)
+        return [(key, self.rows[key])]
+
+    def take_dirty(self):
+        '''
+        Returns (key, row) of every dirty row and marks them as written
+        '''
+        rows = [(key, self.rows[key]) for key in self.dirty]
+        self.dirty.clear()
+        return rows
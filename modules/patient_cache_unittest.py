@@ -0,0 +1,48 @@
+import unittest
+
+from patient_cache import PatientCache, cache_key
+from metrics_monitoring import patient_cache_metrics
+
+class PatientCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = PatientCache(size=2)
+
+    def test_lru_eviction(self):
+        evictions = patient_cache_metrics['patient_cache_evictions']._value.get()
+        self.cache.put(1, {'mrn': 1})
+        self.cache.put(2, {'mrn': 2})
+        # 1 is used, so 2 is the least recently used
+        self.assertEqual(self.cache.get(1), {'mrn': 1})
+        self.assertEqual(self.cache.put(3, {'mrn': 3}), [])
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(patient_cache_metrics['patient_cache_evictions']._value.get(), evictions + 1)
+
+    def test_hits_and_misses(self):
+        hits = patient_cache_metrics['patient_cache_hits']._value.get()
+        misses = patient_cache_metrics['patient_cache_misses']._value.get()
+        self.cache.put(1, {'mrn': 1})
+        self.cache.get(1)
+        self.cache.get(2)
+        self.assertEqual(patient_cache_metrics['patient_cache_hits']._value.get(), hits + 1)
+        self.assertEqual(patient_cache_metrics['patient_cache_misses']._value.get(), misses + 1)
+
+    def test_dirty_rows(self):
+        self.cache.put(1, {'mrn': 1}, dirty=True)
+        self.cache.put(2, {'mrn': 2}, dirty=True)
+        # an evicted dirty row is handed back to be written
+        self.assertEqual(self.cache.put(3, {'mrn': 3}), [(1, {'mrn': 1})])
+        self.cache.update(2, paged=1)
+        self.assertEqual(self.cache.take_dirty(), [(2, {'mrn': 2, 'paged': 1})])
+        self.assertEqual(self.cache.take_dirty(), [])
+        self.cache.put(3, {'mrn': 3}, dirty=True)
+        self.assertEqual(self.cache.take(3), [(3, {'mrn': 3})])
+        self.assertEqual(self.cache.take(3), [])
+
+    def test_cache_key(self):
+        self.assertEqual(cache_key('42'), 42)
+        self.assertEqual(cache_key(42), 42)
+        self.assertIsNone(cache_key('A42'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,6 @@
-from datetime import datetime
 import torch
 import modules.metrics_monitoring as monitoring
+import modules.timestamps as timestamps
 from modules.module_logging import preprocessor_logger
 
 # Following constants are computed from CW1 training data
@@ -46,7 +46,7 @@ class Preprocessor():
             return
         # test result
         elif self.message.message_type == 'ORU^R01':
-            patient_data = self.database.get(self.message.mrn)
+            patient_data = self.database.get(self.message.mrn, test_results=False)
             if patient_data is None:
                 return None
             if patient_data["gender"] == "" or patient_data["dob"] =="":
@@ -59,19 +59,13 @@ class Preprocessor():
             # TODO: if gender or dob is empty, we should use an alternative model
             if gender == "" or dob =="":
                 raise Exception('Error: empty gender or dob, please register patient first')
-            self.database.set(self.message.mrn, self.message.obr_timestamp, self.message.obx_value)
-            patient_data = self.database.get(self.message.mrn)
-            test_results = patient_data['test_results'].split(',')
-            test_results = [float(x) for x in test_results]
-            test_dates = patient_data['test_dates'].split(',')
-            test_dates = [float(x) for x in test_dates]
-            # only look at the last 9 test results
+            # every creatinine result of the panel is stored in one transaction, then inference runs once
+            self.database.set_many(self.message.mrn, self.message.creatinine_results())
+            # only look at the last 9 test results, only those are read
+            test_results, test_dates = self.database.recent_results(self.message.mrn, 9)
             # if there is only one test result, we just skip it
             if len(test_results) <= 1:
                 return None
-            if len(test_results) > 9:
-                test_results = test_results[-9:]
-                test_dates = test_dates[-9:]
             if len(test_results) < 9:
                 test_results = [0] * (9 - len(test_results)) + test_results
                 test_dates = [0] * (9 - len(test_dates)) + test_dates
@@ -138,11 +132,10 @@ class Preprocessor():
             input_tensor (Tensor): the 2D tensor of the patient's info and test results
                                     With shape (n, 4), n is the number of test results (fixed to 9 in CW3)
         '''
-        dob = datetime.strptime(dob, '%Y-%m-%d')
+        dob = timestamps.parse_iso(dob)
         # The age computation is not accurate, but will not significantly affect the model
-        # python's datetime library is faster
         # 0.25 is used to account for leap years
-        age = (datetime.now() - dob).days / 365.25
+        age = (timestamps.now() - dob) // timestamps.SECONDS_PER_DAY / 365.25
         static_data = torch.tensor([age, gender], dtype=torch.float32)
         test_results = [float(x) for x in test_results]
         static_data = static_data.repeat(len(test_results), 1)
@@ -96,6 +96,17 @@ class TestPreprocessor(unittest.TestCase):
         self.assertEqual(output_tensor.shape, torch.Size([1, 9, 4]))
 
 
+    def test_preprocess_panel(self):
+        self.preprocessor.preprocess(self.message3)
+        panel = messagetypes.Oru_r01()
+        panel.process_message(['MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20200103000000||ORU^R01|||2.5', 'PID|1||1',
+                               'OBR|1||||||20200103000000', 'OBX|1|SN|CREATININE||3.0', 'OBX|2|SN|SODIUM||140',
+                               'OBR|2||||||20200104000000', 'OBX|1|SN|CREATININE||4.0'])
+        output_tensor = self.preprocessor.preprocess(panel)
+        # both creatinine results are stored, and one input is returned for them
+        self.assertEqual(output_tensor.shape, torch.Size([1, 9, 4]))
+        self.assertEqual(self.db.get('1')['test_results'], '1.0,2.0,3.0,4.0')
+        self.assertAlmostEqual(output_tensor[0, -1, 1].item(), (4.0 - VALUE_MEAN) / VALUE_STD, places=5)
 
 
 if __name__ == '__main__':
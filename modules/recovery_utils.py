@@ -3,27 +3,41 @@ import os
 
 from modules.dataparser import DataParser
 from modules.database import Database
+from modules.mllp import MLLPFile
 from modules.preprocessor import Preprocessor
 from modules.model import load_model, inference
 from modules.module_logging import main_logger, set_log_path
 import modules.metrics_monitoring as monitoring
 
 def read_missed_messages():
+	"""
+	Reads the messages missed while the service was down, from /app/data/missed_messages.mllp in MLLP
+	format, read lazily, or else from /app/data/missed_messages.txt, one message per MSH segment.
+	The file is deleted once read, an MLLP file stays mapped until it is recovered.
+	Returns:
+		messages: list[bytes] or MLLPFile [The messages, None if there is no file]
+	"""
+	directory = "/app/data/"
+	file_path = os.path.join(directory, "missed_messages.mllp")
+	if os.path.isfile(file_path):
+		messages = MLLPFile(file_path)
+		os.remove(file_path)
+		print(f"File {file_path} has been deleted.")
+		return messages
 
 	# Specify the path and filename
-	directory = "/app/data/"
 	filename = "missed_messages.txt"
 	file_path = os.path.join(directory, filename)
 
 	# Check if the file exists
 	if os.path.isfile(file_path):
 		# File exists, so read it
-		with open(file_path, 'r') as file:
-			content = file.read()		
+		with open(file_path, 'rb') as file:
+			content = file.read()
 		# delete the file
 		os.remove(file_path)
 		print(f"File {filename} has been deleted.")
-		return content.split("MSH")
+		return [b"MSH" + message.replace(b"\n", b"\r") for message in content.split(b"MSH") if message[:3] == b"|^~"]
 	return None
 
 def recover_messages(missed_messages, dataparser, preprocessor, model, database, device):
@@ -31,13 +45,6 @@ def recover_messages(missed_messages, dataparser, preprocessor, model, database,
 		# Pass the message
 		# TODO: Add monitoring for recovered messages
 
-		if message[:3] != "|^~":
-			continue
-		message = "MSH" + message.replace("\n", "\r")
-		# Convert message to bytes
-		message = message.encode('utf-8')
-
-
 		#monitoring.increase_message_received()
 		
 		# Pass the message to data parser
@@ -48,14 +55,16 @@ def recover_messages(missed_messages, dataparser, preprocessor, model, database,
 			continue
 		elif parsed_message.message_type == 'ORU^R01':
 			monitoring.increase_blood_test_messages()
-			monitoring.increase_sum_blood_test_results(parsed_message.obx_value)
-			monitoring.update_running_mean_blood_test_results()
+			for _, value in parsed_message.creatinine_results():
+				monitoring.increase_sum_blood_test_results(value)
+				monitoring.update_running_mean_blood_test_results()
 
 		mrn = parsed_message.mrn
 		timestamp = parsed_message.msg_timestamp
 
 		# Process message
 		preprocessed_message = preprocessor.preprocess(parsed_message)
+		dataparser.release(parsed_message)
 		
 		# Perform inference
 		has_aki = False
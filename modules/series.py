@@ -0,0 +1,98 @@
+import struct
+
+import modules.timestamps as timestamps
+
+# a patient's test results are stored as two packed little endian arrays, the float32 values
+# and the int64 times in seconds since the epoch, appending a result appends one item to each
+VALUE = struct.Struct('<f')
+TIME = struct.Struct('<q')
+
+def pack_values(values):
+    '''
+    Pack test result values into a series
+    Args:
+        values (list): The values, in order
+    Returns:
+        bytes: The packed float32 values
+    '''
+    return struct.pack(f'<{len(values)}f', *values)
+
+def pack_times(times):
+    '''
+    Pack test result times into a series
+    Args:
+        times (list): The times in seconds since the epoch, in order
+    Returns:
+        bytes: The packed int64 times
+    '''
+    return struct.pack(f'<{len(times)}q', *times)
+
+def append_value(series, value, window=None):
+    '''Returns the series of values with one more value, only the last window values if set, without unpacking it'''
+    series += VALUE.pack(value)
+    return series if window is None else series[-window * VALUE.size:]
+
+def append_time(series, time, window=None):
+    '''Returns the series of times with one more time, only the last window times if set, without unpacking it'''
+    series += TIME.pack(time)
+    return series if window is None else series[-window * TIME.size:]
+
+def unpack_values(series):
+    '''Unpack every value of a series'''
+    return struct.unpack(f'<{len(series) // VALUE.size}f', series)
+
+def unpack_times(series):
+    '''Unpack every time of a series'''
+    return struct.unpack(f'<{len(series) // TIME.size}q', series)
+
+def last_values(series, k):
+    '''
+    Unpack the last k values of a series, only those are read
+    Args:
+        series (bytes): The packed values
+        k (int): The number of values, fewer if the series is shorter
+    Returns:
+        tuple: The values, in order
+    '''
+    n = min(k, len(series) // VALUE.size)
+    return struct.unpack_from(f'<{n}f', series, len(series) - n * VALUE.size)
+
+def last_times(series, k):
+    '''
+    Unpack the last k times of a series, only those are read
+    Args:
+        series (bytes): The packed times
+        k (int): The number of times, fewer if the series is shorter
+    Returns:
+        tuple: The times, in order
+    '''
+    n = min(k, len(series) // TIME.size)
+    return struct.unpack_from(f'<{n}q', series, len(series) - n * TIME.size)
+
+def gaps(times):
+    '''
+    The days from each test to the next one, 0 for the last test, the test_dates the model takes
+    Args:
+        times (tuple): The times in seconds since the epoch, in order
+    Returns:
+        list: The gaps in days
+    '''
+    if not times:
+        return []
+    return [(times[i + 1] - times[i]) / timestamps.SECONDS_PER_DAY for i in range(len(times) - 1)] + [0]
+
+def times_from_gaps(test_dates, last_time):
+    '''
+    Inverse of gaps, the times of the tests from the gaps and the time of the last test
+    Used to migrate the comma separated test_dates, see Database.migrate_series
+    Args:
+        test_dates (list): The gaps in days
+        last_time (int): The time of the last test, in seconds since the epoch
+    Returns:
+        list: The times in seconds since the epoch
+    '''
+    times = [last_time]
+    for gap in reversed(test_dates[:-1]):
+        times.append(times[-1] - round(float(gap) * timestamps.SECONDS_PER_DAY))
+    times.reverse()
+    return times
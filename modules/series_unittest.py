@@ -0,0 +1,21 @@
+import unittest
+
+from series import pack_values, pack_times, append_value, append_time, unpack_values, last_values, last_times, gaps, times_from_gaps
+
+class SeriesTest(unittest.TestCase):
+    def test_append_and_last(self):
+        values, times = pack_values([1.0, 2.5]), pack_times([0, 86400])
+        values, times = append_value(values, 3.0), append_time(times, 3 * 86400)
+        self.assertEqual(unpack_values(values), (1.0, 2.5, 3.0))
+        self.assertEqual(last_values(values, 2), (2.5, 3.0))
+        self.assertEqual(last_values(values, 9), (1.0, 2.5, 3.0))
+        self.assertEqual(last_times(times, 2), (86400, 3 * 86400))
+        self.assertEqual(last_values(b'', 9), ())
+
+    def test_gaps(self):
+        self.assertEqual(gaps((0, 86400, 3 * 86400)), [1.0, 2.0, 0])
+        self.assertEqual(gaps(()), [])
+        self.assertEqual(times_from_gaps(['1.0', '0.5', '0'], 10 * 86400), [8.5 * 86400, 9.5 * 86400, 10 * 86400])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import functools
+import time
+
+# parsed and formatted timestamps are cached, dates of birth and history dates repeat a lot
+TIMESTAMP_CACHE_SIZE = 4096
+SECONDS_PER_DAY = 86400
+
+DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+def days_from_civil(year, month, day):
+    '''
+    Days since 1970-01-01 of a date of the proleptic Gregorian calendar, see
+    http://howardhinnant.github.io/date_algorithms.html
+    Args:
+        - year (int), month (int), day (int): The date, which must be valid.
+    '''
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+def civil_from_days(days):
+    '''Inverse of days_from_civil, returns the (year, month, day) of a number of days since 1970-01-01.'''
+    days += 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    mp = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * mp + 2) // 5 + 1
+    month = mp + 3 if mp < 10 else mp - 9
+    return year_of_era + era * 400 + (month <= 2), month, day
+
+def to_seconds(year, month, day, hour=0, minute=0, second=0):
+    '''Checks the fields like strptime does and returns them as seconds since the epoch, raises ValueError if invalid.'''
+    leap = month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+    if not (1 <= month <= 12 and 1 <= day <= DAYS_IN_MONTH[month - 1] + leap
+            and hour < 24 and minute < 60 and second < 60):
+        raise ValueError(f"invalid date {year:04d}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}:{second:02d}")
+    return days_from_civil(year, month, day) * SECONDS_PER_DAY + hour * 3600 + minute * 60 + second
+
+@functools.lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_hl7(value):
+    '''
+    Parses a fixed width HL7 date (YYYYMMDD) or timestamp (YYYYMMDDHHMM or YYYYMMDDHHMMSS).
+    Args:
+        - value (str): The date or timestamp.
+    Returns:
+        - seconds (int): Seconds since the epoch, timestamps carry no time zone.
+    '''
+    if len(value) not in (8, 12, 14) or not value.isascii() or not value.isdigit():
+        raise ValueError(f"'{value}' is not an HL7 date or timestamp")
+    if len(value) == 8:
+        return to_seconds(int(value[:4]), int(value[4:6]), int(value[6:8]))
+    return to_seconds(int(value[:4]), int(value[4:6]), int(value[6:8]),
+                      int(value[8:10]), int(value[10:12]), int(value[12:14] or 0))
+
+@functools.lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_iso(value):
+    '''
+    Parses an ISO date (YYYY-MM-DD) or timestamp (YYYY-MM-DD HH:MM:SS), the formats stored in the database.
+    Args:
+        - value (str): The date or timestamp.
+    Returns:
+        - seconds (int): Seconds since the epoch, timestamps carry no time zone.
+    '''
+    if len(value) not in (10, 19) or not value.isascii() or value[4] != '-' or value[7] != '-' \
+            or (len(value) == 19 and (value[10] != ' ' or value[13] != ':' or value[16] != ':')):
+        raise ValueError(f"'{value}' is not an ISO date or timestamp")
+    digits = value[:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:19]
+    if not digits.isdigit():
+        raise ValueError(f"'{value}' is not an ISO date or timestamp")
+    return parse_hl7(digits)
+
+@functools.lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def format_iso(seconds, date_only=False):
+    '''
+    Formats seconds since the epoch as an ISO timestamp (YYYY-MM-DD HH:MM:SS).
+    Args:
+        - seconds (int): Seconds since the epoch.
+        - date_only (bool): Whether to format the date only (YYYY-MM-DD).
+    '''
+    days, second = divmod(int(seconds), SECONDS_PER_DAY)
+    year, month, day = civil_from_days(days)
+    if date_only:
+        return f"{year:04d}-{month:02d}-{day:02d}"
+    minute, second = divmod(second, 60)
+    hour, minute = divmod(minute, 60)
+    return f"{year:04d}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}:{second:02d}"
+
+def hl7_to_iso(value):
+    '''Converts an HL7 date or timestamp to the ISO form of the same width, e.g. 20240331 to 2024-03-31.'''
+    return format_iso(parse_hl7(value), len(value) == 8)
+
+def now():
+    '''The local wall clock time in seconds since the epoch, comparable with the parsed timestamps like datetime.now().'''
+    seconds = time.time()
+    return int(seconds) + time.localtime(seconds).tm_gmtoff
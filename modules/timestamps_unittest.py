@@ -0,0 +1,37 @@
+import calendar
+import datetime
+import unittest
+
+from timestamps import parse_hl7, parse_iso, format_iso, hl7_to_iso, now
+
+class TimestampsTest(unittest.TestCase):
+    def test_matches_datetime(self):
+        # every day from 1900 to 2100, at a time that changes with the day
+        day = datetime.datetime(1900, 1, 1)
+        while day.year < 2100:
+            value = day.replace(hour=day.day % 24, minute=day.month, second=59)
+            seconds = calendar.timegm(value.timetuple())
+            self.assertEqual(parse_hl7(value.strftime('%Y%m%d%H%M%S')), seconds)
+            self.assertEqual(parse_iso(value.strftime('%Y-%m-%d %H:%M:%S')), seconds)
+            self.assertEqual(format_iso(seconds), value.strftime('%Y-%m-%d %H:%M:%S'))
+            day += datetime.timedelta(days=1)
+
+    def test_dates(self):
+        self.assertEqual(hl7_to_iso('19870515'), '1987-05-15')
+        self.assertEqual(hl7_to_iso('20240331113300'), '2024-03-31 11:33:00')
+        self.assertEqual(parse_hl7('202401201630'), parse_iso('2024-01-20 16:30:00'))
+        self.assertEqual(parse_iso('1970-01-02'), 86400)
+        self.assertEqual(format_iso(86400, date_only=True), '1970-01-02')
+
+    def test_invalid(self):
+        for value in ('', '2024033111330', '20240230', '20230229000000', '20241301', '20240331243300',
+                      '2024-03-31 11:33:00', '２０２４０３３１', '+2024033'):
+            self.assertRaises(ValueError, parse_hl7, value)
+        for value in ('', '20240331', '2024-03-31T11:33:00', '2024-03-32', '2024-03-31 11:33:0x', '2024-3-31'):
+            self.assertRaises(ValueError, parse_iso, value)
+
+    def test_now(self):
+        self.assertLess(abs(now() - calendar.timegm(datetime.datetime.now().timetuple())), 2)
+
+if __name__ == "__main__":
+    unittest.main()
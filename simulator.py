@@ -8,6 +8,8 @@ import socket
 import threading
 import time
 
+from modules import mllp
+
 VERSION = "0.0.0"
 MLLP_BUFFER_SIZE = 1024
 MLLP_TIMEOUT_SECONDS = 10
@@ -88,39 +90,15 @@ def run_mllp_server(host, port, hl7_messages, shutdown_mllp, short_messages):
             t.start()
         print("mllp: graceful shutdown")
 
-MLLP_START_OF_BLOCK = 0x0b
-MLLP_END_OF_BLOCK = 0x1c
-MLLP_CARRIAGE_RETURN = 0x0d
+MLLP_START_OF_BLOCK = mllp.MLLPDelimiter.START_OF_BLOCK.value
+MLLP_END_OF_BLOCK = mllp.MLLPDelimiter.END_OF_BLOCK.value
+MLLP_CARRIAGE_RETURN = mllp.MLLPDelimiter.CARRIAGE_RETURN.value
 
 def parse_mllp_messages(buffer, source):
-    i = 0
-    messages = []
-    consumed = 0
-    expect = MLLP_START_OF_BLOCK
-    while i < len(buffer):
-        if expect is not None:
-            if buffer[i] != expect:
-                raise Exception(f"{source}: bad MLLP encoding: want {hex(expect)}, found {hex(buffer[i])}")
-            if expect == MLLP_START_OF_BLOCK:
-                expect = None
-                consumed = i
-            elif expect == MLLP_CARRIAGE_RETURN:
-                messages.append(buffer[consumed+1:i-1])
-                expect = MLLP_START_OF_BLOCK
-                consumed = i + 1
-        else:
-            if buffer[i] == MLLP_END_OF_BLOCK:
-                expect = MLLP_CARRIAGE_RETURN
-        i += 1
-    return messages, buffer[consumed:]
+    return mllp.decode_frames(buffer, source)
 
 def read_hl7_messages(filename):
-    with open(filename, "rb") as r:
-        messages, remaining = parse_mllp_messages(r.read(), filename)
-        if len(remaining) > 0:
-                print(f"messages: {len(messages)} remaining: {len(remaining)}")
-                raise Exception(f"{filename}: Unexpected data at end of file")
-        return messages
+    return mllp.MLLPFile(filename)
 
 class PagerRequestHandler(http.server.BaseHTTPRequestHandler):
 